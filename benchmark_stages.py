@@ -0,0 +1,124 @@
+import os, sys, io, time, subprocess
+import contextlib
+from datetime import datetime
+import pandas as pd
+import pyogrio
+import synthetic_orn
+import to_segments_gpd as segments
+
+# Times the stages of to_segments_gpd.py separately on synthetic ORN datasets of increasing size and appends the timings to a
+# CSV, so a slow down shows up against the last run at the same scale. Datasets are generated once per scale and reused
+
+def git_commit():
+    # Returns the short hash of the checked out commit, '' outside a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+def use_dataset(data_dir):
+    # Points the segmentation module at a synthetic dataset, with the layer cache off so every read goes to the gdb and the
+    # street names parsed again by every run instead of kept on disk. The helpers memoized on first use (open_street_names,
+    # table_dtypes, region_ids, open_backend, ...) are cleared so nothing read from the last scale is used for this one
+    segments.ORN_GDB = os.path.join(data_dir, 'Non_Sensitive.gdb')
+    segments.workingGDB = os.path.join(data_dir, 'workingGDB.gdb')
+    segments.road_gdb, segments.road_layer = segments.workingGDB, 'ORN_net_element_tester'
+    segments.use_layer_cache = False
+    segments.street_name_cache_dir = None
+    for value in vars(segments).values():
+        if hasattr(value, 'cache_clear'):
+            value.cache_clear()
+
+def check_rows(stage, rows, expected):
+    # Stops the benchmark when a stage saw another number of rows than the synthetic dataset holds, its timing would be of
+    # another dataset
+    if rows != expected:
+        raise RuntimeError(f'{stage}: {rows} rows where the synthetic dataset has {expected}')
+
+def layer_rows(gdb, layer):
+    # Returns the number of rows of a layer of the synthetic dataset
+    return pyogrio.read_info(gdb, layer=layer, force_feature_count=True)['features']
+
+def time_stages(data_dir, count):
+    # Runs the pipeline once, stage by stage, on the synthetic dataset of count road elements and returns the seconds spent
+    # in each stage. The rows of the roads and of every table read are checked against the dataset
+    timings = {}
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO() if quiet else sys.stdout):
+            result = func(*args)
+        timings[stage] = time.perf_counter() - start
+        return result
+    tables = segments.event_tables(segments.ORN_GDB)
+    roads_df = timed('read_roads', segments.read_roads)
+    check_rows('read_roads', len(roads_df), count)
+    source = timed('read_tables', segments.IndexedTables, segments.ORN_GDB, tables + ['ORN_ADDRESS_INFO', 'ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME'])
+    for layer, tbl_df in source.tables.items():
+        check_rows(layer, len(tbl_df), layer_rows(segments.ORN_GDB, layer))
+    # The address stage reads ORN_STREET_NAME_PARSED and parses the missing names on every run, not once per process
+    segments.open_street_names.cache_clear()
+    roads_df = timed('address', segments.add_address_ranges, roads_df, source)
+    street_names = segments.open_street_names(segments.ORN_GDB)
+    check_rows('ORN_STREET_NAME_PARSED', len(street_names.table) + street_names.duplicates, layer_rows(segments.ORN_GDB, 'ORN_STREET_NAME_PARSED'))
+    roads_df = timed('events', segments.add_events, roads_df, tables, source)
+    roads_df = timed('routes', segments.add_routes, roads_df, source)
+    check_rows('routes', len(roads_df), count)
+    timed('encode', segments.encode_segments, roads_df)
+    out_gpkg = os.path.join(data_dir, 'benchmark_segments.gpkg')
+    if os.path.exists(out_gpkg):
+        os.remove(out_gpkg)
+    def export():
+        writer = segments.GpkgWriter(out_gpkg, use_arrow=segments.use_arrow)
+        writer.write(roads_df, 'ORN_Road_Segments')
+        writer.close()
+    timed('export', export)
+    return timings
+
+def compare_runs(results_df, previous_df):
+    # Prints each stage timing next to the last recorded run at the same scale, flagging stages slower by more than tolerance
+    if len(previous_df):
+        previous_df = previous_df.drop_duplicates(subset=['ELEMENTS', 'STAGE'], keep='last')
+        results_df = results_df.merge(previous_df[['ELEMENTS', 'STAGE', 'SECONDS', 'COMMIT']], how='left', on=['ELEMENTS', 'STAGE'],
+                                    suffixes=('', '_LAST'))
+    else:
+        results_df = results_df.assign(SECONDS_LAST= float('nan'), COMMIT_LAST= '')
+    for row in results_df.itertuples():
+        line = f'{row.ELEMENTS:>9} {row.STAGE:<12} {row.SECONDS:9.3f}s'
+        if pd.notna(row.SECONDS_LAST):
+            change = row.SECONDS / row.SECONDS_LAST - 1
+            line += f'  {change:+7.1%} vs {row.SECONDS_LAST:.3f}s ({row.COMMIT_LAST})'
+            if change > tolerance:
+                line += '  SLOWER'
+        print(line)
+
+#----------------------------------------------------------------------------------------------------------------
+#Inputs
+# python benchmark_stages.py [road element counts ...]
+
+scales = [int(count) for count in sys.argv[1:]] or [10000, 100000, 1000000] # Road element counts to benchmark
+bench_dir = os.path.join(os.getcwd(), 'benchmark_data') # Synthetic datasets, delete a scale's folder to regenerate it
+results_csv = os.path.join(os.getcwd(), 'benchmark_results.csv') # Every run is appended here
+seed = 0
+repeats = 3 # Each stage is timed this many times and the fastest run is kept
+tolerance = 0.2 # Stages more than 20% slower than the last run are flagged
+quiet = True # Hide the progress messages of the stages while they are timed
+
+if __name__ == '__main__':
+    run_date = datetime.now().isoformat(timespec='seconds')
+    commit = git_commit()
+    results = []
+    for count in scales:
+        data_dir = os.path.join(bench_dir, f'synthetic_{count}')
+        if not os.path.exists(os.path.join(data_dir, 'workingGDB.gdb')):
+            synthetic_orn.write_synthetic_orn(data_dir, count, seed)
+        use_dataset(data_dir)
+        print(f'Timing stages on {count} road elements')
+        runs = pd.DataFrame([time_stages(data_dir, count) for _ in range(repeats)])
+        for stage, seconds in runs.min().items():
+            results.append({'RUN_DATE' : run_date, 'COMMIT' : commit, 'ELEMENTS' : count, 'STAGE' : stage, 'SECONDS' : round(seconds, 4)})
+    results_df = pd.DataFrame(results)
+    previous_df = pd.read_csv(results_csv, dtype={'COMMIT' : str}, keep_default_na=False) if os.path.exists(results_csv) else pd.DataFrame()
+    compare_runs(results_df, previous_df)
+    results_df.to_csv(results_csv, mode='a', header=not os.path.exists(results_csv), index=False)
+    print('DONE!')
@@ -0,0 +1,102 @@
+import os, json, time, shutil, hashlib
+from datetime import datetime
+import pandas as pd
+
+# Parquet checkpoints of the pipeline stages so a run that fails late can resume from the last stage that finished
+# Each folder holds one chain of stages (a partition of the roads, or the run wide stages) and a manifest.json listing every
+# checkpoint with its version, the key of the data and settings the stage used and the versions of the checkpoints it was
+# built from. A checkpoint is reused only while it is listed, its file is there, its key is unchanged and everything
+# upstream of it is unchanged, so a stage named in rerun is built again along with every stage built from it
+# Runs over other roads (a region) checkpoint under a scope folder of their own, nothing is ever removed but by prune
+
+def scope_folder(checkpoint_dir, scope):
+    # Returns the checkpoint folder of a scope, the repr of what decides which roads a run covers
+    return os.path.join(checkpoint_dir, hashlib.sha1(scope.encode()).hexdigest()[:16])
+
+def prune(checkpoint_dir, keep=None):
+    # Removes the checkpoints of every scope but keep (a scope folder), all of them when keep is None
+    if not os.path.isdir(checkpoint_dir):
+        return
+    for folder in os.listdir(checkpoint_dir):
+        if keep is None or folder != os.path.basename(keep):
+            print(f'Removing checkpoints {folder}')
+            shutil.rmtree(os.path.join(checkpoint_dir, folder), ignore_errors=True)
+
+class Checkpoints:
+    # The checkpoints of one folder, rerun names the stages to build again even when their checkpoint is valid and key(name)
+    # returns the key of the data and settings a stage uses (fingerprints of the gdbs it reads, the inputs it depends on)
+    def __init__(self, folder, rerun=(), key=None):
+        self.folder = folder
+        self.rerun = set(rerun)
+        self.key = key
+        self.path = os.path.join(folder, 'manifest.json')
+        self.manifest = {'stages' : {}}
+        if os.path.exists(self.path):
+            with open(self.path) as manifest:
+                self.manifest = json.load(manifest)
+        self.loaded, self.built = [], []
+
+    def version(self, name):
+        # Returns the version of the checkpoint of a stage, None when there is none
+        entry = self.manifest['stages'].get(name)
+        return entry['version'] if entry else None
+
+    def digest(self):
+        # Returns a version of the whole chain, it changes whenever any of its checkpoints does
+        versions = sorted((name, entry['version']) for name, entry in self.manifest['stages'].items())
+        return hashlib.sha1(repr(versions).encode()).hexdigest()[:16]
+
+    def inputs(self, name, inputs=None):
+        # Returns what a checkpoint is built from: the versions of the upstream checkpoints in inputs and the key of the stage
+        return dict(inputs or {}, **({'key' : self.key(name)} if self.key is not None else {}))
+
+    def valid(self, name, inputs=None):
+        # Returns True when the checkpoint of a stage can be reused: it was built from the same input versions and key and is
+        # not to be rerun
+        entry = self.manifest['stages'].get(name)
+        return (entry is not None and name not in self.rerun and entry['inputs'] == self.inputs(name, inputs)
+                and os.path.exists(os.path.join(self.folder, entry['file'])))
+
+    def load(self, name):
+        # Returns the checkpoint of a stage
+        entry = self.manifest['stages'][name]
+        path = os.path.join(self.folder, entry['file'])
+        if entry['geometry']:
+            import geopandas as gpd
+            return gpd.read_parquet(path)
+        return pd.read_parquet(path)
+
+    def save(self, name, df, inputs=None):
+        # Writes the checkpoint of a stage then lists it in the manifest, both written aside and renamed so a run killed
+        # part way never leaves a checkpoint the manifest vouches for half written
+        file = name.replace('/', '__') + '.parquet'
+        os.makedirs(self.folder, exist_ok=True)
+        temp_path = os.path.join(self.folder, f'{file}.{os.getpid()}.tmp')
+        df.to_parquet(temp_path)
+        os.replace(temp_path, os.path.join(self.folder, file))
+        self.manifest['stages'][name] = {'file' : file, 'rows' : len(df), 'geometry' : type(df).__name__ == 'GeoDataFrame',
+                                        'version' : hashlib.sha1(f'{name}|{time.time_ns()}|{os.getpid()}'.encode()).hexdigest()[:12],
+                                        'inputs' : self.inputs(name, inputs), 'saved' : datetime.now().isoformat(timespec='seconds')}
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as manifest:
+            json.dump(self.manifest, manifest, indent=2)
+        os.replace(temp_path, self.path)
+        self.rerun.discard(name) # a stage is only rerun once per run
+
+    def stage(self, name, build, inputs=None):
+        # Returns the output of a stage, from its checkpoint when it is valid, otherwise from build() and checkpointed
+        if self.valid(name, inputs):
+            self.loaded.append(name)
+            print(f'{name}: resumed from the checkpoint of {self.manifest["stages"][name]["saved"]}')
+            return self.load(name)
+        df = build()
+        self.save(name, df, inputs)
+        self.built.append(name)
+        return df
+
+def run_stage(checkpoints, name, build, after=()):
+    # Runs a stage through checkpoints, built from the checkpoints of the stages named in after, or just builds it when
+    # checkpointing is off (checkpoints is None)
+    if checkpoints is None:
+        return build()
+    return checkpoints.stage(name, build, {stage : checkpoints.version(stage) for stage in after})
@@ -0,0 +1,177 @@
+import os, sys, io
+import contextlib
+import importlib.util
+import numpy as np
+import pandas as pd
+import synthetic_orn
+from nrn_codes import load_code_tables
+from run_report import RunReport
+from event_qa import event_issues
+from street_names import parsed_fields, street_vocabulary, parse_street_name
+from segments_core import make_backend, address_ranges, event_fields, longest_events, route_multifields
+
+# Checks the stages against the results they are meant to give, on small synthetic tables built in memory with the
+# synthetic_orn.py helpers, and the event QA and street name parser against hand made cases. Run it before merging a change
+# to segments_core.py, segments_duckdb.py, event_qa.py or street_names.py, it prints every failed case and exits with 1
+# when there is one
+
+def check(name, compare):
+    # Runs compare (a function raising AssertionError on a mismatch) and records the case as failed when it raises
+    try:
+        compare()
+    except AssertionError as error:
+        failures.append(name)
+        print(f'FAILED {name}: {str(error).strip()[:500]}')
+
+def with_ties(events, rng, share):
+    # Appends copies of a share of the events (new EVENT_IDs, the same element and measures) so the longest event and the
+    # routes tie, blanks the measures of another share and shuffles the rows, so table order decides the ties
+    copies = events.iloc[rng.choice(len(events), int(len(events) * share), replace=False)]
+    copies = copies.assign(EVENT_ID= np.arange(len(copies)) + events['EVENT_ID'].max() + 1)
+    events = pd.concat([events, copies], ignore_index=True)
+    blank = rng.random(len(events)) < share / 2
+    events.loc[blank, ['FROM_MEASURE', 'TO_MEASURE']] = np.nan
+    return events.iloc[rng.permutation(len(events))].reset_index(drop=True)
+
+def backend_tables(count, seed):
+    # Returns synthetic roads, a speed limit table, the address rows (with their parsed names) and a route number table
+    rng = np.random.default_rng(seed)
+    roads, junctions = synthetic_orn.grid_roads(count, rng)
+    parsed = synthetic_orn.street_names(rng, max(count // 20, 1))
+    speed_df = with_ties(synthetic_orn.event_table(synthetic_orn.measure_events(roads, rng, 0.9, 1.5), rng, 1, SPEED_LIMIT= [40, 50, 60, 80]), rng, 0.2)
+    address_df = with_ties(synthetic_orn.event_table(synthetic_orn.measure_events(roads, rng, 0.8, 1.5), rng, 1,
+                                                    STREET_SIDE= ['Left', 'Right', 'Both'],
+                                                    HOUSE_NUMBER_STRUCTURE= ['Even', 'Odd', 'Mixed', 'Irregular', 'None', 'Unknown'],
+                                                    FIRST_HOUSE_NUMBER= lambda size: rng.integers(1, 500, size),
+                                                    LAST_HOUSE_NUMBER= lambda size: rng.integers(500, 2000, size),
+                                                    FULL_STREET_NAME= parsed['FULL_STREET_NAME'].values), rng, 0.2)
+    address_df = address_df.merge(parsed, how='left', on='FULL_STREET_NAME')
+    routes_df = with_ties(synthetic_orn.event_table(synthetic_orn.measure_events(roads, rng, 0.3, 2.0), rng, 1,
+                                                    ROUTE_NUMBER= ['2', '7', '17', '401', None]), rng, 0.2)
+    return roads, speed_df, address_df, routes_df
+
+def backend_outputs(backend, roads, speed_df, address_df, routes_df):
+    # Returns the row selections of a backend and the address, event and route stage outputs built from them
+    report = RunReport()
+    ids = speed_df['ORN_ROAD_NET_ELEMENT_ID'].values
+    sides = address_df['STREET_SIDE'].values
+    measure_dif = np.abs(routes_df['TO_MEASURE'].values - routes_df['FROM_MEASURE'].values)
+    add_rng_df = address_df.rename(columns={'AGENCY_NAME' : 'ADDRESS_INFO_AGENCY', 'EFFECTIVE_DATETIME' : 'ADDRESS_INFO_EFF_DATE',
+                                            'EVENT_ID' : 'ADDRESS_INFO_EVENT_ID'})
+    add_rng_base = add_rng_df[['ORN_ROAD_NET_ELEMENT_ID', 'ADDRESS_INFO_AGENCY', 'ADDRESS_INFO_EFF_DATE', 'ADDRESS_INFO_EVENT_ID',
+                                'STREET_SIDE', 'HOUSE_NUMBER_STRUCTURE']].drop_duplicates(subset=['ORN_ROAD_NET_ELEMENT_ID'], keep='first')
+    return {'longest_event_rows' : backend.longest_event_rows(ids, speed_df['FROM_MEASURE'].values, speed_df['TO_MEASURE'].values),
+            'side_rows' : backend.side_rows(address_df['ORN_ROAD_NET_ELEMENT_ID'].values, sides),
+            'route_rows' : backend.route_rows(routes_df[['ORN_ROAD_NET_ELEMENT_ID', 'ROUTE_NUMBER']], measure_dif),
+            'address_ranges' : address_ranges(add_rng_df, add_rng_base, code_tables, report, backend),
+            'longest_events' : longest_events(event_fields(speed_df, 'SPEED_LIMIT'), 'SPEED_LIMIT', backend),
+            'route_multifields' : route_multifields(roads[['OGF_ID']], routes_df, ['ROUTE_NUMBER'], 3, report, backend)}
+
+def check_backends():
+    # PandasBackend and DuckDBBackend must pick the same rows, in the same order, with the same tie breaks: the first longest
+    # event in table order, the last address event on each side and routes ranked longest first then in table order
+    if importlib.util.find_spec('duckdb') is None:
+        print('duckdb is not installed, skipping the backend checks')
+        return
+    for seed in seeds:
+        tables = backend_tables(count, seed)
+        with contextlib.redirect_stdout(io.StringIO() if quiet else sys.stdout):
+            expected = backend_outputs(make_backend('pandas'), *tables)
+            result = backend_outputs(make_backend('duckdb', threads=2), *tables)
+        for name in ['longest_event_rows', 'side_rows', 'route_rows']:
+            # side_rows and route_rows return several arrays (and a count), longest_event_rows one array
+            parts = lambda value: value if isinstance(value, tuple) else (value,)
+            check(f'{name} seed {seed}', lambda: [np.testing.assert_array_equal(np.asarray(a), np.asarray(b))
+                                                for a, b in zip(parts(expected[name]), parts(result[name]))])
+        for name in ['address_ranges', 'longest_events', 'route_multifields']:
+            check(f'{name} seed {seed}', lambda: pd.testing.assert_frame_equal(expected[name], result[name]))
+    print(f'Backends compared on {len(seeds)} synthetic datasets of {count} road elements')
+
+def check_event_issues():
+    # event_issues on one road element of length 100 with a tolerance of 0.5: events that touch, overlap or leave a gap
+    # up to the tolerance are not flagged, past it they are. Reversed events are flagged and swept on their measures put
+    # back in order. Each case lists its events as (FROM_MEASURE, TO_MEASURE, STREET_SIDE) and the (ISSUE, QA_FROM, QA_TO,
+    # SIDE) it should flag
+    cases = [('touching', [(0, 50, None), (50, 100, None)], []),
+            ('gap within tolerance', [(0, 50, None), (50.4, 100, None)], []),
+            ('gap of the tolerance', [(0, 50, None), (50.5, 100, None)], []),
+            ('gap past tolerance', [(0, 50, None), (50.6, 100, None)], [('gap', 50, 50.6, None)]),
+            ('overlap within tolerance', [(0, 50.4, None), (50, 100, None)], []),
+            ('overlap of the tolerance', [(0, 50.5, None), (50, 100, None)], []),
+            ('overlap past tolerance', [(0, 51, None), (50, 100, None)], [('overlap', 50, 51, None)]),
+            ('event inside another', [(0, 100, None), (20, 30, None)], [('overlap', 20, 30, None)]),
+            ('same event twice', [(0, 100, None), (0, 100, None)], [('overlap', 0, 100, None)]),
+            ('start gap of the tolerance', [(0.5, 100, None)], []),
+            ('start gap past tolerance', [(0.6, 100, None)], [('gap', 0, 0.6, None)]),
+            ('end gap of the tolerance', [(0, 99.5, None)], []),
+            ('end gap past tolerance', [(0, 99.4, None)], [('gap', 99.4, 100, None)]),
+            ('measures out by the tolerance', [(-0.5, 100.5, None)], []),
+            ('measures out past tolerance', [(-0.6, 100, None)], [('out of range', 0, 100, None)]),
+            ('reversed', [(0, 40, None), (100, 40, None)], [('reversed', 40, 100, None)]),
+            ('reversed within tolerance', [(0, 50, None), (50.4, 50, None), (50, 100, None)], []),
+            ('reversed and overlapping', [(0, 60, None), (100, 50, None)], [('overlap', 50, 60, None), ('reversed', 50, 100, None)]),
+            ('reversed and leaving a gap', [(0, 40, None), (100, 41, None)], [('gap', 40, 41, None), ('reversed', 41, 100, None)]),
+            ('reversed touching the end', [(100, 0, None)], [('reversed', 0, 100, None)]),
+            ('sides covered', [(0, 50, 'Left'), (0, 50, 'Right'), (50, 100, 'Both')], []),
+            ('both sides overlapping the right side', [(0, 100, 'Right'), (50, 100, 'Both')], [('overlap', 50, 100, 'Right'), ('gap', 0, 50, 'Left')]),
+            ('both sides overlapping one side', [(0, 60, 'Both'), (50, 100, 'Left')], [('overlap', 50, 60, 'Left'), ('gap', 60, 100, 'Right')])]
+    for name, events, expected in cases:
+        tbl_df = pd.DataFrame(events, columns=['FROM_MEASURE', 'TO_MEASURE', 'STREET_SIDE']).assign(ORN_ROAD_NET_ELEMENT_ID= 1)
+        issues = event_issues(tbl_df, pd.Series([100.0], index=[1]), tolerance=0.5)
+        found = sorted((issue.ISSUE, round(issue.QA_FROM, 6), round(issue.QA_TO, 6), issue.SIDE) for issue in issues.itertuples())
+        expected = sorted((issue, float(qa_from), float(qa_to), side) for issue, qa_from, qa_to, side in expected)
+        check(f'event_issues {name}', lambda: np.testing.assert_equal(found, expected, f'flagged {found}'))
+    # Tables not meant to cover their elements or with concurrent events have the gap or overlap check switched off
+    tbl_df = pd.DataFrame({'ORN_ROAD_NET_ELEMENT_ID' : 1, 'FROM_MEASURE' : [0.0, 20.0], 'TO_MEASURE' : [30.0, 60.0]})
+    issues = event_issues(tbl_df, pd.Series([100.0], index=[1]), tolerance=0.5, gaps=False, overlaps=False)
+    check('event_issues gaps and overlaps off', lambda: np.testing.assert_equal(list(issues['ISSUE']), []))
+    print(f'Event QA checked on {len(cases) + 1} cases')
+
+def check_street_names():
+    # parse_street_name with the directions of the code tables and the street types of a small ORN_STREET_NAME_PARSED
+    # (Sdrd is only known from the table): French types lead the name, English types end it, directions of one or two words
+    # (hyphenated too) are taken off either end and the body always keeps a word. Each case is the name and its parsed fields
+    # (DIRECTIONAL_PREFIX, STREET_TYPE_PREFIX, STREET_NAME_BODY, STREET_TYPE_SUFFIX, DIRECTIONAL_SUFFIX)
+    parsed_df = pd.DataFrame([['Mill Sdrd', None, None, 'Mill', 'Sdrd', None]], columns=['FULL_STREET_NAME'] + parsed_fields)
+    vocabulary = street_vocabulary(parsed_df, list(code_tables['codes']['direction']))
+    cases = [('Rue Principale Est', (None, 'Rue', 'Principale', None, 'Est')),
+            ('Chemin du Lac Nord-Ouest', (None, 'Chemin', 'du Lac', None, 'Nord Ouest')),
+            ('Rang Saint-Joseph Sud-Est', (None, 'Rang', 'Saint-Joseph', None, 'Sud Est')),
+            ('Boulevard Saint-Laurent', (None, 'Boulevard', 'Saint-Laurent', None, None)),
+            ('Montée Sainte-Julie', (None, 'Montée', 'Sainte-Julie', None, None)),
+            ('Côte des Neiges', (None, 'Côte', 'des Neiges', None, None)),
+            ('Allée des Érables', (None, 'Allée', 'des Érables', None, None)),
+            ('Nord-Est Rue Principale', ('Nord Est', 'Rue', 'Principale', None, None)),
+            ('rue principale ouest', (None, 'Rue', 'principale', None, 'Ouest')),
+            ('King Street West', (None, None, 'King', 'Street', 'West')),
+            ('Yonge Street North East', (None, None, 'Yonge', 'Street', 'North East')),
+            ('North Service Road', ('North', None, 'Service', 'Road', None)),
+            ('South West Queen Elizabeth Way', ('South West', None, 'Queen Elizabeth', 'Way', None)),
+            ('Mill Sdrd', (None, None, 'Mill', 'Sdrd', None)),
+            ('Avenue Road', (None, None, 'Avenue', 'Road', None)),
+            ('North Road', (None, None, 'North', 'Road', None)),
+            ('Avenue Nord', (None, None, 'Avenue', None, 'Nord')),
+            ('Rue', (None, None, 'Rue', None, None)),
+            ('Concession Road 5', (None, None, 'Concession Road 5', None, None))]
+    for name, expected in cases:
+        found = parse_street_name(name, vocabulary)
+        check(f'parse_street_name {name}', lambda: np.testing.assert_equal(found, expected))
+    print(f'Street name parser checked on {len(cases)} names')
+
+#----------------------------------------------------------------------------------------------------------------
+#Inputs
+# python consistency_checks.py
+
+count = 2000 # Road elements of each synthetic dataset
+seeds = [0, 1, 2] # One dataset per seed
+code_tables = load_code_tables(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ORN_code_tables.yaml'))
+quiet = True # Hide the progress messages of the stages while they are checked
+failures = [] # Names of the failed cases
+
+if __name__ == '__main__':
+    check_backends()
+    check_event_issues()
+    check_street_names()
+    if failures:
+        sys.exit(f'{len(failures)} checks failed')
+    print('DONE!')
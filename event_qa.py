@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+
+# Measure checks of the ORN event tables. Every table is sorted once on (element, side, start measure) and swept with
+# running maxima instead of comparing events pair by pair, so a table is checked in O(n log n) whatever the number of
+# events per element. Each issue is one row with the measure span it flags (QA_FROM / QA_TO)
+
+issue_types = ['measure missing', 'road not found', 'reversed', 'out of range', 'overlap', 'gap']
+qa_fields = ['ORN_ROAD_NET_ELEMENT_ID', 'EVENT_ID', 'SIDE', 'FROM_MEASURE', 'TO_MEASURE', 'ISSUE', 'QA_FROM', 'QA_TO']
+
+def event_issues(tbl_df, lengths, tolerance=0.0, gaps=True, overlaps=True):
+    # Returns the issues of an event table (ORN_ROAD_NET_ELEMENT_ID, FROM_MEASURE, TO_MEASURE, optionally EVENT_ID and
+    # STREET_SIDE) against the element lengths (a Series indexed on OGF_ID):
+    # measure missing - FROM_MEASURE or TO_MEASURE is null, road not found - the element isn't in lengths
+    # reversed - FROM_MEASURE > TO_MEASURE, out of range - a measure before 0 or past the element length
+    # overlap - the event starts before an earlier event on the element ends (flags the shared span)
+    # gap - no event covers a stretch of an element that has events (flags the uncovered span)
+    # Events on one side of the road are swept apart from the other side, 'Both' events count on either side. Measures
+    # within tolerance of each other are equal. gaps / overlaps switch those checks off for tables that aren't meant to
+    # cover the elements end to end or that have concurrent events (routes, alternate names)
+    n = len(tbl_df)
+    ids = tbl_df['ORN_ROAD_NET_ELEMENT_ID'].values
+    from_measures = tbl_df['FROM_MEASURE'].to_numpy(dtype=float, na_value=np.nan)
+    to_measures = tbl_df['TO_MEASURE'].to_numpy(dtype=float, na_value=np.nan)
+    event_ids = tbl_df['EVENT_ID'].values if 'EVENT_ID' in tbl_df.columns else np.full(n, None, dtype=object)
+    sides = tbl_df['STREET_SIDE'].values if 'STREET_SIDE' in tbl_df.columns else np.full(n, None, dtype=object)
+    length = lengths.reindex(ids).values.astype(float)
+    found = pd.Series(ids).isin(lengths.index).values
+    missing = np.isnan(from_measures) | np.isnan(to_measures)
+    lo, hi = np.fmin(from_measures, to_measures), np.fmax(from_measures, to_measures)
+    issues = []
+    def add(rows, issue, qa_from, qa_to, side=None):
+        if side is not None:
+            side = np.where(side == '', None, side) # events without a side were swept under ''
+        issues.append([ids[rows], event_ids[rows], sides[rows] if side is None else side, from_measures[rows], to_measures[rows],
+                        np.full(len(rows), issue, dtype=object), np.broadcast_to(qa_from, len(rows)), np.broadcast_to(qa_to, len(rows))])
+    rows = np.flatnonzero(missing & found)
+    add(rows, 'measure missing', 0.0, length[rows])
+    rows = np.flatnonzero(~found)
+    add(rows, 'road not found', np.nan, np.nan)
+    valid = found & ~missing
+    rows = np.flatnonzero(valid & (from_measures > to_measures + tolerance))
+    add(rows, 'reversed', lo[rows], hi[rows])
+    rows = np.flatnonzero(valid & ((lo < -tolerance) | (hi > length + tolerance)))
+    add(rows, 'out of range', np.clip(lo[rows], 0, length[rows]), np.clip(hi[rows], 0, length[rows]))
+
+    if gaps or overlaps:
+        # One sweep per element (and side): reach is the furthest any earlier event on the element got to
+        rows = np.flatnonzero(valid)
+        side_key = pd.Series(sides[rows], dtype=object)
+        left, right = side_key.isin(['Left', 'Both']).values, side_key.isin(['Right', 'Both']).values
+        other = ~left & ~right
+        swept = pd.DataFrame({'row' : np.concatenate([rows[left], rows[right], rows[other]]),
+                            'side' : np.concatenate([np.full(left.sum(), 'Left', dtype=object), np.full(right.sum(), 'Right', dtype=object),
+                                                    side_key.fillna('').astype(str).values[other]])})
+        swept['id'], swept['lo'], swept['hi'] = ids[swept['row']], lo[swept['row']], hi[swept['row']]
+        id_code, side_code = pd.factorize(swept['id'], sort=True)[0], pd.factorize(swept['side'], sort=True)[0]
+        order = np.lexsort((swept['hi'].values, swept['lo'].values, side_code, id_code))
+        swept = swept.iloc[order].reset_index(drop=True)
+        key = id_code[order] * (side_code.max() + 1 if len(side_code) else 1) + side_code[order]
+        first, last = np.ones(len(key), dtype=bool), np.ones(len(key), dtype=bool)
+        first[1:] = last[:-1] = key[1:] != key[:-1]
+        group = np.cumsum(first)
+        reach = swept['hi'].groupby(group).cummax().values
+        before = np.where(first, 0.0, np.r_[0.0, reach[:-1]]) # where the events before each event reach, the element start for the first
+        row, side = swept['row'].values, swept['side'].values
+        if overlaps:
+            hit = ~first & (swept['lo'].values < before - tolerance)
+            add(row[hit], 'overlap', swept['lo'].values[hit], np.minimum(swept['hi'].values[hit], before[hit]), side[hit])
+        if gaps:
+            hit = swept['lo'].values > before + tolerance
+            add(row[hit], 'gap', before[hit], swept['lo'].values[hit], side[hit])
+            # Gaps left at the end of the element are flagged on the event reaching furthest
+            end_length = length[row]
+            hit = last & (reach < end_length - tolerance)
+            add(row[hit], 'gap', reach[hit], end_length[hit], side[hit])
+    issues = pd.DataFrame({field : np.concatenate([issue[i] for issue in issues]) for i, field in enumerate(qa_fields)})
+    order = np.lexsort((issues['QA_FROM'].values, pd.factorize(issues['ORN_ROAD_NET_ELEMENT_ID'], sort=True)[0]))
+    return issues.iloc[order].reset_index(drop=True)
+
+def check_tables(read, tables, lengths, tolerance=0.0, gaps_allowed=(), overlaps_allowed=()):
+    # Checks every event table with measures, read(table) returns the ORN_ROAD_NET_ELEMENT_ID, EVENT_ID, FROM_MEASURE,
+    # TO_MEASURE (and STREET_SIDE) of a table or None to skip it. Returns all the issues with their TABLE and the per table
+    # report: events checked, elements with issues and the count of each issue type
+    flagged, report = [], []
+    for table in tables:
+        tbl_df = read(table)
+        if tbl_df is None:
+            continue
+        issues = event_issues(tbl_df, lengths, tolerance, gaps= table not in gaps_allowed, overlaps= table not in overlaps_allowed)
+        issues.insert(0, 'TABLE', table)
+        counts = issues['ISSUE'].value_counts()
+        report.append(dict({'TABLE' : table, 'EVENTS' : len(tbl_df), 'ELEMENTS_FLAGGED' : issues['ORN_ROAD_NET_ELEMENT_ID'].nunique()},
+                        **{issue : int(counts.get(issue, 0)) for issue in issue_types}))
+        print(f'{table}: ' + ', '.join(f'{counts[issue]} {issue}' for issue in issue_types if issue in counts) if len(counts) else f'{table}: no issues')
+        flagged.append(issues)
+    flagged = pd.concat(flagged, ignore_index=True) if flagged else pd.DataFrame(columns=['TABLE'] + qa_fields)
+    return flagged, pd.DataFrame(report, columns=['TABLE', 'EVENTS', 'ELEMENTS_FLAGGED'] + issue_types)
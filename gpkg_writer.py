@@ -0,0 +1,91 @@
+import os, sqlite3
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import shapely
+
+# Bulk writer for the delivered GeoPackages. Every write is one Arrow batch write (a single transaction) with the SQLite
+# pragmas relaxed for the load, layers are created without a spatial index and each layer's R-tree is built once from the
+# bounds of everything written to it when the writer closes. A GeoParquet copy of every layer can be written alongside
+
+load_options = {'OGR_SQLITE_SYNCHRONOUS' : 'OFF', 'OGR_SQLITE_CACHE' : '512', 'OGR_SQLITE_PRAGMA' : 'journal_mode=MEMORY'}
+
+# The R-tree triggers GDAL creates with a spatial index, so later edits through GDAL (upserts) keep the index up to date
+rtree_triggers = [
+    'CREATE TRIGGER "{rtree}_insert" AFTER INSERT ON "{table}" WHEN (new."{geom}" NOT NULL AND NOT ST_IsEmpty(NEW."{geom}")) '
+    'BEGIN INSERT OR REPLACE INTO "{rtree}" VALUES (NEW."{fid}",ST_MinX(NEW."{geom}"), ST_MaxX(NEW."{geom}"),ST_MinY(NEW."{geom}"), ST_MaxY(NEW."{geom}")); END',
+    'CREATE TRIGGER "{rtree}_update6" AFTER UPDATE OF "{geom}" ON "{table}" WHEN OLD."{fid}" = NEW."{fid}" AND (NEW."{geom}" NOTNULL AND NOT ST_IsEmpty(NEW."{geom}")) '
+    'AND (OLD."{geom}" NOTNULL AND NOT ST_IsEmpty(OLD."{geom}")) BEGIN UPDATE "{rtree}" SET minx = ST_MinX(NEW."{geom}"), maxx = ST_MaxX(NEW."{geom}"),'
+    'miny = ST_MinY(NEW."{geom}"), maxy = ST_MaxY(NEW."{geom}") WHERE id = NEW."{fid}";END',
+    'CREATE TRIGGER "{rtree}_update7" AFTER UPDATE OF "{geom}" ON "{table}" WHEN OLD."{fid}" = NEW."{fid}" AND (NEW."{geom}" NOTNULL AND NOT ST_IsEmpty(NEW."{geom}")) '
+    'AND (OLD."{geom}" ISNULL OR ST_IsEmpty(OLD."{geom}")) BEGIN INSERT INTO "{rtree}" VALUES (NEW."{fid}",ST_MinX(NEW."{geom}"), ST_MaxX(NEW."{geom}"),'
+    'ST_MinY(NEW."{geom}"), ST_MaxY(NEW."{geom}")); END',
+    'CREATE TRIGGER "{rtree}_update2" AFTER UPDATE OF "{geom}" ON "{table}" WHEN OLD."{fid}" = NEW."{fid}" AND (NEW."{geom}" ISNULL OR ST_IsEmpty(NEW."{geom}")) '
+    'BEGIN DELETE FROM "{rtree}" WHERE id = OLD."{fid}"; END',
+    'CREATE TRIGGER "{rtree}_update5" AFTER UPDATE ON "{table}" WHEN OLD."{fid}" != NEW."{fid}" AND (NEW."{geom}" NOTNULL AND NOT ST_IsEmpty(NEW."{geom}")) '
+    'BEGIN DELETE FROM "{rtree}" WHERE id = OLD."{fid}"; INSERT OR REPLACE INTO "{rtree}" VALUES (NEW."{fid}",ST_MinX(NEW."{geom}"), ST_MaxX(NEW."{geom}"),'
+    'ST_MinY(NEW."{geom}"), ST_MaxY(NEW."{geom}")); END',
+    'CREATE TRIGGER "{rtree}_update4" AFTER UPDATE ON "{table}" WHEN OLD."{fid}" != NEW."{fid}" AND (NEW."{geom}" ISNULL OR ST_IsEmpty(NEW."{geom}")) '
+    'BEGIN DELETE FROM "{rtree}" WHERE id IN (OLD."{fid}", NEW."{fid}"); END',
+    'CREATE TRIGGER "{rtree}_delete" AFTER DELETE ON "{table}" WHEN old."{geom}" NOT NULL BEGIN DELETE FROM "{rtree}" WHERE id = OLD."{fid}"; END']
+
+class GpkgWriter:
+    # Writes layers into the GeoPackage at path. The first write of a layer replaces it, later writes (chunks) append, and
+    # append=True appends to a layer that is already in the file (and already indexed). Call close() once everything is
+    # written to build the R-trees, the layers have no spatial index until then
+    def __init__(self, path, parquet_dir=None, use_arrow=True):
+        self.path = path
+        self.parquet_dir = parquet_dir
+        self.use_arrow = use_arrow
+        self.bounds = {} # layer: bounds of every row written to the layers created by this writer, in write order
+        self.parts = {} # layer: GeoParquet parts written
+        pyogrio.set_gdal_config_options(load_options)
+
+    def write(self, df, layer, append=False):
+        spatial = isinstance(df, gpd.GeoDataFrame)
+        if layer in self.bounds or append:
+            # Appended fields are matched by position, so put the columns in the layer's field order
+            fields = list(pyogrio.read_info(self.path, layer=layer)['fields'])
+            df = df[fields + ([df.geometry.name] if spatial else [])]
+            pyogrio.write_dataframe(df, self.path, layer=layer, driver='GPKG', append=True, use_arrow=self.use_arrow)
+        else:
+            pyogrio.write_dataframe(df, self.path, layer=layer, driver='GPKG', use_arrow=self.use_arrow, SPATIAL_INDEX='NO')
+            self.bounds[layer] = [] if spatial else None
+        if self.bounds.get(layer) is not None:
+            self.bounds[layer].append(shapely.bounds(df.geometry.values))
+        if self.parquet_dir is not None:
+            # Columns with no values in this part would be typed null and clash with the string parts of the same layer
+            empty = [field for field in df.columns if df[field].dtype == object and df[field].isna().all()]
+            df = df.astype({field : 'string' for field in empty})
+            part = self.parts.get(layer, 0)
+            os.makedirs(os.path.join(self.parquet_dir, layer), exist_ok=True)
+            df.to_parquet(os.path.join(self.parquet_dir, layer, f'part-{part:05d}.parquet'), index=False)
+            self.parts[layer] = part + 1
+
+    def close(self):
+        # Builds the R-tree of every spatial layer this writer created, in one transaction per layer
+        for layer, bounds in self.bounds.items():
+            if bounds is None:
+                continue
+            info = pyogrio.read_info(self.path, layer=layer)
+            bounds = np.concatenate(bounds) if bounds else np.empty((0, 4))
+            names = {'table' : layer, 'geom' : info['geometry_name'], 'fid' : info['fid_column'] or 'fid', 'rtree' : f'rtree_{layer}_{info["geometry_name"]}'}
+            con = sqlite3.connect(self.path)
+            with con:
+                con.execute('PRAGMA synchronous = OFF')
+                fids = np.array([row[0] for row in con.execute(f'SELECT "{names["fid"]}" FROM "{layer}" ORDER BY "{names["fid"]}"')], dtype=np.int64)
+                indexed = ~np.isnan(bounds).any(axis=1) # null and empty geometries are left out, as GDAL does
+                con.execute(f'CREATE VIRTUAL TABLE "{names["rtree"]}" USING rtree(id, minx, maxx, miny, maxy)')
+                con.executemany(f'INSERT INTO "{names["rtree"]}" VALUES (?, ?, ?, ?, ?)',
+                                zip(fids[indexed].tolist(), bounds[indexed, 0].tolist(), bounds[indexed, 2].tolist(),
+                                    bounds[indexed, 1].tolist(), bounds[indexed, 3].tolist()))
+                con.execute('CREATE TABLE IF NOT EXISTS gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, '
+                            'definition TEXT NOT NULL, scope TEXT NOT NULL, CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))')
+                con.execute('INSERT INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)', (layer, names['geom'], 'gpkg_rtree_index',
+                            'http://www.geopackage.org/spec120/#extension_rtree', 'write-only'))
+                for trigger in rtree_triggers:
+                    con.execute(trigger.format(**names))
+            con.close()
+            print(f'Spatial index built for {layer} ({indexed.sum()} features)')
+        self.bounds = {}
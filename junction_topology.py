@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+# Junction topology of the road elements from their FROM_JUNCTION_ID / TO_JUNCTION_ID. The graph is held as flat arrays in
+# CSR form: junctions are numbered 0..n-1 in JUNCTION_ID order and the roads meeting at junction i are
+# incident[indptr[i]:indptr[i + 1]] (road positions), so a province takes a few int32 arrays instead of a dict or graph
+# object per junction. Junction types follow the NRN junction types derived from the number of roads meeting there
+
+junction_type_names = {1 : 'Dead End', 3 : 'Intersection'} # degree: junction type, 3 stands for 3 or more
+
+class JunctionGraph:
+    # Builds the CSR adjacency of the road elements in one pass. Missing junction ids (null or 0) leave that end of the
+    # road unconnected. A road starting and ending at the same junction counts twice at it
+    def __init__(self, ogf_ids, from_junctions, to_junctions):
+        self.ogf_ids = np.asarray(ogf_ids)
+        ends = pd.to_numeric(pd.Series(np.concatenate([from_junctions, to_junctions])), errors='coerce').values
+        connected = ~np.isnan(ends) & (ends != 0)
+        self.junction_ids, node = np.unique(ends[connected].astype(np.int64), return_inverse=True)
+        road = np.tile(np.arange(len(self.ogf_ids), dtype=np.int32), 2)[connected]
+        end_node = np.full(len(ends), -1, dtype=np.int32)
+        end_node[connected] = node
+        self.from_node, self.to_node = end_node[:len(self.ogf_ids)], end_node[len(self.ogf_ids):]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(node, minlength=len(self.junction_ids)))]).astype(np.int64)
+        self.incident = road[np.argsort(node, kind='stable')]
+
+    def degree(self):
+        # Returns the number of road ends at each junction
+        return np.diff(self.indptr)
+
+    def roads_at(self, junction_id):
+        # Returns the OGF_IDs of the roads meeting at a junction
+        i = np.searchsorted(self.junction_ids, junction_id)
+        if i == len(self.junction_ids) or self.junction_ids[i] != junction_id:
+            return self.ogf_ids[:0]
+        return self.ogf_ids[self.incident[self.indptr[i]:self.indptr[i + 1]]]
+
+    def junction_labels(self):
+        # Returns a connected component label per junction (the lowest junction number in the component). Every pass hooks
+        # the root of each road's ends onto the lower of the two roots and then compresses the label chains, so the number
+        # of passes grows with the log of the component diameter rather than with its size
+        labels = np.arange(len(self.junction_ids), dtype=np.int64)
+        both = (self.from_node >= 0) & (self.to_node >= 0)
+        u, v = self.from_node[both], self.to_node[both]
+        while True:
+            root_u, root_v = labels[u], labels[v]
+            if (root_u == root_v).all():
+                return labels
+            low = np.minimum(root_u, root_v)
+            np.minimum.at(labels, root_u, low)
+            np.minimum.at(labels, root_v, low)
+            jumped = labels[labels]
+            while (jumped != labels).any():
+                labels = jumped
+                jumped = labels[labels]
+
+    def components(self):
+        # Returns the component of every junction and of every road, numbered from 1 by number of roads (1 is the largest
+        # network). Roads with no junction at either end are a component of their own
+        labels = self.junction_labels()
+        road_node = np.where(self.from_node >= 0, self.from_node, self.to_node)
+        road_label = np.where(road_node >= 0, labels[np.maximum(road_node, 0)], len(labels) + np.arange(len(road_node)))
+        keys, road_component, sizes = np.unique(road_label, return_inverse=True, return_counts=True)
+        rank = np.empty(len(keys), dtype=np.int64)
+        rank[np.argsort(-sizes, kind='stable')] = np.arange(1, len(keys) + 1)
+        junction_component = rank[np.searchsorted(keys, labels)]
+        return junction_component, rank[road_component]
+
+    def junction_types(self, ferry_roads=None):
+        # Returns the NRN junction type of every junction: Dead End where one road ends, Intersection where three or more
+        # meet and Ferry where a ferry connection meets a road. Junctions joining two roads only split a road and get no type
+        degree = self.degree()
+        types = np.full(len(degree), None, dtype=object)
+        types[degree == 1] = junction_type_names[1]
+        types[degree >= 3] = junction_type_names[3]
+        if ferry_roads is not None:
+            ferry = np.asarray(ferry_roads, dtype=bool)[self.incident]
+            ferry_ends = np.add.reduceat(ferry, self.indptr[:-1]) if len(ferry) else np.zeros(len(degree), dtype=np.int64)
+            types[(ferry_ends > 0) & (ferry_ends < degree)] = 'Ferry'
+        return types
+
+def topology_report(graph, road_component):
+    # Prints the connectivity checks and returns their counts: dangles (junctions where a single road ends), the number of
+    # disconnected networks and the roads that are not on the largest one
+    dangles = int((graph.degree() == 1).sum())
+    components = int(road_component.max()) if len(road_component) else 0
+    off_network = int((road_component > 1).sum())
+    unconnected = int(((graph.from_node < 0) | (graph.to_node < 0)).sum())
+    print(f'{len(graph.junction_ids)} junctions, {dangles} dangles, {components} connected networks, '
+            f'{off_network} roads off the largest network, {unconnected} roads missing a junction id')
+    return {'dangles' : dangles, 'components' : components, 'off_network' : off_network, 'unconnected' : unconnected}
+
+def junction_layer(graph, points_df, road_element_types=None):
+    # Returns the junction points (JUNCTION_ID plus geometry, from ORN_JUNCTION) of every junction a road ends at, with its
+    # NRN JUNCTION_TYPE, DEGREE and connected network (COMPONENT). Junction ids the roads refer to that have no point are
+    # reported and left out. Ferry junctions are found from the road ROAD_ELEMENT_TYPEs when they are given
+    ferry_roads = None
+    if road_element_types is not None:
+        ferry_roads = pd.Series(road_element_types).astype(str).str.upper().str.replace(' ', '_').values == 'FERRY_CONNECTION'
+    junction_component, road_component = graph.components()
+    junctions_df = pd.DataFrame({'JUNCTION_ID' : graph.junction_ids, 'JUNCTION_TYPE' : graph.junction_types(ferry_roads),
+                                'DEGREE' : graph.degree().astype(np.int32), 'COMPONENT' : junction_component.astype(np.int32)})
+    points_df = points_df.drop_duplicates(subset=['JUNCTION_ID'])
+    layer_df = points_df.merge(junctions_df, how='inner', on='JUNCTION_ID')
+    missing = len(junctions_df) - len(layer_df)
+    if missing:
+        print(f'{missing} junction ids on the roads have no ORN_JUNCTION point and are left out')
+    return layer_df, road_component
@@ -0,0 +1,84 @@
+import os, shutil, time, hashlib, threading
+import importlib.util
+import pandas as pd
+
+# On disk Parquet copies of File Geodatabase layers shared by to_segments.py and to_segments_gpd.py
+# Each gdb gets a cache folder named after its path and a fingerprint of its files, so editing or replacing the gdb starts a
+# new cache and the folders of its older fingerprints are removed. Gdbs of the same name in other folders keep their own
+
+def gdb_fingerprint(gdb):
+    # Returns a short hash of the names, sizes and modification times of the files making up a gdb
+    fingerprint = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(gdb)):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            fingerprint.update(f'{os.path.relpath(os.path.join(root, name), gdb)}|{stat.st_size}|{stat.st_mtime_ns};'.encode())
+    return fingerprint.hexdigest()[:16]
+
+def apply_filters(df, filters):
+    # Applies (column, op, value) filters written for pyarrow to an in memory dataframe
+    ops = {'>=' : 'ge', '<=' : 'le', '>' : 'gt', '<' : 'lt', '==' : 'eq', '!=' : 'ne'}
+    for column, op, value in filters or []:
+        df = df[df[column].isin(value)] if op == 'in' else df[getattr(df[column], ops[op])(value)]
+    return df
+
+class LayerCache:
+    # Parquet (GeoParquet for layers with geometry) cache of gdb layers with cold / warm load timings
+    # backend separates the copies made by the arcpy and geopandas readers since their dtypes differ
+    def __init__(self, cache_dir, backend):
+        self.cache_dir = cache_dir
+        self.backend = backend
+        self.folders = {}
+        self.timings = []
+        self.enabled = importlib.util.find_spec('pyarrow') is not None
+        if not self.enabled:
+            print('pyarrow is not installed, layers will be read from the gdb without caching')
+
+    def folder(self, gdb):
+        # Returns the cache folder for the current state of a gdb, removing folders left by older states
+        if gdb not in self.folders:
+            name = os.path.basename(os.path.normpath(gdb))
+            name = f'{name}_{hashlib.sha1(os.path.abspath(gdb).encode()).hexdigest()[:8]}'
+            folder = os.path.join(self.cache_dir, f'{name}_{gdb_fingerprint(gdb)}')
+            if os.path.isdir(self.cache_dir):
+                for old in os.listdir(self.cache_dir):
+                    if old.startswith(name + '_') and old != os.path.basename(folder):
+                        print(f'Removing stale layer cache {old}')
+                        shutil.rmtree(os.path.join(self.cache_dir, old), ignore_errors=True)
+            os.makedirs(folder, exist_ok=True)
+            self.folders[gdb] = folder
+        return self.folders[gdb]
+
+    def read(self, gdb, layer, load, columns=None, filters=None, geometry=False):
+        # Returns a layer from the cache, calling load() to read it from the gdb and fill the cache on a miss
+        # columns is the column list load() reads and is part of the cache key, filters are (column, op, value) tuples
+        if not self.enabled:
+            return apply_filters(load(), filters)
+        key = hashlib.sha1(repr(columns).encode()).hexdigest()[:8]
+        path = os.path.join(self.folder(gdb), f'{self.backend}_{layer}_{key}.parquet')
+        start = time.perf_counter()
+        if os.path.exists(path):
+            state = 'warm'
+            if geometry:
+                import geopandas as gpd
+                df = gpd.read_parquet(path, filters=filters)
+            else:
+                df = pd.read_parquet(path, filters=filters)
+        else:
+            state = 'cold'
+            df = load()
+            temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp' # written aside then renamed so parallel workers (and prefetch threads) never read a partial file
+            df.to_parquet(temp_path, index=False)
+            os.replace(temp_path, path)
+            df = apply_filters(df, filters)
+        seconds = time.perf_counter() - start
+        self.timings.append((layer, state, seconds))
+        print(f'{layer}: {state} load in {seconds:.2f}s')
+        return df
+
+    def report(self):
+        # Prints the total cold and warm load times of the layers read through this cache
+        for state in ['cold', 'warm']:
+            loads = [seconds for layer, load_state, seconds in self.timings if load_state == state]
+            if loads:
+                print(f'Layer cache: {len(loads)} {state} loads in {sum(loads):.2f}s')
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+# Linear referencing on plain vertex arrays, shared by to_segments.py (vertices from arcpy.da) and to_segments_gpd.py (vertices
+# from shapely). Routes are the road elements: the vertices of a route are consecutive and in digitized order, and measures are
+# taken along the route's LENGTH field
+
+def segment_lengths(coords, vertex_part, geographic):
+    # Returns the length of the segment ending at each vertex, 0 for the first vertex of every part so that the jump between
+    # the parts of a multi part route adds nothing. Geographic coordinates give metres (equirectangular), others map units
+    step = np.diff(coords, axis=0)
+    if geographic:
+        step[:, 0] *= np.cos(np.radians((coords[1:, 1] + coords[:-1, 1]) / 2))
+        step *= 111320
+    lengths = np.hypot(step[:, 0], step[:, 1])
+    lengths[vertex_part[1:] != vertex_part[:-1]] = 0
+    return np.concatenate([[0.0], lengths])
+
+def locate_measures(vertex_route, vertex_part, coords, route_lengths, event_routes, at_measures, geographic, tolerance=0.0):
+    # Returns the x, y of every event AT_MEASURE along its route and an lrs_err message per event ('' when it was located)
+    # The measure is turned into a fraction of the route LENGTH (route_lengths, a Series indexed on route id) and the point is
+    # interpolated at that fraction of the route geometry, all events in one pass. Measures up to tolerance past either end
+    # are snapped to the end. Events that can't be located get NaN coordinates
+    vertex_route = np.asarray(vertex_route)
+    at_measures = np.asarray(at_measures, dtype=float)
+    distance = pd.Series(segment_lengths(coords, np.asarray(vertex_part), geographic)).groupby(vertex_route, sort=False).cumsum().values
+    starts = np.flatnonzero(np.concatenate([[True], vertex_route[1:] != vertex_route[:-1]])) if len(vertex_route) else np.array([], dtype=int)
+    ends = np.append(starts[1:], len(vertex_route)) - 1
+    route = pd.Index(vertex_route[starts]).get_indexer(np.asarray(event_routes))
+    found = route >= 0
+    route = np.where(found, route, 0)
+    length = pd.Series(route_lengths).reindex(np.asarray(event_routes)).values.astype(float)
+    geometry_length = distance[ends[route]] if len(starts) else np.zeros(len(route))
+    lrs_err = np.full(len(route), '', dtype=object)
+    lrs_err[np.isnan(at_measures)] = 'measure missing'
+    lrs_err[(at_measures < -tolerance) | (at_measures > length + tolerance)] = 'measure out of range'
+    lrs_err[~(length > 0) | ~(geometry_length > 0)] = 'road has no length'
+    lrs_err[~found] = 'road not found'
+    located = lrs_err == ''
+    # Search every route at once with each route laid 1 past the end of the one before
+    route_start = np.cumsum(distance[ends] + 1) - (distance[ends] + 1) if len(starts) else np.array([])
+    key = distance + np.repeat(route_start, ends - starts + 1) if len(starts) else distance
+    target = np.clip(at_measures / np.where(length > 0, length, 1), 0, 1) * geometry_length
+    xy = np.full((len(route), 2), np.nan)
+    if located.any():
+        r, at = route[located], target[located]
+        i = np.clip(np.searchsorted(key, route_start[r] + at, 'left'), starts[r] + 1, ends[r])
+        span = distance[i] - distance[i - 1]
+        t = np.where(span > 0, (at - distance[i - 1]) / np.where(span > 0, span, 1), 0)[:, None]
+        xy[located] = coords[i - 1] + t * (coords[i] - coords[i - 1])
+    return xy, lrs_err
+
+def lrs_report(lrs_err, layer):
+    # Prints how many events of a layer were located and the count of each lrs_err
+    counts = pd.Series(lrs_err).value_counts()
+    print(f'{layer}: {counts.get("", 0)} of {len(lrs_err)} events located' +
+        ''.join(f', {count} {error}' for error, count in counts.items() if error != ''))
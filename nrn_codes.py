@@ -0,0 +1,53 @@
+import fnmatch
+import numpy as np
+import pandas as pd
+
+# NRN code tables for the string fields of the delivered layers, read from ORN_code_tables.yaml. Code fields are nullable
+# Int8 / Int16 columns (null where the string is missing or has no code) and repeated strings are kept as categoricals
+
+def load_code_tables(path):
+    # Returns the code table config: codes (table name: {string: code}), encode and categories (per layer)
+    import yaml
+    with open(path) as config:
+        return yaml.safe_load(config)
+
+def code_values(values, table):
+    # Returns the codes of a column of strings as a nullable Int8 (Int16 when a code doesn't fit) array and the strings that
+    # have no code in the table, with their counts
+    strings = list(table)
+    codes = np.array([table[string] for string in strings])
+    position = pd.Index(strings).get_indexer(pd.Series(values).astype(object).values)
+    dtype = 'Int8' if codes.min() >= -128 and codes.max() <= 127 else 'Int16'
+    coded = pd.array(np.where(position >= 0, codes[np.maximum(position, 0)], 0), dtype=dtype)
+    coded[position < 0] = pd.NA
+    values = pd.Series(values)
+    unmapped = values[(position < 0) & values.notna().values].value_counts()
+    return coded, unmapped
+
+def encode_layer(df, layer, code_tables, categorize=True):
+    # Adds the code fields of a layer (in place), each right after its string field, and turns the layer's categories fields into
+    # categoricals. Returns the unmapped value counts per code field, for the fields that had any
+    # A string field split over several code fields (SURFACE_TYPE into PAVED_ / UNPAVED_SURFACE_TYPE_CDE) only reports the
+    # strings none of its tables code
+    unmapped = {}
+    encode = code_tables['encode'].get(layer) or {}
+    for code_field, (field, table) in encode.items():
+        coded, missing = code_values(df[field], code_tables['codes'][table])
+        df.insert(df.columns.get_loc(field) + 1, code_field, coded)
+        coded_elsewhere = set().union(*[code_tables['codes'][other] for other_field, (source, other) in encode.items() if source == field])
+        missing = missing[~missing.index.isin(coded_elsewhere)]
+        if len(missing):
+            unmapped[code_field] = missing
+    if categorize:
+        patterns = code_tables['categories'].get(layer) or []
+        for field in df.columns:
+            if df[field].dtype == object and any(fnmatch.fnmatchcase(field, pattern) for pattern in patterns):
+                df[field] = df[field].astype('category')
+    return unmapped
+
+def unmapped_report(unmapped, layer):
+    # Prints the strings that got no code, per code field
+    for code_field, counts in unmapped.items():
+        values = ', '.join(f'{value!r} ({count})' for value, count in counts.head(5).items())
+        more = f' and {len(counts) - 5} more' if len(counts) > 5 else ''
+        print(f'{layer}.{code_field}: {counts.sum()} values without a code: {values}{more}')
@@ -0,0 +1,73 @@
+import re
+import numpy as np
+import pandas as pd
+
+# Builds the NRN products described by the YAML configs (ORN_field_map.yaml, ORN_ferry_segs.yaml, ORN_Toll_Booths.yaml,
+# ORN_Blocked_Passages.yaml) straight from the layers in memory: each config's query becomes a row mask over its source layer
+# and every conform table is projected and renamed into its NRN schema, so the delivered layers are never read back
+
+nrn_spatial_tables = {'roadseg', 'ferryseg', 'junction', 'tollpoint', 'blkpassage'} # NRN tables with geometry, the rest are attribute tables
+query_pattern = re.compile(r'^\s*"\s*(\w+)\s*"\s*(=|<>|!=|>=|<=|>|<)\s*(.+?)\s*$')
+
+def load_products(yaml_paths):
+    # Returns one product per conform table of every config: its config file, source layer, query, NRN table and field mapping
+    import yaml
+    products = []
+    for path in yaml_paths:
+        with open(path) as config_file:
+            config = yaml.safe_load(config_file)
+        for table, mapping in (config.get('conform') or {}).items():
+            products.append({'config' : path, 'layer' : config['data']['layer'], 'query' : config['data'].get('query'),
+                            'spatial' : config['data'].get('spatial', True), 'table' : table, 'mapping' : mapping or {}})
+    return products
+
+def query_mask(df, query):
+    # Evaluates a config query ("FIELD" op value) as a boolean mask over df. Strings are compared with case and the
+    # spaces / underscores ignored so that FERRY_CONNECTION matches 'FERRY CONNECTION', missing values never match
+    if not query:
+        return np.ones(len(df), dtype=bool)
+    match = query_pattern.match(query)
+    if match is None:
+        raise ValueError(f'Unsupported query: {query}')
+    field, op, value = match.groups()
+    column = df[field]
+    value = value.strip('\'"')
+    try:
+        value = float(value)
+        column = pd.to_numeric(column, errors='coerce')
+    except ValueError:
+        column = column.astype(object).where(column.notna(), None).map(lambda text: None if text is None else str(text).upper().replace(' ', '_'))
+        value = value.upper().replace(' ', '_')
+    compare = {'=' : column.eq, '<>' : column.ne, '!=' : column.ne, '>=' : column.ge, '<=' : column.le, '>' : column.gt, '<' : column.lt}[op]
+    return (compare(value) & column.notna()).fillna(False).values.astype(bool)
+
+def conform_product(df, product, geometry_field=None):
+    # Returns the rows of df matching the product query with the columns of its NRN table, in mapping order. A mapping value
+    # naming a field of df copies that field, an UPPER_CASE value that isn't a field is reported and left null and any other
+    # value is a constant. geometry_field is carried over for spatial NRN tables. Products mapping no field at all are
+    # reported and return None, rather than a table of nulls (or geometry only)
+    if all(source is None for source in product['mapping'].values()):
+        print(f'{product["config"]} {product["table"]}: no field is mapped, not exported')
+        return None
+    rows = df[query_mask(df, product['query'])]
+    columns, missing = {}, []
+    for nrn_field, source in product['mapping'].items():
+        if source is None:
+            columns[nrn_field] = pd.Series(None, index=rows.index, dtype=object)
+        elif isinstance(source, str) and source in rows.columns:
+            columns[nrn_field] = rows[source]
+        elif isinstance(source, str) and re.fullmatch(r'[A-Z0-9_]+', source):
+            missing.append(source)
+            columns[nrn_field] = pd.Series(None, index=rows.index, dtype=object)
+        else:
+            columns[nrn_field] = pd.Series(source, index=rows.index)
+    if missing:
+        print(f'{product["config"]} {product["table"]}: fields not in {product["layer"]}, left null: {", ".join(missing)}')
+    conformed = pd.DataFrame(columns, index=rows.index)
+    if geometry_field is not None and product['spatial'] and product['table'] in nrn_spatial_tables:
+        conformed[geometry_field] = rows[geometry_field]
+    return conformed.reset_index(drop=True)
+
+def products_for(products, layer):
+    # Returns the products built from a source layer, layer names are matched ignoring case (ORN_Toll_Booths is ORN_toll_booths)
+    return [product for product in products if product['layer'].lower() == layer.lower()]
@@ -0,0 +1,66 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Reads ahead the tables a stage loop is about to ask for, in a thread pool, while the loop resolves and joins the current one
+# The GDAL decode (pyogrio) and the Parquet reads of the layer cache (pyarrow) release the GIL, so the reads overlap the
+# pandas work instead of taking turns with it. At most depth reads are in flight or waiting to be taken, which caps the
+# memory held by tables read ahead at depth tables
+
+class Prefetcher:
+    # Calls read(key) for every key of keys, in order and depth keys ahead of the one the loop is taking with get()
+    # Keys taken out of order, or never listed, are read on the spot. Use it in a with block so the pool is shut down
+    def __init__(self, read, keys, depth=2):
+        self.read = read
+        self.depth = depth
+        self.pending = list(keys)
+        self.futures = {}
+        self.pool = ThreadPoolExecutor(max_workers= max(depth, 1), thread_name_prefix='prefetch')
+        self.reads, self.read_seconds, self.wait_seconds = 0, 0.0, 0.0
+        self.fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def timed_read(self, key):
+        start = time.perf_counter()
+        result = self.read(key)
+        return result, time.perf_counter() - start
+
+    def fill(self):
+        # Starts the reads of the next pending keys until depth reads are in flight or waiting
+        while self.pending and len(self.futures) < self.depth:
+            key = self.pending.pop(0)
+            self.futures[key] = self.pool.submit(self.timed_read, key)
+
+    def get(self, key):
+        # Returns read(key), waiting for its read ahead when it was started. The time spent waiting here is the I/O the
+        # loop still sees, the rest of the read time was hidden behind the loop's own work
+        start = time.perf_counter()
+        future = self.futures.pop(key, None)
+        if future is None:
+            if key in self.pending:
+                self.pending.remove(key)
+            result, seconds = self.timed_read(key)
+        else:
+            result, seconds = future.result()
+        self.reads += 1
+        self.read_seconds += seconds
+        self.wait_seconds += time.perf_counter() - start
+        self.fill()
+        return result
+
+    def hidden_seconds(self):
+        # Returns the read time the loop didn't wait for. The reads only run alongside the loop on a spare core or while one
+        # of them waits on the disk, on a single busy core they stretch as they share it and this overstates the saving
+        return max(self.read_seconds - self.wait_seconds, 0.0)
+
+    def close(self):
+        # Drops the reads ahead that were never taken (a stage failed or was resumed) and shuts the pool down
+        self.pending = []
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+        self.pool.shutdown(wait=True)
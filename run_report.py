@@ -0,0 +1,91 @@
+import os, sys, json, time
+import contextlib
+from datetime import datetime
+
+# Stage level telemetry for the segmentation scripts: wall time, peak memory and row counts of every named stage, written out
+# as a JSON run report at the end of a run
+
+def peak_rss_mb():
+    # Returns the peak resident set size of this process so far in MB, None when the platform doesn't expose it
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1) # bytes on macOS, KB elsewhere
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / 1024 / 1024, 1) # Windows
+    except (ImportError, AttributeError):
+        return None
+
+class RunReport:
+    # Collects one record per stage run. Stages nest and are named by their path (partition/events/ORN_ROAD_CLASS), a stage
+    # that runs more than once (per partition or chunk) gets a record per run and a line in the summary adding them up
+    def __init__(self):
+        self.run_date = datetime.now().isoformat(timespec='seconds')
+        self.started = time.perf_counter()
+        self.stages = []
+        self.open = []
+
+    def path(self):
+        # Returns the path of the innermost open stage as a list, empty outside every stage
+        return [self.open[-1]['stage']] if self.open else []
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None, one_to_one=False, **info):
+        # Times the with block and yields its record, the stage sets rows_out (and any other counts) on the record
+        # one_to_one stages are joins that should return one row per input row, anything more is reported as fan out
+        record = dict(stage= '/'.join(self.path() + [name]), rows_in= rows_in, **info)
+        self.open.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.open.pop()
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            record['peak_rss_mb'] = peak_rss_mb()
+            self.stages.append(record)
+        if one_to_one and record.get('rows_out') is not None and record['rows_out'] != rows_in:
+            record['fan_out'] = record['rows_out'] - rows_in
+            print(f'WARNING: {record["stage"]} turned {rows_in} rows into {record["rows_out"]}')
+
+    def count(self, key, value):
+        # Adds value to a count on the innermost open stage, used by helpers that don't hold the stage record
+        if self.open:
+            self.open[-1][key] = self.open[-1].get(key, 0) + int(value)
+
+    def dropped(self, value):
+        # Records rows removed by drop_duplicates (or another de-duplication) in the innermost open stage
+        self.count('dropped', value)
+
+    def extend(self, records, **info):
+        # Adds the stage records of a worker process, nested under the stages open here
+        for record in records:
+            self.stages.append(dict(record, stage= '/'.join(self.path() + [record['stage']]), **info))
+
+    def summary(self):
+        # Returns the records added up per stage path, in the order the stages first finished
+        summary = {}
+        for record in self.stages:
+            total = summary.setdefault(record['stage'], {'runs' : 0})
+            total['runs'] += 1
+            for key, value in record.items():
+                if key == 'peak_rss_mb' and value is not None:
+                    total[key] = max(total.get(key) or 0, value)
+                elif key not in ['stage', 'peak_rss_mb'] and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    total[key] = round(total.get(key, 0) + value, 4)
+        return summary
+
+    def write(self, path, **info):
+        # Writes the run report as JSON and prints the slowest stages
+        summary = self.summary()
+        report = dict(run_date= self.run_date, pid= os.getpid(), python= sys.version.split()[0],
+                    total_seconds= round(time.perf_counter() - self.started, 4), peak_rss_mb= peak_rss_mb(), **info)
+        report.update(summary= summary, stages= self.stages)
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+        print(f'Run report written to {path}')
+        leaf_stages = [stage for stage in summary if not any(other.startswith(stage + '/') for other in summary)]
+        for stage in sorted(leaf_stages, key=lambda stage: summary[stage]['seconds'], reverse=True)[:5]:
+            print(f'{stage}: {summary[stage]["seconds"]:.2f}s over {summary[stage]["runs"]} runs')
@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+from nrn_codes import code_values, unmapped_report
+
+# The address, event and route stages shared by to_segments.py and to_segments_gpd.py. Every stage is split in two: a backend
+# picks the rows that win (the group by / window work) and returns their positions, and the stage builds its columns from
+# those positions with pandas here. Backends only ever return row positions, so every backend gives the same output
+# PandasBackend works on the dataframes directly, DuckDBBackend (segments_duckdb.py) runs the same selections multithreaded
+# and spills to disk when the tables don't fit in memory
+
+class PandasBackend:
+    # Row selection with pandas sorts and drop_duplicates
+    name = 'pandas'
+
+    def longest_event_rows(self, ids, from_measures, to_measures):
+        # Returns the positions of the event covering the longest part of each road element, in element order. Ties go
+        # to the first event in table order, events without measures lose to every event with them
+        measure_dif = pd.Series(np.abs(to_measures - from_measures)).fillna(-1).values
+        order = pd.DataFrame({'id' : ids, 'measure_dif' : measure_dif}).sort_values(by=['id', 'measure_dif'], ascending=[True, False], kind='stable')
+        return order.index.values[~order['id'].duplicated().values]
+
+    def route_rows(self, keys, measure_dif):
+        # Returns the positions and ranks of the routes kept on each road element. Routes are ranked longest event first
+        # (table order on ties, events without measures last) and a route repeated along an element is only kept once
+        # keys holds ORN_ROAD_NET_ELEMENT_ID and the route fields
+        order = keys.assign(measure_dif= measure_dif).reset_index(drop=True).sort_values(by=['measure_dif'], ascending= False, kind= 'stable')
+        kept = order[~order.duplicated(subset=list(keys.columns))]
+        rank = kept.groupby('ORN_ROAD_NET_ELEMENT_ID').cumcount().values + 1
+        return kept.index.values, rank
+
+    def side_rows(self, ids, street_sides):
+        # Returns the positions of the address event kept on the left and on the right of each road element (the last in
+        # table order, 'Both' events count on either side) and the number of elements with more than one on a side
+        sides = pd.concat([pd.DataFrame({'id' : ids, 'SIDE' : 'L'})[np.isin(street_sides, ['Left', 'Both'])],
+                            pd.DataFrame({'id' : ids, 'SIDE' : 'R'})[np.isin(street_sides, ['Right', 'Both'])]])
+        multi = sides.duplicated(keep=False)
+        kept = sides[~sides.duplicated(keep='last')]
+        return kept.index.values[kept['SIDE'].values == 'L'], kept.index.values[kept['SIDE'].values == 'R'], sides.loc[multi.values, 'id'].nunique()
+
+def make_backend(name, **options):
+    # Returns the backend called name, options go to the DuckDB backend (threads, memory_limit, temp_directory)
+    if name == 'pandas':
+        return PandasBackend()
+    if name == 'duckdb':
+        from segments_duckdb import DuckDBBackend
+        return DuckDBBackend(**options)
+    raise ValueError(f'Unknown backend: {name}')
+
+# L_ / R_ address fields as {field : ORN_ADDRESS_INFO or ORN_STREET_NAME_PARSED field}
+address_side_fields = {'HOUSE_NUMBER_STRUCTURE_CDE' : 'HOUSE_NUMBER_STRUCTURE_CDE',
+                        'FIRST_HOUSE_NUM' : 'FIRST_HOUSE_NUMBER',
+                        'LAST_HOUSE_NUM' : 'LAST_HOUSE_NUMBER',
+                        'FULL_STREET_NAME' : 'FULL_STREET_NAME',
+                        'DIR_PRE' : 'DIRECTIONAL_PREFIX',
+                        'STR_TYP_PRE' : 'STREET_TYPE_PREFIX',
+                        'STR_NME_BDY' : 'STREET_NAME_BODY',
+                        'STR_TYP_SUF' : 'STREET_TYPE_SUFFIX',
+                        'DIR_SUF' : 'DIRECTIONAL_SUFFIX'}
+
+def address_ranges(add_rng_df, add_rng_base, code_tables, report, backend):
+    # Pivots the ORN_ADDRESS_INFO rows onto L_/R_ columns ('Both' rows are fanned out to both sides)
+    # When an element has more than one address event on the same side the last event in table order wins, the same
+    # result the old row by row loop gave by overwriting earlier values
+    side_fields = address_side_fields
+    structure_cde, unmapped = code_values(add_rng_df['HOUSE_NUMBER_STRUCTURE'], code_tables['codes']['hnumstr'])
+    unmapped_report({'HOUSE_NUMBER_STRUCTURE_CDE' : unmapped} if len(unmapped) else {}, 'ORN_ADDRESS_INFO')
+    report.count('unmapped', unmapped.sum())
+    events = add_rng_df.assign(HOUSE_NUMBER_STRUCTURE_CDE= structure_cde)
+    events = events[['ORN_ROAD_NET_ELEMENT_ID', 'STREET_SIDE'] + list(side_fields.values())]
+    events = events.rename(columns={source : field for field, source in side_fields.items()}).reset_index(drop=True)
+    left, right, multi = backend.side_rows(events['ORN_ROAD_NET_ELEMENT_ID'].values, events['STREET_SIDE'].values)
+    print(f'{multi} road elements have multiple address events on the same side, keeping the last event in table order')
+    sides = pd.concat([events.iloc[left].assign(SIDE= 'L'), events.iloc[right].assign(SIDE= 'R')])
+    report.dropped(np.isin(events['STREET_SIDE'], ['Left', 'Both']).sum() + np.isin(events['STREET_SIDE'], ['Right', 'Both']).sum() - len(sides))
+    wide = sides.set_index(['ORN_ROAD_NET_ELEMENT_ID', 'SIDE'])[list(side_fields)].unstack('SIDE')
+    wide.columns = [f'{side}_{field}' for field, side in wide.columns]
+    wide = wide.reindex(columns=[f'{side}_{field}' for side in ['L', 'R'] for field in side_fields])
+    # Columns added by the reindex are float, keep string fields as strings and codes as codes so every partition has the same schema
+    kept_fields = {field : events[field].dtype for field in side_fields if events[field].dtype == object or field.endswith('_CDE')}
+    wide = wide.astype({f'{side}_{field}' : dtype for side in ['L', 'R'] for field, dtype in kept_fields.items()})
+    return add_rng_base.merge(wide, how= 'left', left_on='ORN_ROAD_NET_ELEMENT_ID', right_index=True)
+
+def event_fields(tbl_df, field_prefix):
+    # Renames the fields every event table shares so that they are unique to the table once joined to the roads
+    return tbl_df.rename(columns={'AGENCY_NAME' : field_prefix + '_AGENCY',
+                                'EFFECTIVE_DATETIME' : field_prefix + '_EFF_DATE',
+                                'EVENT_ID' : field_prefix + '_EVENT_ID',
+                                'NATIONAL_UUID' : field_prefix + '_NAT_UUID',
+                                'STREET_SIDE': field_prefix + '_STREET_SIDE',
+                                'FULL_STREET_NAME': field_prefix + '_FULL_STREET_NAME'})
+
+def output_dtypes(table_dtypes, timezone=None):
+    # Returns {column : dtype} of the address and event columns joined to the roads, from the {field : dtype} of ORN_ADDRESS_INFO
+    # and of the event tables in table_dtypes. The dtype of a joined column otherwise depends on the rows of the partition:
+    # integer fields stay int32 where every road has an event and turn float where one doesn't, and a datetime field read
+    # without rows loses its time zone. Integers become nullable Int, floats float64 and datetimes carry timezone
+    def fixed(dtype):
+        dtype = str(dtype)
+        if dtype.startswith('int'):
+            return dtype.capitalize()
+        if dtype.startswith('float'):
+            return 'float64'
+        if dtype.startswith('datetime64'):
+            unit = dtype[len('datetime64['):].split(',')[0].rstrip(']')
+            return f'datetime64[{unit}, {timezone}]' if timezone else f'datetime64[{unit}]'
+        return None
+    columns = {}
+    for table, dtypes in table_dtypes.items():
+        if table == 'ORN_ADDRESS_INFO':
+            names = {'EFFECTIVE_DATETIME' : ['ADDRESS_INFO_EFF_DATE'], 'EVENT_ID' : ['ADDRESS_INFO_EVENT_ID']}
+            for field, source in address_side_fields.items():
+                names.setdefault(source, []).extend([f'L_{field}', f'R_{field}'])
+        else:
+            names = {field : [name] for field, name in zip(dtypes, event_fields(pd.DataFrame(columns=list(dtypes)), table[4:]).columns)}
+        for field, dtype in dtypes.items():
+            if field not in ['ORN_ROAD_NET_ELEMENT_ID', 'FROM_MEASURE', 'TO_MEASURE'] and fixed(dtype) is not None:
+                columns.update({name : fixed(dtype) for name in names.get(field, [])})
+    return columns
+
+def fixed_dtypes(roads_df, dtypes):
+    # Casts the columns of roads_df to dtypes (output_dtypes) so every partition and region writes the same schema, naive
+    # datetimes are taken to be in the time zone of dtypes
+    cast = {}
+    for column, dtype in dtypes.items():
+        if column not in roads_df.columns or str(roads_df[column].dtype) == dtype:
+            continue
+        values = roads_df[column]
+        if dtype.startswith('datetime64'):
+            values = pd.to_datetime(values)
+            timezone = pd.DatetimeTZDtype.construct_from_string(dtype).tz if ',' in dtype else None
+            if values.dt.tz is None and timezone is not None:
+                values = values.dt.tz_localize(timezone)
+            elif values.dt.tz is not None:
+                values = values.dt.tz_convert(timezone) if timezone is not None else values.dt.tz_localize(None)
+        cast[column] = values.astype(dtype)
+    return roads_df.assign(**cast)
+
+def longest_events(tbl_df, field_prefix, backend):
+    # Returns the event covering the longest part of each road element indexed on ORN_ROAD_NET_ELEMENT_ID, ties go to the
+    # first event in table order
+    rows = backend.longest_event_rows(tbl_df['ORN_ROAD_NET_ELEMENT_ID'].values, tbl_df['FROM_MEASURE'].to_numpy(dtype=float, na_value=np.nan),
+                                    tbl_df['TO_MEASURE'].to_numpy(dtype=float, na_value=np.nan))
+    winners = tbl_df.iloc[rows].set_index('ORN_ROAD_NET_ELEMENT_ID')
+    return winners.drop([field_prefix + '_EVENT_ID', 'FROM_MEASURE', 'TO_MEASURE'], axis=1, errors='ignore') # Removes non-essential fields
+
+def route_multifields(roads_df, tbl_df, fields, max_count, report, backend):
+    # Ranks the route events on each road element once and pivots them into FIELD_1 .. FIELD_max_count columns
+    tbl_df = tbl_df[tbl_df['ORN_ROAD_NET_ELEMENT_ID'].isin(roads_df['OGF_ID'])]
+    if {'FROM_MEASURE', 'TO_MEASURE'}.issubset(tbl_df.columns):
+        measure_dif = np.abs(tbl_df['TO_MEASURE'].to_numpy(dtype=float, na_value=np.nan) - tbl_df['FROM_MEASURE'].to_numpy(dtype=float, na_value=np.nan))
+    else:
+        measure_dif = np.zeros(len(tbl_df))
+    rows, rank = backend.route_rows(tbl_df[['ORN_ROAD_NET_ELEMENT_ID'] + fields], measure_dif)
+    report.dropped(len(tbl_df) - len(rows))
+    tbl_df = tbl_df.iloc[rows].assign(RANK= rank)
+    over_cap = tbl_df.loc[tbl_df['RANK'] > max_count, 'ORN_ROAD_NET_ELEMENT_ID'].nunique()
+    report.count('over_cap', (tbl_df['RANK'] > max_count).sum())
+    print(f'{over_cap} road elements have more than {max_count} routes, extra routes are dropped')
+    wide = tbl_df[tbl_df['RANK'] <= max_count].set_index(['ORN_ROAD_NET_ELEMENT_ID', 'RANK'])[fields].unstack('RANK')
+    wide = wide.reindex(columns=[(field, count) for count in range(1, max_count + 1) for field in fields])
+    wide.columns = [f'{field}_{count}' for field, count in wide.columns]
+    # Columns added by the reindex are float, keep string fields as strings so every partition has the same schema
+    wide = wide.astype({f'{field}_{count}' : object for field in fields for count in range(1, max_count + 1) if tbl_df[field].dtype == object})
+    return roads_df.merge(wide, how= 'left', left_on='OGF_ID', right_index=True)
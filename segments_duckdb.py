@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+# DuckDB backend of segments_core.py. The row selections of the address, event and route stages run as window queries in an
+# embedded DuckDB database: the key columns are handed to DuckDB without a copy, the windows run on all the threads and
+# sort / partition state spills to temp_directory once memory_limit is reached. Only the chosen row positions come back,
+# the stages build their columns from them exactly as with the pandas backend
+
+class DuckDBBackend:
+    name = 'duckdb'
+
+    def __init__(self, threads=None, memory_limit=None, temp_directory=None):
+        import duckdb
+        self.con = duckdb.connect()
+        if threads:
+            self.con.execute(f'SET threads = {int(threads)}')
+        if memory_limit:
+            self.con.execute(f"SET memory_limit = '{memory_limit}'")
+        if temp_directory:
+            self.con.execute(f"SET temp_directory = '{temp_directory}'")
+        self.con.execute('SET preserve_insertion_order = false') # results are ordered explicitly
+
+    def rows(self, frame, query):
+        # Runs query over frame (registered as events, with its positions in a row column) and returns the result as numpy arrays
+        self.con.register('events', frame.assign(row= np.arange(len(frame), dtype=np.int64)))
+        try:
+            result = self.con.execute(query).fetchnumpy()
+        finally:
+            self.con.unregister('events')
+        return result
+
+    def longest_event_rows(self, ids, from_measures, to_measures):
+        # Same order and tie breaks as PandasBackend.longest_event_rows: elements in id order, longest event first, events
+        # without measures last, then table order
+        measure_dif = pd.Series(np.abs(to_measures - from_measures)).fillna(-1).values
+        result = self.rows(pd.DataFrame({'id' : ids, 'dif' : measure_dif}), '''
+            SELECT row FROM (
+                SELECT id, row, row_number() OVER (PARTITION BY id ORDER BY dif DESC, row) AS pick FROM events)
+            WHERE pick = 1 ORDER BY id NULLS LAST''')
+        return result['row']
+
+    def route_rows(self, keys, measure_dif):
+        # Same rows, order and ranks as PandasBackend.route_rows: each (element, route) once, from its longest event, ranked
+        # longest event first within the element. Routes are returned longest event first over the whole table
+        fields = [f'"{field}"' for field in keys.columns]
+        frame = keys.reset_index(drop=True).assign(dif= pd.Series(measure_dif).where(~np.isnan(measure_dif)).values)
+        result = self.rows(frame, f'''
+            SELECT row, row_number() OVER (PARTITION BY "ORN_ROAD_NET_ELEMENT_ID" ORDER BY dif DESC NULLS LAST, row) AS route_rank FROM (
+                SELECT *, row_number() OVER (PARTITION BY {", ".join(fields)} ORDER BY dif DESC NULLS LAST, row) AS pick FROM events)
+            WHERE pick = 1 ORDER BY dif DESC NULLS LAST, row''')
+        return result['row'], result['route_rank'].astype(np.int64)
+
+    def side_rows(self, ids, street_sides):
+        # Same rows and count as PandasBackend.side_rows: the last event in table order on each side of each element
+        result = self.rows(pd.DataFrame({'id' : ids, 'side' : pd.Series(street_sides, dtype=object).values}), '''
+            WITH sides AS (
+                SELECT id, 'L' AS side, row FROM events WHERE side IN ('Left', 'Both')
+                UNION ALL SELECT id, 'R' AS side, row FROM events WHERE side IN ('Right', 'Both')),
+            ranked AS (
+                SELECT id, side, row, row_number() OVER (PARTITION BY id, side ORDER BY row DESC) AS pick,
+                    count(*) OVER (PARTITION BY id, side) AS events FROM sides)
+            SELECT side, row, (SELECT count(DISTINCT id) FROM ranked WHERE events > 1) AS multi FROM ranked
+            WHERE pick = 1 ORDER BY side, row''')
+        side = np.asarray(result['side'], dtype=object)
+        multi = int(result['multi'][0]) if len(side) else 0
+        return result['row'][side == 'L'], result['row'][side == 'R'], multi
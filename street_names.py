@@ -0,0 +1,116 @@
+import os, hashlib
+import importlib.util
+import numpy as np
+import pandas as pd
+
+# Street names of the address stage shared by to_segments.py and to_segments_gpd.py. ORN_STREET_NAME_PARSED is held in a
+# hash index on FULL_STREET_NAME with one row per name, so the address rows are looked up instead of merged (a name listed
+# twice no longer fans them out). Names the table doesn't have are split by a rule based English / French parser using
+# the direction code table and the street types the table itself uses. Parsed names are memoized, each distinct name is
+# parsed once, and kept on disk between runs
+
+parser_version = 1 # Bump when parse_street_name changes so the names cached by the old rules are parsed again
+parsed_fields = ['DIRECTIONAL_PREFIX', 'STREET_TYPE_PREFIX', 'STREET_NAME_BODY', 'STREET_TYPE_SUFFIX', 'DIRECTIONAL_SUFFIX']
+# Street types beyond those found in ORN_STREET_NAME_PARSED, French types lead the name (Rue Principale), English types end it
+french_types = ['Rue', 'Chemin', 'Avenue', 'Boulevard', 'Route', 'Rang', 'Montée', 'Place', 'Impasse', 'Croissant', 'Promenade',
+                'Allée', 'Côte', 'Ruelle', 'Sentier', 'Terrasse', 'Carré', 'Cercle', 'Autoroute']
+english_types = ['Street', 'Road', 'Avenue', 'Drive', 'Crescent', 'Court', 'Boulevard', 'Lane', 'Line', 'Way', 'Place', 'Trail',
+                'Circle', 'Parkway', 'Highway', 'Terrace', 'Square', 'Gate', 'Grove', 'Heights', 'Close', 'Sideroad', 'Townline']
+
+def street_vocabulary(parsed_df, directions):
+    # Returns the words the parser recognises as {casefolded words : spelling} for the directions (the direction code table,
+    # hyphenated forms too: Nord-Est), the street type prefixes and the street type suffixes. Types are spelt as the table spells them
+    def words(values):
+        return {value.casefold() : value for value in values if isinstance(value, str) and value.strip()}
+    directions = [direction for direction in directions if direction != 'None']
+    direction_words = dict(words(directions), **{key.replace(' ', '-') : value for key, value in words(directions).items()})
+    prefixes = dict(words(french_types), **words(parsed_df['STREET_TYPE_PREFIX'].dropna().unique()))
+    suffixes = dict(words(english_types), **words(parsed_df['STREET_TYPE_SUFFIX'].dropna().unique()))
+    return direction_words, prefixes, suffixes
+
+def parse_street_name(name, vocabulary):
+    # Splits a full street name into its parsed fields (parsed_fields order), taking off the ends in turn: the directional
+    # suffix (one or two words: South West, Nord Ouest), the street type suffix, then the directional prefix and the street
+    # type prefix. Every rule leaves at least one word for the STREET_NAME_BODY (Avenue Road keeps Avenue as its body)
+    directions, prefixes, suffixes = vocabulary
+    words = name.split()
+    match = lambda part, table: table.get(' '.join(part).casefold())
+    dir_pre = type_pre = type_suf = dir_suf = None
+    for size in [2, 1]:
+        if len(words) > size and match(words[-size:], directions):
+            dir_suf, words = match(words[-size:], directions), words[:-size]
+            break
+    if len(words) > 1 and match(words[-1:], suffixes):
+        type_suf, words = match(words[-1:], suffixes), words[:-1]
+    for size in [2, 1]:
+        if len(words) > size and match(words[:size], directions):
+            dir_pre, words = match(words[:size], directions), words[size:]
+            break
+    if len(words) > 1 and match(words[:1], prefixes):
+        type_pre, words = match(words[:1], prefixes), words[1:]
+    return dir_pre, type_pre, ' '.join(words) or None, type_suf, dir_suf
+
+class StreetNames:
+    # Parsed street names from ORN_STREET_NAME_PARSED (parsed_df) and the direction code table, with the names parsed by
+    # parse_street_name memoized and kept in cache_dir (None keeps them for this run only)
+    def __init__(self, parsed_df, directions, cache_dir=None):
+        unique = parsed_df.drop_duplicates(subset=['FULL_STREET_NAME'], keep='last') # the row the merge let win
+        self.duplicates = len(parsed_df) - len(unique)
+        self.table = unique.set_index('FULL_STREET_NAME')[parsed_fields]
+        self.vocabulary = street_vocabulary(parsed_df, directions)
+        key = hashlib.sha1(repr([parser_version, sorted(self.vocabulary[0].items()), sorted(self.vocabulary[1].items()),
+                                sorted(self.vocabulary[2].items())]).encode()).hexdigest()[:16]
+        self.cache_path = None
+        if cache_dir is not None and importlib.util.find_spec('pyarrow') is not None:
+            self.cache_path = os.path.join(cache_dir, f'street_names_{key}.parquet')
+            os.makedirs(cache_dir, exist_ok=True)
+            for old in os.listdir(cache_dir):
+                if old.startswith('street_names_') and old != os.path.basename(self.cache_path):
+                    os.remove(os.path.join(cache_dir, old)) # parsed with other rules or another vocabulary
+        self.memo = self.load()
+        self.saved = len(self.memo)
+
+    def load(self):
+        # Returns the names parsed by earlier runs as {name : parsed fields}
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        cached = pd.read_parquet(self.cache_path)
+        return dict(zip(cached['FULL_STREET_NAME'], zip(*[cached[field].where(cached[field].notna(), None) for field in parsed_fields])))
+
+    def save(self):
+        # Adds the names parsed since the last save to the cache, along with any another process saved meanwhile, written
+        # aside and renamed so a reader never sees half a file
+        if self.cache_path is None or len(self.memo) == self.saved:
+            return
+        self.memo = dict(self.load(), **self.memo)
+        cached = pd.DataFrame(list(self.memo.values()), columns=parsed_fields, dtype=object)
+        cached.insert(0, 'FULL_STREET_NAME', list(self.memo))
+        temp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        cached.to_parquet(temp_path, index=False)
+        os.replace(temp_path, self.cache_path)
+        self.saved = len(self.memo)
+
+    def parse(self, names):
+        # Returns the parsed fields of distinct names (an array) in the same order: the ORN_STREET_NAME_PARSED row of the name,
+        # or the memoized parse of names the table doesn't have. Null names get null fields
+        parsed = self.table.reindex(names)
+        missing = ~pd.Index(names).isin(self.table.index) & pd.notna(names)
+        new = [name for name in names[missing] if name not in self.memo]
+        for name in new:
+            self.memo[name] = parse_street_name(name, self.vocabulary)
+        if missing.any():
+            parsed.loc[missing] = np.array([self.memo[name] for name in names[missing]], dtype=object).reshape(-1, len(parsed_fields))
+        print(f'{len(names)} street names: {len(names) - missing.sum()} in ORN_STREET_NAME_PARSED, {missing.sum()} parsed '
+            f'({len(new)} not seen before), {self.duplicates} duplicate names dropped from ORN_STREET_NAME_PARSED')
+        return parsed, int(missing.sum()), len(new)
+
+def add_parsed_names(add_rng_df, street_names, report):
+    # Adds the parsed fields of FULL_STREET_NAME to the address rows, each distinct name is looked up (or parsed) once
+    codes, names = pd.factorize(add_rng_df['FULL_STREET_NAME'])
+    parsed, missing, new = street_names.parse(np.asarray(names, dtype=object))
+    report.count('names_parsed', missing)
+    report.count('names_parsed_new', new)
+    street_names.save()
+    rows = parsed.iloc[np.maximum(codes, 0)].reset_index(drop=True)
+    rows.loc[codes < 0] = np.nan # rows without a name, as the merge left them
+    return add_rng_df.reset_index(drop=True).assign(**{field : rows[field] for field in parsed_fields})
@@ -0,0 +1,197 @@
+import os, sys, shutil
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import shapely
+
+# Writes a synthetic ORN shaped dataset (Non_Sensitive and workingGDB) at any scale so the segmentation scripts can be run and
+# benchmarked without the real ORN download. Road elements are laid on the edges of a jittered street grid so they meet at
+# junctions, and every attribute table is a set of FROM_MEASURE / TO_MEASURE events splitting its road elements up
+
+def grid_roads(count, rng):
+    # Returns count road elements picked from the edges of a square street grid around Ontario, and the grid nodes they use
+    # Each road runs between two grid nodes (its FROM/TO junctions) with a jittered middle vertex
+    side = int(np.ceil(np.sqrt(count / 2))) + 1
+    spacing = 0.005
+    node_xy = np.stack(np.meshgrid(np.arange(side), np.arange(side), indexing='ij'), axis=-1).reshape(-1, 2) * spacing
+    node_xy = node_xy + [-80.0, 43.0] + rng.normal(0, spacing / 10, node_xy.shape)
+    node_ids = np.arange(side * side).reshape(side, side)
+    edges = np.concatenate([np.stack([node_ids[:-1, :].ravel(), node_ids[1:, :].ravel()], axis=1),
+                            np.stack([node_ids[:, :-1].ravel(), node_ids[:, 1:].ravel()], axis=1)])
+    edges = edges[rng.permutation(len(edges))[:count]]
+    start, end = node_xy[edges[:, 0]], node_xy[edges[:, 1]]
+    middle = (start + end) / 2 + rng.normal(0, spacing / 20, start.shape)
+    geometry = shapely.linestrings(np.stack([start, middle, end], axis=1))
+    # Lengths in metres from the degree coordinates, close enough at this latitude for measures
+    parts = np.diff(np.stack([start, middle, end], axis=1), axis=1) * [111320 * np.cos(np.radians(43.0)), 110540]
+    length = np.sqrt((parts ** 2).sum(axis=2)).sum(axis=1).round(2)
+    ogf_ids = np.sort(rng.choice(count * 3, count, replace=False)) + 1000000
+    roads = gpd.GeoDataFrame({'OGF_ID' : ogf_ids,
+                            'ROAD_ELEMENT_TYPE' : rng.choice(['ROAD ELEMENT', 'FERRY CONNECTION', 'VIRTUAL ROAD'], count, p=[0.96, 0.01, 0.03]),
+                            'ACQUISITION_TECHNIQUE' : rng.choice(['GPS', 'ORTHOIMAGE', 'ORTHOPHOTO', 'VECTOR DATA', 'UNKNOWN'], count),
+                            'CREATION_DATE' : pd.Timestamp('2005-01-01') + pd.to_timedelta(rng.integers(0, 5000, count), unit='D'),
+                            'REVISION_DATE' : pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.integers(0, 1500, count), unit='D'),
+                            'EXIT_NUMBER' : np.where(rng.random(count) < 0.01, rng.integers(1, 500, count).astype(str), None),
+                            'NATIONAL_UUID' : [f'{ogf_id:032x}' for ogf_id in ogf_ids],
+                            'ROAD_ABSOLUTE_ACCURACY' : rng.choice([1.0, 5.0, 10.0], count),
+                            'DIRECTION_OF_TRAFFIC_FLOW' : rng.choice(['Both', 'Positive', 'Negative', 'Unknown'], count, p=[0.9, 0.04, 0.04, 0.02]),
+                            'FROM_JUNCTION_ID' : edges[:, 0] + 1,
+                            'TO_JUNCTION_ID' : edges[:, 1] + 1,
+                            'LENGTH' : length},
+                            geometry=geometry, crs='EPSG:4269')
+    # The gdb is not stored in OGF_ID order
+    roads = roads.iloc[rng.permutation(count)].reset_index(drop=True)
+    used = np.unique(edges)
+    degree = np.bincount(edges.ravel(), minlength=len(node_xy))[used]
+    junctions = gpd.GeoDataFrame({'JUNCTION_ID' : used + 1,
+                                'JUNCTION_TYPE' : np.where(degree == 1, 'Dead End', 'Intersection')},
+                                geometry=shapely.points(node_xy[used]), crs='EPSG:4269')
+    return roads, junctions
+
+def measure_events(roads, rng, coverage, per_element):
+    # Returns events splitting the road elements into consecutive FROM_MEASURE / TO_MEASURE spans covering the whole element
+    # A share of coverage of the elements get events, on average per_element of them
+    roads = roads[rng.random(len(roads)) < coverage]
+    counts = rng.poisson(per_element - 1, len(roads)) + 1
+    events = pd.DataFrame({'ORN_ROAD_NET_ELEMENT_ID' : np.repeat(roads['OGF_ID'].values, counts),
+                            'LENGTH' : np.repeat(roads['LENGTH'].values, counts),
+                            'CUT' : rng.random(counts.sum())})
+    first = np.repeat(np.cumsum(counts) - counts, counts) == np.arange(len(events))
+    events.loc[first, 'CUT'] = 0.0
+    events = events.sort_values(by=['ORN_ROAD_NET_ELEMENT_ID', 'CUT'], ignore_index=True)
+    next_cut = events.groupby('ORN_ROAD_NET_ELEMENT_ID')['CUT'].shift(-1).fillna(1.0)
+    events['FROM_MEASURE'] = (events['CUT'] * events['LENGTH']).round(2)
+    events['TO_MEASURE'] = (next_cut * events['LENGTH']).round(2)
+    return events.drop(['LENGTH', 'CUT'], axis=1)
+
+def point_events(roads, rng, count):
+    # Returns count events located AT_MEASURE along randomly picked road elements
+    roads = roads.iloc[rng.choice(len(roads), min(count, len(roads)), replace=False)]
+    return pd.DataFrame({'ORN_ROAD_NET_ELEMENT_ID' : roads['OGF_ID'].values,
+                        'AT_MEASURE' : (rng.random(len(roads)) * roads['LENGTH'].values).round(2)})
+
+def event_table(events, rng, first_event_id, **fields):
+    # Adds the EVENT_ID, AGENCY_NAME, EFFECTIVE_DATETIME and NATIONAL_UUID columns every ORN event table has, plus fields
+    # given as a list of choices or a function of the number of events, and shuffles the rows out of element order
+    count = len(events)
+    events = events.assign(EVENT_ID= np.arange(first_event_id, first_event_id + count),
+                            AGENCY_NAME= rng.choice(['MINISTRY OF TRANSPORTATION', 'CITY OF OTTAWA', 'CITY OF TORONTO', 'COUNTY OF SIMCOE'], count),
+                            EFFECTIVE_DATETIME= pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3000, count), unit='D'))
+    events['NATIONAL_UUID'] = [f'{event_id:032x}' for event_id in events['EVENT_ID']]
+    for field, values in fields.items():
+        events[field] = values(count) if callable(values) else rng.choice(values, count)
+    return events.iloc[rng.permutation(count)].reset_index(drop=True)
+
+def street_names(rng, count):
+    # Returns ORN_STREET_NAME_PARSED rows for about count distinct street names
+    bodies = ['Maple', 'Oak', 'King', 'Queen', 'Lake', 'Hill', 'Church', 'Mill', 'Bay', 'River', 'Pine', 'Cedar', 'Elm',
+            'Victoria', 'Wellington', 'Principale', 'Champlain', 'Laurier', 'Dundas', 'Yonge']
+    bodies = [body + ending for body in bodies for ending in ['', 'view', 'wood', 'side', 'field', 'brook']]
+    bodies = bodies + [f'{body} {number}' for body in ['Concession', 'Sideroad', 'Line'] for number in range(1, max(count // 10, 1) + 1)]
+    count = max(count, 1)
+    parsed = pd.DataFrame({'DIRECTIONAL_PREFIX' : rng.choice([None, 'North', 'South', 'East', 'West'], count, p=[0.92, 0.02, 0.02, 0.02, 0.02]),
+                            'STREET_TYPE_PREFIX' : rng.choice([None, 'Rue', 'Chemin', 'Avenue'], count, p=[0.85, 0.1, 0.03, 0.02]),
+                            'STREET_NAME_BODY' : rng.choice(bodies, count),
+                            'STREET_TYPE_SUFFIX' : rng.choice([None, 'Street', 'Road', 'Avenue', 'Drive', 'Crescent', 'Line'], count),
+                            'DIRECTIONAL_SUFFIX' : rng.choice([None, 'North', 'South', 'East', 'West', 'Est', 'Ouest'], count,
+                                                            p=[0.8, 0.04, 0.04, 0.04, 0.04, 0.02, 0.02])})
+    parsed['FULL_STREET_NAME'] = parsed.apply(lambda row: ' '.join(part for part in row if part), axis=1)
+    return parsed.drop_duplicates(subset=['FULL_STREET_NAME'], ignore_index=True)[['FULL_STREET_NAME', 'DIRECTIONAL_PREFIX',
+        'STREET_TYPE_PREFIX', 'STREET_NAME_BODY', 'STREET_TYPE_SUFFIX', 'DIRECTIONAL_SUFFIX']]
+
+def located_points(roads, events):
+    # Places point events on their road element at AT_MEASURE, standing in for the points made with the QGIS LRS plugin
+    located = events.merge(roads[['OGF_ID', 'LENGTH', 'geometry']], how='left', left_on='ORN_ROAD_NET_ELEMENT_ID', right_on='OGF_ID')
+    points = shapely.line_interpolate_point(located['geometry'].values, (located['AT_MEASURE'] / located['LENGTH']).values, normalized=True)
+    return gpd.GeoDataFrame(events.assign(lrs_err=''), geometry=points, crs=roads.crs)
+
+def write_layer(df, path, layer, driver):
+    # Writes one layer, 64 bit integer fields are narrowed to 32 bits since OpenFileGDB would store them as doubles
+    df = df.astype({field : 'int32' for field in df.columns if df[field].dtype == 'int64'})
+    pyogrio.write_dataframe(df, path, layer=layer, driver=driver, append=os.path.exists(path))
+
+def write_synthetic_orn(out_dir, count, seed=0, driver='OpenFileGDB'):
+    # Writes Non_Sensitive and workingGDB (.gdb or .gpkg depending on driver) with count road elements to out_dir
+    rng = np.random.default_rng(seed)
+    extension = '.gdb' if driver == 'OpenFileGDB' else '.gpkg'
+    orn_path = os.path.join(out_dir, 'Non_Sensitive' + extension)
+    working_path = os.path.join(out_dir, 'workingGDB' + extension)
+    os.makedirs(out_dir, exist_ok=True)
+    for path in [orn_path, working_path]:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    print(f'Generating {count} road elements')
+    roads, junctions = grid_roads(count, rng)
+    parsed = street_names(rng, count // 20)
+    names = parsed['FULL_STREET_NAME'].values
+    number_of = lambda low, high: (lambda size: rng.integers(low, high, size))
+    layers = {}
+    layers['ORN_ADDRESS_INFO'] = event_table(measure_events(roads, rng, 0.8, 1.3), rng, 1,
+                                            STREET_SIDE= lambda size: rng.choice(['Left', 'Right', 'Both'], size, p=[0.4, 0.4, 0.2]),
+                                            HOUSE_NUMBER_STRUCTURE= ['Even', 'Odd', 'Mixed', 'Irregular', 'None', 'Unknown'],
+                                            FIRST_HOUSE_NUMBER= number_of(1, 500),
+                                            LAST_HOUSE_NUMBER= number_of(500, 2000),
+                                            FULL_STREET_NAME= names)
+    layers['ORN_STREET_NAME_PARSED'] = parsed
+    layers['ORN_OFFICIAL_STREET_NAME'] = event_table(measure_events(roads, rng, 0.9, 1.0), rng, 1, FULL_STREET_NAME= names, STREET_SIDE= ['Both'])
+    layers['ORN_ALTERNATE_STREET_NAME'] = event_table(measure_events(roads, rng, 0.05, 1.0), rng, 1, FULL_STREET_NAME= names,
+                                                    STREET_SIDE= ['Both', 'Left', 'Right'])
+    layers['ORN_ROAD_CLASS'] = event_table(measure_events(roads, rng, 1.0, 1.2), rng, 1,
+                                        ROAD_CLASS= ['Freeway', 'Expressway / Highway', 'Arterial', 'Collector', 'Local / Street', 'Local / Strata',
+                                                    'Local / Unknown', 'Alleyway / Laneway', 'Ramp', 'Resource / Recreation', 'Service', 'Winter'])
+    surface = measure_events(roads, rng, 1.0, 1.3)
+    is_paved = rng.random(len(surface)) < 0.7
+    layers['ORN_ROAD_SURFACE'] = event_table(surface, rng, 1,
+                                            PAVEMENT_STATUS= lambda size: np.where(is_paved, 'Paved', 'Unpaved'),
+                                            SURFACE_TYPE= lambda size: np.where(is_paved, rng.choice(['Rigid', 'Flexible', 'Blocks'], size),
+                                                                                        rng.choice(['Gravel', 'Dirt', 'Unknown'], size)))
+    layers['ORN_SPEED_LIMIT'] = event_table(measure_events(roads, rng, 0.95, 1.3), rng, 1, SPEED_LIMIT= [40, 50, 60, 70, 80, 90, 100])
+    layers['ORN_NUMBER_OF_LANES'] = event_table(measure_events(roads, rng, 0.95, 1.2), rng, 1, NUMBER_OF_LANES= [1, 2, 2, 2, 4, 6])
+    layers['ORN_JURISDICTION'] = event_table(measure_events(roads, rng, 1.0, 1.1), rng, 1,
+                                            JURISDICTION= ['Provincial', 'Municipal', 'Federal', 'First Nation', 'Private'])
+    layers['ORN_STRUCTURE'] = event_table(measure_events(roads, rng, 0.03, 1.0), rng, 1,
+                                        STRUCTURE_TYPE= ['Bridge', 'Bridge Covered', 'Bridge Moveable', 'Tunnel', 'Dam'],
+                                        STRUCTURE_NAME_ENGLISH= ['Mill Creek Bridge', 'Rideau Bridge', 'Highland Tunnel'],
+                                        STRUCTURE_NAME_FRENCH= ['Pont du ruisseau Mill', 'Pont Rideau', 'Tunnel des Hautes-Terres'])
+    layers['ORN_ROUTE_NUMBER'] = event_table(measure_events(roads, rng, 0.1, 1.5), rng, 1,
+                                            ROUTE_NUMBER= lambda size: rng.integers(1, 700, size).astype(str))
+    layers['ORN_ROUTE_NAME'] = event_table(measure_events(roads, rng, 0.05, 1.5), rng, 1,
+                                        ROUTE_NAME_ENGLISH= ['Trans-Canada Highway', "King's Highway", 'Queen Elizabeth Way'],
+                                        ROUTE_NAME_FRENCH= ['Route Transcanadienne', 'Route du Roi', 'Autoroute Queen Elizabeth'])
+    layers['ORN_UNDERPASS'] = event_table(point_events(roads, rng, max(count // 500, 1)), rng, 1)
+    layers['ORN_TOLL_POINT'] = event_table(point_events(roads, rng, max(count // 1000, 1)), rng, 1,
+                                        TOLL_POINT_TYPE= ['Physical', 'Virtual', 'Hybrid', 'Unknown'])
+    layers['ORN_BLOCKED_PASSAGE'] = event_table(point_events(roads, rng, max(count // 1000, 1)), rng, 1,
+                                                BLOCKED_PASSAGE_TYPE= ['Permanent', 'Removable', 'Unknown'])
+
+    print(f'Writing {orn_path}')
+    write_layer(roads, orn_path, 'ORN_ROAD_NET_ELEMENT', driver)
+    write_layer(junctions, orn_path, 'ORN_JUNCTION', driver)
+    for layer, df in layers.items():
+        print(f'{layer}: {len(df)} rows')
+        write_layer(df, orn_path, layer, driver)
+
+    print(f'Writing {working_path}')
+    write_layer(roads, working_path, 'ORN_net_element_tester', driver)
+    toll_points = located_points(roads, layers['ORN_TOLL_POINT'].rename(columns={'TOLL_POINT_TYPE' : 'TOLL_POINT'}))
+    write_layer(toll_points, working_path, 'ORN_Toll_Points', driver)
+    blocked_passages = located_points(roads, layers['ORN_BLOCKED_PASSAGE'].rename(columns={'BLOCKED_PASSAGE_TYPE' : 'BLOCKED_PA'}))
+    write_layer(blocked_passages, working_path, 'ORN_BLocked_Passages', driver)
+    return orn_path, working_path
+
+#----------------------------------------------------------------------------------------------------------------
+#Inputs
+# python synthetic_orn.py [road element count] [output folder]
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000 # Number of road elements
+out_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.getcwd(), f'synthetic_{count}') # Run the scripts from this folder
+seed = 0 # Same seed and count always give the same dataset
+driver = 'OpenFileGDB' # 'OpenFileGDB' writes .gdb folders like the ORN download, 'GPKG' writes GeoPackages
+
+if __name__ == '__main__':
+    write_synthetic_orn(out_dir, count, seed, driver)
+    print('DONE!')
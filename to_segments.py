@@ -1,7 +1,18 @@
-import arcpy, os, sys
+import arcpy, os, sys, shutil, hashlib
+import argparse
 import pandas as pd
 import numpy as np
 from arcgis.features import GeoAccessor
+from layer_cache import LayerCache, gdb_fingerprint
+from checkpoints import Checkpoints, scope_folder, prune, run_stage
+from linear_referencing import locate_measures, lrs_report
+from nrn_codes import load_code_tables, encode_layer, unmapped_report
+from nrn_export import load_products, conform_product, products_for
+from run_report import RunReport
+from event_qa import check_tables
+from junction_topology import JunctionGraph, junction_layer, topology_report
+from segments_core import make_backend, address_ranges, event_fields, longest_events, route_multifields, output_dtypes, fixed_dtypes
+from street_names import StreetNames, add_parsed_names, parser_version
 
 arcpy.env.overwriteOutput = True
 
@@ -10,12 +21,180 @@ def unique_values(fc, field):
     with arcpy.da.SearchCursor(fc, field_names= [field]) as cursor:
         return sorted({row[0] for row in cursor})
 
-def NumberizeField(df, field, outFieldName, numberize_dict):
-    # will return a new field in pandas dataframe with the field name + _CDE
-    df.insert(df.columns.get_loc(field) + 1, outFieldName + '_CDE', df[field])
-    df[outFieldName + '_CDE'] = df[field].map(numberize_dict)
-    pd.to_numeric(df[outFieldName + '_CDE'], errors= 'ignore')
-    
+def read_table(gdb, table):
+    # Reads a gdb table into a dataframe, through the layer cache when it is switched on. In a regional run the tables with
+    # ORN_ROAD_NET_ELEMENT_ID only come back with the rows of the region's road elements, filtered in the read
+    path = os.path.join(gdb, table)
+    by_element = region is not None and 'ORN_ROAD_NET_ELEMENT_ID' in [field.name for field in arcpy.ListFields(path)]
+    if layer_cache is not None:
+        filters = [('ORN_ROAD_NET_ELEMENT_ID', 'in', region.tolist())] if by_element else None
+        return layer_cache.read(gdb, table, lambda: pd.DataFrame.spatial.from_table(path), filters=filters)
+    if not by_element:
+        return pd.DataFrame.spatial.from_table(path)
+    return pd.concat([pd.DataFrame.spatial.from_table(path, where_clause=where) for where in id_wheres('ORN_ROAD_NET_ELEMENT_ID', region)], ignore_index=True)
+
+def table_dtypes(gdb, table):
+    # Returns the {field : dtype} of the numeric and date fields of a gdb table, as the spatially enabled dataframe reads them
+    dtypes = {'SmallInteger' : 'int16', 'Integer' : 'int32', 'BigInteger' : 'int64', 'Single' : 'float32', 'Double' : 'float64', 'Date' : 'datetime64[ns]'}
+    return {field.name : dtypes[field.type] for field in arcpy.ListFields(os.path.join(gdb, table)) if field.type in dtypes}
+
+def id_wheres(field, ids):
+    # Returns where clauses selecting ids by field, 1000 ids per IN list
+    return [f'{field} IN ({", ".join(str(i) for i in batch)})' for batch in np.array_split(ids, max(int(np.ceil(len(ids) / 1000)), 1)) if len(batch)]
+
+def road_wheres():
+    # Returns the where clauses reading the road elements of the run, [''] reads every road
+    return id_wheres('OGF_ID', region) if region is not None else ['']
+
+def region_ids():
+    # Returns the sorted OGF_IDs of the roads meeting every region filter given (region_bbox, region_polygon, region_jurisdictions,
+    # region_ogf_ids), or None when no filter is given and the run covers every road. The spatial filters are selections on
+    # the road layer (spatial index) and the jurisdictions a where clause on ORN_JURISDICTION
+    if region_bbox is None and region_polygon is None and region_jurisdictions is None and region_ogf_ids is None:
+        return None
+    roads_layer = arcpy.management.MakeFeatureLayer(road_ele_data, 'region_roads')[0]
+    if region_bbox is not None:
+        box = arcpy.Extent(*region_bbox, spatial_reference= arcpy.Describe(road_ele_data).spatialReference).polygon
+        arcpy.management.SelectLayerByLocation(roads_layer, 'INTERSECT', box)
+    if region_polygon is not None:
+        arcpy.management.SelectLayerByLocation(roads_layer, 'INTERSECT', region_polygon,
+                                            selection_type= 'SUBSET_SELECTION' if region_bbox is not None else 'NEW_SELECTION')
+    ids = np.array(unique_values(roads_layer, 'OGF_ID'), dtype=np.int64)
+    arcpy.management.Delete(roads_layer)
+    if region_ogf_ids is not None:
+        ids = np.intersect1d(ids, region_ogf_ids)
+    if region_jurisdictions is not None:
+        names = ', '.join("'" + str(name).replace("'", "''") + "'" for name in region_jurisdictions)
+        jurisdiction = arcpy.da.TableToNumPyArray(os.path.join(ORN_GDB, 'ORN_JURISDICTION'), ['ORN_ROAD_NET_ELEMENT_ID'], where_clause= f'JURISDICTION IN ({names})')
+        ids = np.intersect1d(ids, jurisdiction['ORN_ROAD_NET_ELEMENT_ID'])
+    print(f'{len(ids)} road elements in the region')
+    return ids
+
+def checkpoint_folder():
+    # Returns the checkpoint folder of the roads this run covers (the road layer and the region), so a regional run never
+    # touches the checkpoints of a full run or of another region
+    return scope_folder(checkpoint_dir, repr([os.path.abspath(road_ele_data), region_bbox, region_polygon, region_jurisdictions, region_ogf_ids]))
+
+def stage_key(name):
+    # Returns the key of a stage checkpoint: the fingerprint of the ORN gdb and the settings the stage uses
+    keys = {'address' : [code_tables, parser_version], 'events' : [], 'routes' : [route_field_cap]}
+    return hashlib.sha1(repr([orn_fingerprint] + keys[name.split('/')[0]]).encode()).hexdigest()[:16]
+
+def open_checkpoints():
+    # Returns the Checkpoints of the run, None when checkpoint is off. Only the attribute stages are checkpointed, the roads
+    # keep their arcgis geometries and are read again
+    if not checkpoint:
+        return None
+    return Checkpoints(os.path.join(checkpoint_folder(), 'run'), rerun_stages, stage_key)
+
+def address_table():
+    # Returns the L/R address range fields of the road elements, one row per element
+    add_rng_df = read_table(ORN_GDB, 'ORN_ADDRESS_INFO') # get full dataset
+    field_prefix = 'ADDRESS_INFO'
+    add_rng_df.rename(columns={'AGENCY_NAME' : field_prefix + '_AGENCY', 
+                            'EFFECTIVE_DATETIME' : field_prefix + '_EFF_DATE',
+                            'EVENT_ID' : field_prefix + '_EVENT_ID',
+                            }, 
+                            inplace= True)
+    # Select only rows that are in the section currently being worked on
+    add_rng_df = add_rng_df[add_rng_df['ORN_ROAD_NET_ELEMENT_ID'].isin(OGF_IDS)]
+    add_rng_base = add_rng_df[['ORN_ROAD_NET_ELEMENT_ID', 
+                                field_prefix + '_AGENCY',
+                                field_prefix + '_EFF_DATE',
+                                field_prefix + '_EVENT_ID',
+                                'STREET_SIDE',
+                                'HOUSE_NUMBER_STRUCTURE']].drop_duplicates(subset=['ORN_ROAD_NET_ELEMENT_ID'],  keep='first') # Base for adding L/R attributes to the table
+
+    #Parsed street names, looked up in ORN_STREET_NAME_PARSED or parsed
+    street_names = StreetNames(read_table(ORN_GDB, 'ORN_STREET_NAME_PARSED'), code_tables['codes']['direction'], street_name_cache_dir)
+    add_rng_df = add_parsed_names(add_rng_df, street_names, run_report)
+
+    #Pivot address info onto L/R columns
+    print('Calculating Address Range data')
+    return address_ranges(add_rng_df, add_rng_base, code_tables, run_report, backend)
+
+def table_winners(table):
+    # Returns the longest event of each road element in an event table, indexed on ORN_ROAD_NET_ELEMENT_ID
+    field_prefix = table[4:]
+    print(f'Running segmentification on: {table}')
+    tbl_df = read_table(ORN_GDB, table)
+    tbl_df = event_fields(tbl_df.drop(['OBJECTID'], axis=1), field_prefix) #Rename Table fields
+    tbl_df = tbl_df[tbl_df['ORN_ROAD_NET_ELEMENT_ID'].isin(OGF_IDS)]
+    #Keep only the event with the largest measure dif (longest seg) for each road element
+    winners = longest_events(tbl_df, field_prefix, backend)
+    print(f'Table Length: {len(tbl_df)} Road elements with events: {len(winners)}')
+    return winners
+
+def table_routes(table):
+    # Returns the route multi fields of the road elements from a route table, one row per OGF_ID
+    print(f'Running segmentification on: {table}')
+    tbl_df = read_table(ORN_GDB, table)
+    tbl_df = tbl_df.drop(['OBJECTID', 'EVENT_ID', 'AGENCY_NAME'], axis=1) # Drop some excess fields
+    return route_multifields(pd.DataFrame({'OGF_ID' : OGF_IDS}), tbl_df, route_fields[table], route_field_cap[table], run_report, backend)
+
+def parse_args(argv):
+    # Reads the command line, every argument defaults to its value in the inputs below
+    # python to_segments.py --roads workingGDB.gdb/ORN_net_element_tester --jurisdiction Municipal --out-gdb municipal.gdb
+    # Arguments can be read from a file with @file (one per line), e.g. --ogf-ids @ids.txt
+    parser = argparse.ArgumentParser(description='Converts the ORN LRS into NRN road segments', fromfile_prefix_chars='@')
+    parser.add_argument('--orn-gdb', default=ORN_GDB, help='gdb holding the ORN event tables (default: %(default)s)')
+    parser.add_argument('--working-gdb', default=workingGDB, help='gdb holding the QGIS point layers (default: %(default)s)')
+    parser.add_argument('--roads', help='road element feature class as gdb/feature class (default: orn gdb/ORN_ROAD_NET_ELEMENT)')
+    parser.add_argument('--out-gdb', default=outGDB, help='delivery gdb, it must exist (default: %(default)s)')
+    parser.add_argument('--nrn-gdb', default=nrn_gdb, help='NRN products gdb (default: %(default)s)')
+    parser.add_argument('--layer-cache', action='store_true', default=use_layer_cache,
+                        help=f'keep Parquet copies of the ORN tables in {layer_cache_dir} for faster reruns (a full copy of the gdb)')
+    region = parser.add_argument_group('region', 'only the road elements meeting every filter given are processed, their rows are filtered in the reads')
+    region.add_argument('--bbox', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'), help='roads crossing this box, in the road spatial reference')
+    region.add_argument('--polygon', help='roads crossing the polygons of this feature class')
+    region.add_argument('--jurisdiction', nargs='+', help='roads with an ORN_JURISDICTION event of one of these JURISDICTIONs')
+    region.add_argument('--ogf-ids', type=int, nargs='+', help='these road elements')
+    stages = parser.add_argument_group('checkpoints', f'attribute stage outputs are checkpointed in {checkpoint_dir} (a folder per road layer and region) and a rerun resumes from them')
+    stages.add_argument('--checkpoint', action='store_true', default=checkpoint, help='checkpoint the stage outputs and resume from them')
+    stages.add_argument('--rerun', nargs='+', default=rerun_stages, metavar='STAGE',
+                        help='build these stages again: address, events/<table>, routes/<table>')
+    stages.add_argument('--fresh', action='store_true', help='remove the checkpoints of these roads and run every stage')
+    stages.add_argument('--prune', action='store_true', help='remove the checkpoints of every other road layer and region')
+    args = parser.parse_args(argv)
+    if args.bbox is not None and (args.bbox[0] >= args.bbox[2] or args.bbox[1] >= args.bbox[3]):
+        parser.error('--bbox is XMIN YMIN XMAX YMAX')
+    if args.fresh and args.rerun:
+        parser.error('--fresh already reruns every stage')
+    if args.rerun and not args.checkpoint:
+        parser.error('--rerun resumes the other stages from their checkpoints, add --checkpoint')
+    return args
+
+def measure_table(table):
+    # Returns an ORN table for the event QA, None for tables without FROM_MEASURE / TO_MEASURE
+    fields = [field.name for field in arcpy.ListFields(os.path.join(ORN_GDB, table))]
+    return read_table(ORN_GDB, table) if {'FROM_MEASURE', 'TO_MEASURE'}.issubset(fields) else None
+
+def locate_points(table):
+    # Builds the point layer of an ORN point event table (ORN_TOLL_POINT, ORN_BLOCKED_PASSAGE) by locating every AT_MEASURE along
+    # its road element, in place of the layers made in QGIS with the linear referencing plugin. Fields keep the 10 character
+    # names the plugin gave them and lrs_err says why an event could not be located
+    # Road vertices come out of arcpy.da without their part numbers, so multi part roads are measured across the gaps between parts
+    events_df = read_table(ORN_GDB, table).drop(['OBJECTID'], axis=1, errors='ignore')
+    vertices = np.concatenate([arcpy.da.FeatureClassToNumPyArray(road_ele_data, ['OGF_ID', 'SHAPE@X', 'SHAPE@Y'], where, explode_to_points=True) for where in road_wheres()])
+    lengths = pd.DataFrame(np.concatenate([arcpy.da.TableToNumPyArray(road_ele_data, ['OGF_ID', 'LENGTH'], where) for where in road_wheres()])).set_index('OGF_ID')['LENGTH']
+    spatial_reference = arcpy.Describe(road_ele_data).spatialReference
+    xy, lrs_err = locate_measures(vertices['OGF_ID'], vertices['OGF_ID'], np.column_stack([vertices['SHAPE@X'], vertices['SHAPE@Y']]),
+                                lengths, events_df['ORN_ROAD_NET_ELEMENT_ID'].values, events_df['AT_MEASURE'].values,
+                                spatial_reference.type == 'Geographic', lrs_tolerance)
+    lrs_report(lrs_err, table)
+    events_df = events_df.rename(columns={field : field[:10] for field in events_df.columns})
+    events_df['lrs_err'] = lrs_err
+    events_df['POINT_X'], events_df['POINT_Y'] = xy[:, 0], xy[:, 1]
+    events_df = events_df[events_df['lrs_err'] == ''] # Only located events become points
+    events_df = pd.DataFrame.spatial.from_xy(events_df, 'POINT_X', 'POINT_Y', sr= spatial_reference.factoryCode)
+    return events_df.drop(['POINT_X', 'POINT_Y'], axis=1)
+
+def conform_nrn_products(layer, df):
+    # Adds the NRN tables the configs build from a delivered layer (still in memory) to nrn_tables
+    for product in products_for(nrn_products, layer):
+        conformed = conform_product(df, product, 'SHAPE')
+        if conformed is not None:
+            nrn_tables.setdefault(product['table'], []).append(conformed)
 
 #Data Source: https://geohub.lio.gov.on.ca/datasets/mnrf::ontario-road-network-orn-road-net-element
 '''                     Conversion Methodology
@@ -36,90 +215,81 @@ workingGDB = os.path.join(directory, 'workingGDB.gdb')
 outGDB = os.path.join(directory, 'files_for_delivery.gdb') 
 road_ele_data = os.path.join(ORN_GDB, 'ORN_ROAD_NET_ELEMENT') # Full road dataset
 #road_ele_data = os.path.join(workingGDB, 'ORN_net_element_tester') #Test area road dataset
+use_layer_cache = False # Keep Parquet copies of the ORN tables, refreshed whenever the gdb changes (needs pyarrow), see --layer-cache
+layer_cache_dir = os.path.join(directory, 'layer_cache')
+street_name_cache_dir = os.path.join(directory, 'street_name_cache') # Street names missing from ORN_STREET_NAME_PARSED parsed by earlier runs, None parses them again every run
+topology = True # Build ORN_junctions from the roads' FROM/TO_JUNCTION_ID with NRN junction types and count dangles and disconnected networks
+locate_points_from_events = True # Locate ORN_TOLL_POINT and ORN_BLOCKED_PASSAGE on the roads by AT_MEASURE, False reads ORN_Toll_Points / ORN_BLocked_Passages made in QGIS from workingGDB
+event_qa = True # Check the measures of every event table for missing, reversed, out of range, overlapping and gapped events
+qa_tolerance = 0.5 # Measures closer than this (in measure units) are treated as equal by the event QA
+qa_gaps_allowed = ['ORN_ADDRESS_INFO', 'ORN_STRUCTURE', 'ORN_UNDERPASS', 'ORN_ALTERNATE_STREET_NAME', 'ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME'] # Tables not meant to cover their elements end to end
+qa_overlaps_allowed = ['ORN_ALTERNATE_STREET_NAME', 'ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME'] # Tables with concurrent events (several names or routes on one stretch)
+qa_report_file = os.path.join(directory, 'files_for_delivery_event_qa.csv') # Per table counts of each issue
+lrs_tolerance = 1.0 # AT_MEASUREs up to this far (in measure units) past either end of their road element are placed on the end
+code_tables = load_code_tables(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ORN_code_tables.yaml')) # NRN codes of the encoded fields
+backend = make_backend('pandas') # make_backend('duckdb', memory_limit='4GB', temp_directory=...) picks the address, event and route rows with DuckDB (needs duckdb)
+run_report = RunReport() # Row counts of the shared stages, nothing is written out
+route_field_cap = {'ORN_ROUTE_NUMBER' : 5, 'ORN_ROUTE_NAME' : 4} # Max ROUTE_NUMBER_n / ROUTE_NAME_*_n columns (NRN rtnumber1-5, rtename1-4)
+route_fields = {'ORN_ROUTE_NUMBER' : ['ROUTE_NUMBER'], 'ORN_ROUTE_NAME' : ['ROUTE_NAME_ENGLISH', 'ROUTE_NAME_FRENCH']} # Fields of each route table made into multi fields
+nrn_export = True # Build the NRN products of nrn_configs from the delivered layers in memory and write them to nrn_gdb
+nrn_configs = [os.path.join(os.path.dirname(os.path.abspath(__file__)), yml) for yml in ['ORN_field_map.yaml', 'ORN_ferry_segs.yaml', 'ORN_Toll_Booths.yaml', 'ORN_Blocked_Passages.yaml', 'ORN_junctions.yaml']]
+nrn_products = load_products(nrn_configs)
+nrn_gdb = os.path.join(directory, 'nrn_delivery.gdb') # One feature class or table per NRN table (roadseg, addrange, strplaname, ferryseg, tollpoint, blkpassage, junction)
+nrn_tables = {} # NRN table: conformed dataframes, written at the end of the run
+# Region of a regional rerun, None processes every road element (set from the command line, see parse_args)
+region_bbox = None # (xmin, ymin, xmax, ymax) in the road spatial reference
+region_polygon = None # Polygon feature class, the roads crossing its polygons are processed
+region_jurisdictions = None # JURISDICTION values of ORN_JURISDICTION
+region_ogf_ids = None # OGF_IDs
+checkpoint = False # Checkpoint the address, event and route stage outputs (Parquet, with a manifest) so a rerun after a failure resumes from them, see --checkpoint
+checkpoint_dir = os.path.join(directory, 'checkpoints')
+rerun_stages = [] # Stages to build again even when their checkpoint is valid, see --rerun
+
+args = parse_args(sys.argv[1:])
+ORN_GDB, workingGDB, outGDB, nrn_gdb = args.orn_gdb, args.working_gdb, args.out_gdb, args.nrn_gdb
+layer_cache = LayerCache(layer_cache_dir, 'arcpy') if args.layer_cache else None
+road_ele_data = args.roads or os.path.join(ORN_GDB, 'ORN_ROAD_NET_ELEMENT')
+region_bbox, region_polygon, region_jurisdictions, region_ogf_ids = args.bbox, args.polygon, args.jurisdiction, args.ogf_ids
+checkpoint, rerun_stages = args.checkpoint, args.rerun
+orn_fingerprint = gdb_fingerprint(ORN_GDB) if checkpoint else None
+if args.fresh and os.path.isdir(checkpoint_folder()):
+    shutil.rmtree(checkpoint_folder())
+if args.prune:
+    prune(checkpoint_dir, keep= checkpoint_folder())
 
 #----------------------------------------------------------------------------------------------------------------
 # Main script
 
 arcpy.env.workspace = ORN_GDB 
 tables = arcpy.ListTables()
+region = region_ids()
+if region is not None and len(region) == 0:
+    sys.exit('No road elements in the region')
+checkpoints = open_checkpoints()
 print('Reading road data into spatial dataframe')
-roads_df = pd.DataFrame.spatial.from_featureclass(road_ele_data, dtypes= {'OGF_ID': 'int', 'FROM_JUNCTION_ID':'int', 'TO_JUNCTION_ID': 'int'}) 
+roads_df = pd.concat([pd.DataFrame.spatial.from_featureclass(road_ele_data, where_clause= where, dtypes= {'OGF_ID': 'int', 'FROM_JUNCTION_ID':'int', 'TO_JUNCTION_ID': 'int'})
+                    for where in road_wheres()], ignore_index=True)
 OGF_IDS = roads_df.OGF_ID.unique()
 # Remove tables that require specific treatment 
 for tbl in ['ORN_JUNCTION', 'ORN_BLOCKED_PASSAGE', 'ORN_TOLL_POINT', 'ORN_UNDERPASS', 'ORN_STREET_NAME_PARSED', 'ORN_ADDRESS_INFO', 'ORN_ROUTE_NAME', 'ORN_ROUTE_NUMBER', 'ORN_OFFICIAL_STREET_NAME']:
     tables.remove(tbl)
+if topology:
+    # The junction graph is built before the junction ids are dropped from the roads
+    graph = JunctionGraph(roads_df['OGF_ID'].values, roads_df['FROM_JUNCTION_ID'].values, roads_df['TO_JUNCTION_ID'].values)
+    road_element_types = roads_df['ROAD_ELEMENT_TYPE'].values
+if event_qa:
+    # Measures are checked against LENGTH before it is dropped, the flagged events go to the ORN_event_qa table (display them
+    # on the roads with Make Route Event Layer on QA_FROM / QA_TO)
+    print('Checking event measures')
+    flagged_df, qa_df = check_tables(measure_table, tables + ['ORN_ADDRESS_INFO', 'ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME'],
+                                    roads_df.drop_duplicates(subset=['OGF_ID']).set_index('OGF_ID')['LENGTH'].astype(float),
+                                    qa_tolerance, qa_gaps_allowed, qa_overlaps_allowed)
+    qa_df.to_csv(qa_report_file, index=False)
+    flagged_df.spatial.to_table(os.path.join(outGDB, 'ORN_event_qa'), overwrite= True)
+    print(f'{len(flagged_df)} event issues on {flagged_df["ORN_ROAD_NET_ELEMENT_ID"].nunique()} road elements, report written to {qa_report_file}')
 
 #Make Address Ranges on L/R
-add_rng_df = pd.DataFrame.spatial.from_table(os.path.join(ORN_GDB, 'ORN_ADDRESS_INFO')) # get full dataset
-field_prefix = 'ADDRESS_INFO'
-add_rng_df.rename(columns={'AGENCY_NAME' : field_prefix + '_AGENCY', 
-                        'EFFECTIVE_DATETIME' : field_prefix + '_EFF_DATE',
-                        'EVENT_ID' : field_prefix + '_EVENT_ID',
-                        }, 
-                        inplace= True)
-# Select only rows that are in the section currently being worked on
-add_rng_df = add_rng_df[add_rng_df['ORN_ROAD_NET_ELEMENT_ID'].isin(OGF_IDS)]
-add_rng_base = add_rng_df[['ORN_ROAD_NET_ELEMENT_ID', 
-                            field_prefix + '_AGENCY',
-                            field_prefix + '_EFF_DATE',
-                            field_prefix + '_EVENT_ID',
-                            'STREET_SIDE',
-                            'HOUSE_NUMBER_STRUCTURE']].drop_duplicates(subset=['ORN_ROAD_NET_ELEMENT_ID'],  keep='first') # Base for adding L/R attributes to the table
-
-#Merger of street nme table
-str_nme_parsed_df = pd.DataFrame.spatial.from_table(os.path.join(ORN_GDB, 'ORN_STREET_NAME_PARSED')) # ORN_STREET_NAME_PARSED table as a df
-add_rng_df = add_rng_df.merge(str_nme_parsed_df, how= 'left', left_on='FULL_STREET_NAME', right_on= 'FULL_STREET_NAME')
-
-#Loop to add address info to roads df
-print('Calculating Address Range data')
-for row in add_rng_df.itertuples():
-    index = add_rng_base.ORN_ROAD_NET_ELEMENT_ID[add_rng_base.ORN_ROAD_NET_ELEMENT_ID == row.ORN_ROAD_NET_ELEMENT_ID].index.tolist()[0]
-    Structure_CDE = {'Unknown' : -1, 'None' : 0, 'Even' : 1, 'Odd' : 2, 'Mixed' : 3, 'Irregular' : 4}
-    # Calculate Address range columns and HOUSE_NUMBER_STRUCTURE_CDE based on STREET_SIDE column value
-    if row.STREET_SIDE == 'Left':
-        add_rng_base.at[index, 'L_HOUSE_NUMBER_STRUCTURE_CDE'] = Structure_CDE[row.HOUSE_NUMBER_STRUCTURE]
-        add_rng_base.at[index, 'L_FIRST_HOUSE_NUM'] = row.FIRST_HOUSE_NUMBER
-        add_rng_base.at[index, 'L_LAST_HOUSE_NUM'] = row.LAST_HOUSE_NUMBER
-        add_rng_base.at[index, 'L_FULL_STREET_NAME'] = row.FULL_STREET_NAME
-        #STREET NAME PARSED data
-        add_rng_base.at[index, 'L_DIR_PRE'] = row.DIRECTIONAL_PREFIX
-        add_rng_base.at[index, 'L_STR_TYP_PRE'] = row.STREET_TYPE_PREFIX
-        add_rng_base.at[index, 'L_STR_NME_BDY'] = row.STREET_NAME_BODY
-        add_rng_base.at[index, 'L_STR_TYP_SUF'] = row.STREET_TYPE_SUFFIX
-        add_rng_base.at[index, 'L_DIR_SUF'] = row.DIRECTIONAL_SUFFIX
-
-    if row.STREET_SIDE == 'Right':
-        add_rng_base.at[index, 'R_HOUSE_NUMBER_STRUCTURE_CDE'] = Structure_CDE[row.HOUSE_NUMBER_STRUCTURE]
-        add_rng_base.at[index, 'R_FIRST_HOUSE_NUM'] = row.FIRST_HOUSE_NUMBER
-        add_rng_base.at[index, 'R_LAST_HOUSE_NUM'] = row.LAST_HOUSE_NUMBER
-        add_rng_base.at[index, 'R_FULL_STREET_NAME'] = row.FULL_STREET_NAME
-        #STREET NAME PARSED data
-        add_rng_base.at[index, 'R_DIR_PRE'] = row.DIRECTIONAL_PREFIX
-        add_rng_base.at[index, 'R_STR_TYP_PRE'] = row.STREET_TYPE_PREFIX
-        add_rng_base.at[index, 'R_STR_NME_BDY'] = row.STREET_NAME_BODY
-        add_rng_base.at[index, 'R_STR_TYP_SUF'] = row.STREET_TYPE_SUFFIX
-        add_rng_base.at[index, 'R_DIR_SUF'] = row.DIRECTIONAL_SUFFIX
-
-    if row.STREET_SIDE == 'Both':
-        add_rng_base.at[index, 'L_HOUSE_NUMBER_STRUCTURE_CDE'] = Structure_CDE[row.HOUSE_NUMBER_STRUCTURE]
-        add_rng_base.at[index, 'R_HOUSE_NUMBER_STRUCTURE_CDE'] = Structure_CDE[row.HOUSE_NUMBER_STRUCTURE]
-        add_rng_base.at[index, 'L_FIRST_HOUSE_NUM'] = row.FIRST_HOUSE_NUMBER
-        add_rng_base.at[index, 'L_LAST_HOUSE_NUM'] = row.LAST_HOUSE_NUMBER
-        add_rng_base.at[index, 'R_FIRST_HOUSE_NUM'] = row.FIRST_HOUSE_NUMBER
-        add_rng_base.at[index, 'R_LAST_HOUSE_NUM'] = row.LAST_HOUSE_NUMBER
-        add_rng_base.at[index, 'L_FULL_STREET_NAME'] = row.FULL_STREET_NAME
-        add_rng_base.at[index, 'R_FULL_STREET_NAME'] = row.FULL_STREET_NAME
-        #STREET NAME PARSED data
-        add_rng_base.at[index, 'L_DIR_PRE'] = row.DIRECTIONAL_PREFIX
-        add_rng_base.at[index, 'L_STR_TYP_PRE'] = row.STREET_TYPE_PREFIX
-        add_rng_base.at[index, 'L_STR_NME_BDY'] = row.STREET_NAME_BODY
-        add_rng_base.at[index, 'L_STR_TYP_SUF'] = row.STREET_TYPE_SUFFIX
-        add_rng_base.at[index, 'L_DIR_SUF'] = row.DIRECTIONAL_SUFFIX
-        add_rng_base.at[index, 'R_DIR_PRE'] = row.DIRECTIONAL_PREFIX
-        add_rng_base.at[index, 'R_STR_TYP_PRE'] = row.STREET_TYPE_PREFIX
-        add_rng_base.at[index, 'R_STR_NME_BDY'] = row.STREET_NAME_BODY
-        add_rng_base.at[index, 'R_STR_TYP_SUF'] = row.STREET_TYPE_SUFFIX
-        add_rng_base.at[index, 'R_DIR_SUF'] = row.DIRECTIONAL_SUFFIX
+add_rng_base = run_stage(checkpoints, 'address', address_table)
 
 #Merge the Address Range data to the roads data beofre looping other tables 
 roads_df = roads_df.merge(add_rng_base, how= 'left', left_on='OGF_ID', right_on= 'ORN_ROAD_NET_ELEMENT_ID')
@@ -127,126 +297,25 @@ roads_df = roads_df.drop(['OBJECTID', 'ORN_ROAD_NET_ELEMENT_ID', 'HOUSE_NUMBER_S
                         'LENGTH','STREET_SIDE', 'FROM_JUNCTION_ID', 'TO_JUNCTION_ID'], axis=1)
 
 print('Adding non address data to table')
+# Winning events are resolved on the attribute tables alone and collected here, then joined to the roads once
+events_df = pd.DataFrame(index= pd.Index(OGF_IDS, name= 'ORN_ROAD_NET_ELEMENT_ID'))
 for table in tables: #Loop for line tables
-    field_prefix = table[4:]
-    print(f'Running segmentification on: {table}')
-    tbl_df = pd.DataFrame.spatial.from_table(os.path.join(ORN_GDB, table))
-    tbl_df = tbl_df.drop(['OBJECTID'], axis=1)
-    #Rename Table fields
-    tbl_df.rename(columns={'AGENCY_NAME' : field_prefix + '_AGENCY', 
-                            'EFFECTIVE_DATETIME' : field_prefix + '_EFF_DATE',
-                            'EVENT_ID' : field_prefix + '_EVENT_ID',
-                            'NATIONAL_UUID' : field_prefix + '_NAT_UUID', 
-                            'STREET_SIDE': field_prefix + '_STREET_SIDE', 
-                            'FULL_STREET_NAME': field_prefix + '_FULL_STREET_NAME'}, 
-                            inplace= True)
+    winners = run_stage(checkpoints, f'events/{table}', lambda: table_winners(table))
+    events_df = events_df.merge(winners, how= 'left', left_index=True, right_index=True)
 
-    tbl_df[field_prefix + '_measure_dif'] = np.where(tbl_df['FROM_MEASURE'] > tbl_df['TO_MEASURE'], 
-                        tbl_df['FROM_MEASURE'] - tbl_df['TO_MEASURE'], 
-                        tbl_df['TO_MEASURE'] - tbl_df['FROM_MEASURE']) #Get the measure dif value 
-
-    print(f'Roads length: {len(roads_df)} Table Length: {len(tbl_df)}')
-    merged = roads_df.merge(tbl_df, how= 'left', left_on='OGF_ID', right_on= 'ORN_ROAD_NET_ELEMENT_ID')
-    #Sort measure dif values highest to lowest and then drop duplicate OGF_ID records from the dataframe. Leaving only the largest dif (longest seg)
-    merged.sort_values(by=[field_prefix + '_measure_dif'], ascending= True)
-    merged = merged.drop_duplicates(subset=['OGF_ID'], keep='first')
-    merged.astype({'OGF_ID' : int})
-    print('Length of dataframe: ' + str(len(merged)))
-    merged = merged.drop( [field_prefix + '_measure_dif',
-                        field_prefix + '_EVENT_ID',
-                        'FROM_MEASURE',
-                        'TO_MEASURE', 
-                        'ORN_ROAD_NET_ELEMENT_ID'],
-                         axis=1) # Removes non-essential fields
-    roads_df = merged
+print(f'Joining {len(events_df.columns)} event fields to {len(roads_df)} roads')
+roads_df = roads_df.merge(events_df, how= 'left', left_on='OGF_ID', right_index=True)
 print('Creating route name and number multi fields')
 #Route Name and Number Multifields
 for table in ['ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME']:
-    field_prefix = table[4:]
-    print(f'Running segmentification on: {table}')
-    tbl_df = pd.DataFrame.spatial.from_table(os.path.join(ORN_GDB, table))
-    tbl_df = tbl_df.drop(['OBJECTID', 'EVENT_ID', 'AGENCY_NAME'], axis=1) # Drop some excess fields
-    print(f'iterating over matches for the ORN_NET_ID in {table}')
-    for row in roads_df.itertuples():
-        ogf_id = row.OGF_ID
-        matched_df = tbl_df.loc[tbl_df['ORN_ROAD_NET_ELEMENT_ID'] == ogf_id] # df of compiled matches
-        for match_row in matched_df.itertuples():
-            fields_to_extract = {'ORN_ROUTE_NUMBER' : ['ROUTE_NUMBER'], 'ORN_ROUTE_NAME' : ['ROUTE_NAME_ENGLISH', 'ROUTE_NAME_FRENCH']}
-            count = 1           
-            if table == 'ORN_ROUTE_NUMBER':
-                roads_df[f'ROUTE_NUMBER_{count}'] = matched_df.ROUTE_NUMBER
-                count += 1            
-            if table == 'ORN_ROUTE_NAME':
-                roads_df[f'ROUTE_NAME_ENGLISH_{count}'] = matched_df.ROUTE_NAME_ENGLISH
-                roads_df[f'ROUTE_NAME_FRENCH_{count}'] = matched_df.ROUTE_NAME_FRENCH
-                count += 1
+    routes_df = run_stage(checkpoints, f'routes/{table}', lambda: table_routes(table))
+    roads_df = roads_df.merge(routes_df, how= 'left', on='OGF_ID')
+# The address and event columns get the dtypes of their source fields, so a regional run writes the same field types as a full run
+roads_df = fixed_dtypes(roads_df, output_dtypes({table : table_dtypes(ORN_GDB, table) for table in tables + ['ORN_ADDRESS_INFO']}))
 
 print('Encoding select fields from strings into NRN numeric codes')
-# Encode certain fields from the loop
-NumberizeField(roads_df, 'ACQUISITION_TECHNIQUE', 'ACQUISITION_TECHNIQUE', {'UNKNOWN' : -1,
-                                                                        'NONE' : 0,
-                                                                        'OTHER' : 1,
-                                                                        'GPS' : 2,
-                                                                        'ORTHOIMAGE' : 3,
-                                                                        'ORTHOPHOTO' : 4,
-                                                                        'VECTOR DATA' : 5,
-                                                                        'PAPER MAP' : 6,
-                                                                        'FIELD COMPLETION' : 7,
-                                                                        'RASTER DATA' : 8,
-                                                                        'DIGITAL ELEVATION MODEL' : 9,
-                                                                        'AERIAL PHOTO' : 10,
-                                                                        'RAW IMAGERY DATA' : 11,
-                                                                        'COMPUTED' : 12})
-
-NumberizeField(roads_df, 'ROAD_CLASS', 'ROAD_CLASS', {'Freeway' : 1, 
-                                                    'Expressway / Highway' : 2, 
-                                                    'Arterial' : 3, 
-                                                    'Collector' : 4,
-                                                    'Local / Street' : 5,
-                                                    'Local / Strata' : 6,
-                                                    'Local / Unknown' : 7,
-                                                    'Alleyway / Laneway' : 8,
-                                                    'Ramp' : 9,
-                                                    'Resource / Recreation' : 10,
-                                                    'Rapid Transit' : 11,
-                                                    'Service' : 12,
-                                                    'Winter' : 13})   
-
-NumberizeField(roads_df, 'STRUCTURE_TYPE', 'STRUCTURE_TYPE', {'None' : 0,
-                                                            'Bridge' : 1,
-                                                            'Bridge Covered' : 2,
-                                                            'Bridge Moveable' : 3,
-                                                            'Tunnel'  : 5,
-                                                            'Dam' : 7})
-
-NumberizeField(roads_df, 'DIRECTION_OF_TRAFFIC_FLOW', 'DIRECTION_OF_TRAFFIC_FLOW', 
-                                                        {'Unknown' : -1, 
-                                                        'Both' : 1,
-                                                        'Positive' : 2, # 'Positive' - flow of traffic same as digitizing direction (Same Direction)
-                                                        'Negative' : 3 # 'Negative' - flow of traffic different from digitizing direction (Opposite Direction)
-                                                        })
-
-NumberizeField(roads_df, 'PAVEMENT_STATUS', 'PAVEMENT_STATUS', {'Paved' : 1, 'Unpaved' : 2})
-
-NumberizeField(roads_df, 'SURFACE_TYPE', 'UNPAVED_SURFACE_TYPE', {'Unknown' : -1,
-                                                                'None' : 0,
-                                                                'Gravel' : 1,
-                                                                'Dirt' : 2})
-
-NumberizeField(roads_df, 'SURFACE_TYPE', 'PAVED_SURFACE_TYPE', {'Unknown' : -1, 
-                                                                'None' : 0,
-                                                                'Rigid' : 1, # Rigid = Summer (Same def between docs)
-                                                                'Flexible' : 2, # Flexible = Winter (Same def between docs)
-                                                                'Blocks' : 3
-                                                                })
-
-# Directional prefix and suffix encoding
-direction_cde = {'None' : 0, 'North' : 1, 'Nord' : 2, 'South' : 3, 'Sud' : 4, 'East' : 5, 'Est' : 6, 'West' : 7, 'Ouest' : 8, 'North West' : 9,
-            'Nord Ouest' : 10, 'North East' : 11, 'Nord Est' : 12, 'South West' :13, 'Sud Ouest' : 14, 'South East' : 15, 'Sud Est' : 16, 
-            'Central' : 17, 'Centre' : 18}
-
-NumberizeField(roads_df, 'L_DIR_PRE', 'L_DIR_PRE', direction_cde)
-NumberizeField(roads_df, 'L_DIR_SUF', 'L_DIR_SUF', direction_cde)
+# Categoricals are left off, the spatially enabled dataframe writes strings to the feature class
+unmapped_report(encode_layer(roads_df, 'ORN_Road_Segments', code_tables, categorize=False), 'ORN_Road_Segments')
 
 # final_field_order = ['OGF_ID', 'ROAD_ABSOLUTE_ACCURACY', 'NATIONAL_UUID', 'ROAD_ELEMENT_TYPE', 'ACQUISITION_TECHNIQUE', 'ACQUISITION_TECHNIQUE_CDE', 'CREATION_DATE', 
 # 'REVISION_DATE', 'EXIT_NUMBER', 'L_FIRST_HOUSE_NUM', 'R_FIRST_HOUSE_NUM', 'L_HOUSE_NUMBER_STRUCTURE_CDE', 'R_HOUSE_NUMBER_STRUCTURE_CDE', 
@@ -260,19 +329,60 @@ NumberizeField(roads_df, 'L_DIR_SUF', 'L_DIR_SUF', direction_cde)
 
 #Export the complete roads df
 print('Exporting compiled dataset.')
-roads_df.spatial.to_featureclass(os.path.join(directory, 'Files_for_delivery.gdb', 'ORN_Road_Segments'), overwrite= True)
+roads_df.spatial.to_featureclass(os.path.join(outGDB, 'ORN_Road_Segments'), overwrite= True)
+if nrn_export:
+    conform_nrn_products('ORN_Road_Segments', roads_df)
 #Toll Points field encoding
 print('Importing and encoding Toll Points data')
-tp_df = pd.DataFrame.spatial.from_featureclass(os.path.join(workingGDB, 'ORN_Toll_Points')) # ORN_Toll_Points created in QGIS with the linear referencing plugin
+if locate_points_from_events:
+    tp_df = locate_points('ORN_TOLL_POINT')
+else:
+    tp_df = pd.DataFrame.spatial.from_featureclass(os.path.join(workingGDB, 'ORN_Toll_Points')) # ORN_Toll_Points created in QGIS with the linear referencing plugin
 tp_df = tp_df.drop(['EVENT_ID', 'AT_MEASURE', 'lrs_err'], axis=1)
-NumberizeField(tp_df, 'TOLL_POINT', 'TOLL_PNT_TYP', {'Unknown' :-1, 'Physical' : 1, 'Virtual' : 2, 'Hybrid' : 3})
-tp_df.spatial.to_featureclass(os.path.join(directory, 'files_for_delivery.gdb', 'ORN_toll_booths'), overwrite= True)
+unmapped_report(encode_layer(tp_df, 'ORN_toll_booths', code_tables, categorize=False), 'ORN_toll_booths')
+tp_df.spatial.to_featureclass(os.path.join(outGDB, 'ORN_toll_booths'), overwrite= True)
+if nrn_export:
+    conform_nrn_products('ORN_toll_booths', tp_df)
 
 #Blocked Passages field encoding
 print('Importing and encoding Blocked Passages data')
-bp_df = pd.DataFrame.spatial.from_featureclass(os.path.join(workingGDB, 'ORN_BLocked_Passages'))
+if locate_points_from_events:
+    bp_df = locate_points('ORN_BLOCKED_PASSAGE')
+else:
+    bp_df = pd.DataFrame.spatial.from_featureclass(os.path.join(workingGDB, 'ORN_BLocked_Passages'))
 bp_df = bp_df.drop(['EVENT_ID', 'AT_MEASURE', 'lrs_err'], axis=1)
-NumberizeField(bp_df, 'BLOCKED_PA', 'BLKD_PASS_TYP', {'Unknown' : -1, 'Permanent' : 1, 'Removable' : 2})
-bp_df.spatial.to_featureclass(os.path.join(directory, 'files_for_delivery.gdb', 'ORN_blocked_passages'), overwrite= True)
+unmapped_report(encode_layer(bp_df, 'ORN_blocked_passages', code_tables, categorize=False), 'ORN_blocked_passages')
+bp_df.spatial.to_featureclass(os.path.join(outGDB, 'ORN_blocked_passages'), overwrite= True)
+if nrn_export:
+    conform_nrn_products('ORN_blocked_passages', bp_df)
+
+#Junctions from the road topology
+if topology:
+    print('Building the junction topology')
+    junction_wheres = id_wheres('JUNCTION_ID', graph.junction_ids) if region is not None else ['']
+    points_df = pd.concat([pd.DataFrame.spatial.from_featureclass(os.path.join(ORN_GDB, 'ORN_JUNCTION'), where_clause= where)[['JUNCTION_ID', 'SHAPE']]
+                        for where in junction_wheres], ignore_index=True)
+    jn_df, road_component = junction_layer(graph, points_df, road_element_types)
+    jn_df.spatial.set_geometry('SHAPE')
+    topology_report(graph, road_component)
+    unmapped_report(encode_layer(jn_df, 'ORN_junctions', code_tables, categorize=False), 'ORN_junctions')
+    jn_df.spatial.to_featureclass(os.path.join(outGDB, 'ORN_junctions'), overwrite= True)
+    if nrn_export:
+        conform_nrn_products('ORN_junctions', jn_df)
+
+#NRN products
+if nrn_export:
+    print('Writing NRN products')
+    if not arcpy.Exists(nrn_gdb):
+        arcpy.management.CreateFileGDB(os.path.dirname(nrn_gdb), os.path.basename(nrn_gdb))
+    for table, dfs in nrn_tables.items():
+        nrn_df = pd.concat(dfs, ignore_index=True)
+        if 'SHAPE' in nrn_df.columns:
+            nrn_df.spatial.to_featureclass(os.path.join(nrn_gdb, table), overwrite= True)
+        else:
+            nrn_df.spatial.to_table(os.path.join(nrn_gdb, table), overwrite= True)
+        print(f'{len(nrn_df)} rows written to NRN {table}')
 
+if layer_cache is not None:
+    layer_cache.report()
 print('DONE!')
@@ -1,14 +1,819 @@
 import os, sys
+import argparse
+import importlib.util
+import functools
+import cProfile
+import sqlite3
+import shutil, hashlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-import fiona
-def NumberizeField(df, field, outFieldName, numberize_dict):
-    # will return a new field in pandas dataframe with the field name + _CDE
-    df.insert(df.columns.get_loc(field) + 1, outFieldName + '_CDE', df[field])
-    df[outFieldName + '_CDE'] = df[field].map(numberize_dict)
-    pd.to_numeric(df[outFieldName + '_CDE'], errors= 'ignore')
-    
+import pyogrio
+import shapely
+from layer_cache import LayerCache, gdb_fingerprint
+from checkpoints import Checkpoints, scope_folder, prune, run_stage
+from prefetch import Prefetcher
+from street_names import StreetNames, add_parsed_names, parser_version
+from run_report import RunReport
+from linear_referencing import segment_lengths, locate_measures, lrs_report
+from nrn_codes import load_code_tables, encode_layer, unmapped_report
+from nrn_export import load_products, conform_product, products_for
+from gpkg_writer import GpkgWriter
+from event_qa import check_tables
+from junction_topology import JunctionGraph, junction_layer, topology_report
+from segments_core import make_backend, address_ranges, event_fields, longest_events, route_multifields, output_dtypes, fixed_dtypes
+def event_tables(gdb):
+    # Returns the ORN tables handled by the event stage, everything in the gdb except the tables and fc's that require specific
+    # treatment or are not required
+    tables = list(pyogrio.list_layers(gdb)[:, 0]) # List of everything in the gdb
+    for tbl in ['ORN_ROAD_NET_ELEMENT', 'ORN_JUNCTION', 'ORN_BLOCKED_PASSAGE', 'ORN_TOLL_POINT', 'ORN_UNDERPASS', 'ORN_STREET_NAME_PARSED', 'ORN_ADDRESS_INFO', 'ORN_ROUTE_NAME', 'ORN_ROUTE_NUMBER', 'ORN_OFFICIAL_STREET_NAME']:
+        tables.remove(tbl)
+    return tables
+
+def table_fields(gdb, layer, keep=None, drop=()):
+    # Returns the fields of a gdb table that are in keep (every field when keep is None) and not in drop, in table order
+    fields = pyogrio.read_info(gdb, layer=layer)['fields']
+    return [field for field in fields if (keep is None or field in keep) and field not in drop]
+
+@functools.lru_cache(maxsize=None)
+def table_dtypes(gdb, layer):
+    # Returns the {field : dtype} of a gdb table as pyogrio reads it
+    info = pyogrio.read_info(gdb, layer=layer)
+    return dict(zip(info['fields'], info['dtypes']))
+
+def read_table(gdb, layer, columns, where=None):
+    # Reads only the listed columns of a gdb table straight into pandas, geometry is never decoded
+    # Arrow batches are used when pyarrow is installed and where is pushed down to the driver as an attribute filter
+    return pyogrio.read_dataframe(gdb, layer=layer, columns=columns, read_geometry=False, where=where, use_arrow=use_arrow)
+
+def table_columns(gdb, layer):
+    # Returns the columns the pipeline reads from an ORN table
+    if layer == 'ORN_ADDRESS_INFO':
+        return address_fields
+    if layer == 'ORN_STREET_NAME_PARSED':
+        return parsed_fields
+    if layer in route_fields:
+        return table_fields(gdb, layer, keep=event_key_fields + route_fields[layer])
+    return table_fields(gdb, layer, keep=event_keep_fields, drop=event_drop_fields)
+
+@functools.lru_cache(maxsize=None)
+def open_layer_cache():
+    # Returns the LayerCache of this process, or None when use_layer_cache is off
+    return LayerCache(layer_cache_dir, 'gpd') if use_layer_cache else None
+
+@functools.lru_cache(maxsize=None)
+def open_backend():
+    # Returns the backend of this process that picks the address, event and route rows (see segments_core.py)
+    return make_backend(backend, **({'threads' : duckdb_threads, 'memory_limit' : duckdb_memory_limit, 'temp_directory' : duckdb_temp_dir} if backend == 'duckdb' else {}))
+
+@functools.lru_cache(maxsize=None)
+def checkpoint_folder():
+    # Returns the checkpoint folder of the roads this run covers (the road layer and the region), so a regional run never
+    # touches the checkpoints of a full run or of another region
+    return scope_folder(checkpoint_dir, repr([os.path.abspath(road_gdb), road_layer, region_bbox, region_polygon, region_polygon_layer,
+                                            region_jurisdictions, region_ogf_ids]))
+
+fingerprint = functools.lru_cache(maxsize=None)(gdb_fingerprint) # each gdb is fingerprinted once per run
+
+def stage_key(name):
+    # Returns the key of a stage checkpoint: fingerprints of the gdbs the stage reads and the settings it uses. Settings a
+    # stage doesn't use stay out of its key, changing the QA tolerance only rebuilds the QA
+    orn, roads = fingerprint(ORN_GDB), fingerprint(road_gdb)
+    points = [orn, roads, measure_length_field, locate_points_from_events, lrs_tolerance, code_tables] + ([] if locate_points_from_events else [fingerprint(workingGDB)])
+    keys = {'roads' : [roads],
+            'address' : [orn, code_tables, parser_version],
+            'events' : [orn, segmentation, field_map_only],
+            'routes' : [orn, route_field_cap],
+            'element_hashes' : [orn, roads],
+            'ORN_Road_Segments' : [segmentation, min_span_length, measure_length_field, field_map_only, code_tables],
+            'ORN_toll_booths' : points,
+            'ORN_blocked_passages' : points,
+            'ORN_junctions' : [orn, roads, code_tables],
+            'ORN_event_qa' : [orn, roads, measure_length_field, qa_tolerance, qa_gaps_allowed, qa_overlaps_allowed]}
+    return hashlib.sha1(repr(keys[name.split('/')[0]]).encode()).hexdigest()[:16]
+
+def open_checkpoints(chain):
+    # Returns the Checkpoints of a chain of stages ('run' or a partition of the roads), None when checkpoint is off
+    if not checkpoint:
+        return None
+    return Checkpoints(os.path.join(checkpoint_folder(), 'run' if chain == 'run' else 'partition_' + hashlib.sha1(chain.encode()).hexdigest()[:12]),
+                    rerun_stages, stage_key)
+
+def segments_version(rerun=()):
+    # Returns a version of the segmented roads, a digest of the checkpoints of the partitions of this run, or None when a
+    # partition stage is in rerun (the segmented roads are then built again)
+    partitions = [Checkpoints(open_checkpoints(partition_chain(**job)).folder) for job in partition_jobs()]
+    if any(stage in partition.manifest['stages'] for partition in partitions for stage in rerun):
+        return None
+    return hashlib.sha1(''.join(partition.digest() for partition in partitions).encode()).hexdigest()[:16]
+
+class GdbTables:
+    # Reads ORN tables from the gdb (or the layer cache) as the stages ask for them, pushing the ORN_ROAD_NET_ELEMENT_ID range
+    # and the road elements of the region down into the read
+    def __init__(self, gdb):
+        self.gdb = gdb
+
+    def read(self, layer, id_range=None, columns=None):
+        columns = columns or table_columns(self.gdb, layer)
+        ids = region_ids() if 'ORN_ROAD_NET_ELEMENT_ID' in columns else None
+        if ids is not None and id_range is not None:
+            ids = ids[(ids >= id_range[0]) & (ids <= id_range[1])]
+        cache = open_layer_cache()
+        if cache is not None:
+            filters = None
+            if ids is not None:
+                filters = [('ORN_ROAD_NET_ELEMENT_ID', 'in', ids.tolist())]
+            elif id_range is not None:
+                filters = [('ORN_ROAD_NET_ELEMENT_ID', '>=', id_range[0]), ('ORN_ROAD_NET_ELEMENT_ID', '<=', id_range[1])]
+            return cache.read(self.gdb, layer, lambda: read_table(self.gdb, layer, columns), columns, filters)
+        where = None
+        if ids is not None:
+            where = id_where('ORN_ROAD_NET_ELEMENT_ID', ids)
+        elif id_range is not None:
+            where = f'ORN_ROAD_NET_ELEMENT_ID >= {id_range[0]} AND ORN_ROAD_NET_ELEMENT_ID <= {id_range[1]}'
+        tbl_df = read_table(self.gdb, layer, columns, where)
+        return tbl_df if ids is None else tbl_df[tbl_df['ORN_ROAD_NET_ELEMENT_ID'].isin(ids)]
+
+class IndexedTables:
+    # Holds ORN tables in memory sorted on ORN_ROAD_NET_ELEMENT_ID so the rows of a range of road elements are a slice found
+    # with a binary search. The sort is stable so events keep their table order within an element. Tables without
+    # ORN_ROAD_NET_ELEMENT_ID (ORN_STREET_NAME_PARSED) are returned whole. The next tables are read ahead while one is sorted
+    def __init__(self, gdb, layers):
+        self.tables = {}
+        source = GdbTables(gdb)
+        with Prefetcher(source.read, layers, prefetch_depth) as prefetch:
+            for layer in layers:
+                tbl_df = prefetch.get(layer)
+                if 'ORN_ROAD_NET_ELEMENT_ID' in tbl_df.columns:
+                    tbl_df = tbl_df.sort_values(by=['ORN_ROAD_NET_ELEMENT_ID'], kind='stable', ignore_index=True)
+                self.tables[layer] = tbl_df
+        prefetch_report(prefetch)
+
+    def read(self, layer, id_range=None):
+        tbl_df = self.tables[layer]
+        if id_range is not None and 'ORN_ROAD_NET_ELEMENT_ID' in tbl_df.columns:
+            ids = tbl_df['ORN_ROAD_NET_ELEMENT_ID'].values
+            tbl_df = tbl_df.iloc[np.searchsorted(ids, id_range[0], 'left'):np.searchsorted(ids, id_range[1], 'right')]
+        return tbl_df.copy()
+
+class PrefetchTables:
+    # Reads ahead, in threads (prefetch.py), the tables the stages of a partition will ask source for next while the current
+    # one is resolved and joined. reads lists them as (layer, id_range) in the order the stages read them
+    def __init__(self, source, reads):
+        self.prefetch = Prefetcher(lambda read: source.read(*read), reads, prefetch_depth)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.prefetch.close()
+        prefetch_report(self.prefetch)
+
+    def read(self, layer, id_range=None):
+        return self.prefetch.get((layer, id_range))
+
+def prefetch_report(prefetch):
+    # Prints how much of the table read time was hidden behind the work on earlier tables and adds it to the run report
+    if prefetch.reads == 0:
+        return
+    print(f'Read {prefetch.reads} tables in {prefetch.read_seconds:.2f}s, {prefetch.hidden_seconds():.2f}s of it hidden by reading ahead')
+    run_report.count('read_ms', prefetch.read_seconds * 1000)
+    run_report.count('read_wait_ms', prefetch.wait_seconds * 1000)
+    run_report.count('read_hidden_ms', prefetch.hidden_seconds() * 1000)
+
+def stage_reads(tables, id_range, checkpoints):
+    # Returns the table reads of the address, event and route stages of a partition as (layer, id_range), in the order the
+    # stages make them and leaving out the stages that will be resumed from their checkpoint
+    stages = [('address', 'ORN_ADDRESS_INFO')] + [(f'events/{table}', table) for table in tables]
+    stages += [(f'routes/{table}', table) for table in ['ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME']]
+    return [(layer, id_range) for name, layer in stages
+            if checkpoints is None or not checkpoints.valid(name, {'roads' : checkpoints.version('roads')})]
+
+def field_map_fields(yaml_paths):
+    # Returns the source field names referenced by the conform mappings of the NRN YAML configs, with the _CDE suffix also
+    # stripped so that the string field feeding an encoded field is kept
+    import yaml
+    fields = set()
+    for path in yaml_paths:
+        with open(path) as config:
+            conform = yaml.safe_load(config).get('conform') or {}
+        for mapping in conform.values():
+            for field in (mapping or {}).values():
+                if isinstance(field, str):
+                    fields.update([field, field[:-4] if field.endswith('_CDE') else field])
+    return fields
+
+def id_where(field, ids):
+    # Returns an attribute filter on field for a sorted array of ids. Up to max_in_list ids go in as an IN list, more as
+    # their range since the driver tests an IN list value by value, the rows are narrowed down to the ids after the read
+    if len(ids) == 0:
+        return '1 = 0'
+    if len(ids) <= max_in_list:
+        return f'{field} IN ({", ".join(str(i) for i in ids)})'
+    return f'{field} >= {ids[0]} AND {field} <= {ids[-1]}'
+
+@functools.lru_cache(maxsize=None)
+def region_mask():
+    # Returns the spatial filter of the region in the road CRS: the union of the region_polygon polygons, clipped to region_bbox
+    # when both are given, or None when the region has no spatial filter
+    if region_polygon is None:
+        return None if region_bbox is None else shapely.box(*region_bbox)
+    polygons_df = pyogrio.read_dataframe(region_polygon, layer=region_polygon_layer)
+    if polygons_df.crs is not None:
+        polygons_df = polygons_df.to_crs(pyogrio.read_info(road_gdb, layer=road_layer)['crs'])
+    mask = shapely.union_all(polygons_df.geometry.values)
+    return mask if region_bbox is None else shapely.intersection(mask, shapely.box(*region_bbox))
+
+def spatial_filter(tile=None):
+    # Returns the bbox / mask arguments of a road read for a tile and the region, so the driver's spatial index skips the
+    # roads outside both. The mask keeps the roads crossing the region, not just their extent
+    mask = region_mask()
+    tile = None if tile == unplaced_tile else tile
+    if mask is None:
+        return {'bbox' : tile}
+    return {'mask' : mask if tile is None else shapely.intersection(mask, shapely.box(*tile))}
+
+@functools.lru_cache(maxsize=None)
+def region_ids():
+    # Returns the sorted OGF_IDs of the roads in the region, the roads meeting every filter given (region_bbox, region_polygon,
+    # region_jurisdictions, region_ogf_ids), or None when no filter is given and the run covers every road
+    # The spatial filters go down to the road read and the jurisdictions to the ORN_JURISDICTION read
+    if region_mask() is None and region_jurisdictions is None and region_ogf_ids is None:
+        return None
+    where = id_where('OGF_ID', np.unique(region_ogf_ids)) if region_ogf_ids is not None else None
+    ids = pyogrio.read_dataframe(road_gdb, layer=road_layer, columns=['OGF_ID'], read_geometry=False, where=where, **spatial_filter())['OGF_ID']
+    ids = np.unique(ids.dropna().values).astype(np.int64)
+    if region_ogf_ids is not None:
+        ids = np.intersect1d(ids, region_ogf_ids)
+    if region_jurisdictions is not None:
+        names = ', '.join("'" + str(name).replace("'", "''") + "'" for name in region_jurisdictions)
+        # The driver only filters on fields that are read
+        jurisdiction_df = read_table(ORN_GDB, 'ORN_JURISDICTION', ['ORN_ROAD_NET_ELEMENT_ID', 'JURISDICTION'], where=f'JURISDICTION IN ({names})')
+        ids = np.intersect1d(ids, jurisdiction_df['ORN_ROAD_NET_ELEMENT_ID'].dropna().values)
+    print(f'{len(ids)} road elements in the region')
+    return ids
+
+def read_roads(where=None, tile=None):
+    # Reads the road elements, optionally filtered by an attribute where clause or to a spatial tile (xmin, ymin, xmax, ymax)
+    # A road belongs to the tile its first vertex falls in (half open on the max edges) so that each road is in exactly one tile,
+    # roads without a vertex (null or empty geometry) belong to unplaced_tile. Only the roads of the region are read when one is given. Unfiltered reads go through the layer cache
+    cache = open_layer_cache()
+    region = region_ids()
+    if cache is not None and where is None and tile is None and region is None:
+        return cache.read(road_gdb, road_layer, lambda: pyogrio.read_dataframe(road_gdb, layer=road_layer, use_arrow=use_arrow), geometry=True)
+    if region is not None:
+        where = ' AND '.join(f'({clause})' for clause in [where, id_where('OGF_ID', region)] if clause)
+    roads_df = pyogrio.read_dataframe(road_gdb, layer=road_layer, where=where, use_arrow=use_arrow, **spatial_filter(tile))
+    if tile is not None:
+        coords, index = shapely.get_coordinates(roads_df.geometry.values, return_index=True)
+        rows, first = np.unique(index, return_index=True)
+        start = np.full((len(roads_df), 2), np.nan)
+        start[rows] = coords[first]
+        if tile == unplaced_tile:
+            in_tile = np.isnan(start[:, 0])
+        else:
+            in_tile = (start[:, 0] >= tile[0]) & (start[:, 0] < tile[2]) & (start[:, 1] >= tile[1]) & (start[:, 1] < tile[3])
+        roads_df = roads_df[in_tile]
+    if region is not None:
+        roads_df = roads_df[roads_df['OGF_ID'].isin(region)]
+    return roads_df
+
+def ogf_id_partitions(count=None, size=None):
+    # Splits the road elements into count OGF_ID ranges holding about the same number of roads (or ranges of size roads),
+    # in OGF_ID order and returned as where clauses. Roads without an OGF_ID get a partition of their own. Only the roads of
+    # the region are split when one is given
+    ids, unnumbered = region_ids(), False
+    if ids is None:
+        ids = pyogrio.read_dataframe(road_gdb, layer=road_layer, columns=['OGF_ID'], read_geometry=False)['OGF_ID']
+        unnumbered = ids.isna().any()
+        ids = np.unique(ids.dropna())
+    if size is not None:
+        count = max(int(np.ceil(len(ids) / size)), 1)
+    starts = [chunk[0] for chunk in np.array_split(ids, count) if len(chunk)]
+    wheres = [f'OGF_ID >= {lo}' + (f' AND OGF_ID < {hi}' if hi is not None else '') for lo, hi in zip(starts, starts[1:] + [None])]
+    return wheres + ['OGF_ID IS NULL'] * unnumbered
+
+def tile_partitions(count):
+    # Splits the extent of the road elements into a grid of at least count tiles. The extent is padded a little since the
+    # layer extent stored in the gdb can be rounded inside the outermost vertices. The last tile, unplaced_tile, holds the roads
+    # without a vertex to place them by
+    xmin, ymin, xmax, ymax = pyogrio.read_info(road_gdb, layer=road_layer, force_total_bounds=True)['total_bounds']
+    pad = max(xmax - xmin, ymax - ymin, 1) * 0.001
+    side = int(np.ceil(np.sqrt(count)))
+    xs = np.linspace(xmin - pad, xmax + pad, side + 1)
+    ys = np.linspace(ymin - pad, ymax + pad, side + 1)
+    return [(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(side) for j in range(side)] + [unplaced_tile]
+
+def add_address_ranges(roads_df, source, id_range=None, checkpoints=None):
+    # Address stage, joins the L/R address ranges built from ORN_ADDRESS_INFO and ORN_STREET_NAME_PARSED to the roads
+    OGF_IDS = roads_df.OGF_ID.unique()
+    add_rng_base = run_stage(checkpoints, 'address', lambda: address_table(OGF_IDS, source, id_range), after=['roads'])
+
+    #Merge the Address Range data to the roads data beofre looping other tables 
+    roads_df = roads_df.merge(add_rng_base, how= 'left', left_on='OGF_ID', right_on= 'ORN_ROAD_NET_ELEMENT_ID')
+    return roads_df.drop(['ORN_ROAD_NET_ELEMENT_ID', 'HOUSE_NUMBER_STRUCTURE', 
+                        'STREET_SIDE', 'FROM_JUNCTION_ID', 'TO_JUNCTION_ID'], axis=1) # LENGTH is dropped once the event stage is done
+
+def address_table(OGF_IDS, source, id_range=None):
+    # Returns the address ranges of the road elements OGF_IDS, one row per element with its L_ and R_ fields
+    add_rng_df = source.read('ORN_ADDRESS_INFO', id_range)
+    field_prefix = 'ADDRESS_INFO'
+    add_rng_df.rename(columns={'AGENCY_NAME' : field_prefix + '_AGENCY', 
+                            'EFFECTIVE_DATETIME' : field_prefix + '_EFF_DATE',
+                            'EVENT_ID' : field_prefix + '_EVENT_ID',
+                            }, 
+                            inplace= True)
+    # Select only rows that are in the section currently being worked on
+    add_rng_df = add_rng_df[add_rng_df['ORN_ROAD_NET_ELEMENT_ID'].isin(OGF_IDS)]
+    add_rng_base = add_rng_df[['ORN_ROAD_NET_ELEMENT_ID', 
+                                field_prefix + '_AGENCY',
+                                field_prefix + '_EFF_DATE',
+                                field_prefix + '_EVENT_ID',
+                                'STREET_SIDE',
+                                'HOUSE_NUMBER_STRUCTURE']].drop_duplicates(subset=['ORN_ROAD_NET_ELEMENT_ID'],  keep='first') # Base for adding L/R attributes to the table
+    run_report.dropped(len(add_rng_df) - len(add_rng_base))
+
+    #Parsed street names, looked up in ORN_STREET_NAME_PARSED or parsed
+    add_rng_df = add_parsed_names(add_rng_df, open_street_names(ORN_GDB), run_report)
+
+    #Pivot address info onto L/R columns
+    print('Calculating Address Range data')
+    return address_ranges(add_rng_df, add_rng_base, code_tables, run_report, open_backend())
+
+@functools.lru_cache(maxsize=None)
+def open_street_names(gdb):
+    # Returns the StreetNames of a gdb in this process, ORN_STREET_NAME_PARSED is read once and the names parsed are memoized
+    # across partitions
+    return StreetNames(GdbTables(gdb).read('ORN_STREET_NAME_PARSED'), code_tables['codes']['direction'], street_name_cache_dir)
+
+def add_events(roads_df, tables, source, id_range=None, checkpoints=None):
+    # Event stage, joins the longest event of every table in tables to the roads
+    OGF_IDS = roads_df.OGF_ID.unique()
+    print('Adding non address data to table')
+    # Winning events are resolved on the attribute tables alone and collected here, then joined to the roads once
+    events_df = pd.DataFrame(index= pd.Index(OGF_IDS, name= 'ORN_ROAD_NET_ELEMENT_ID'))
+    for table in tables: #Loop for line tables
+        with run_report.stage(table) as stage:
+            winners = run_stage(checkpoints, f'events/{table}', lambda: table_winners(table, OGF_IDS, source, id_range, stage), after=['roads'])
+            events_df = events_df.merge(winners, how= 'left', left_index=True, right_index=True)
+
+    print(f'Joining {len(events_df.columns)} event fields to {len(roads_df)} roads')
+    return roads_df.merge(events_df, how= 'left', left_on='OGF_ID', right_index=True)
+
+def table_events(table, OGF_IDS, source, id_range):
+    # Returns the events of a table on the road elements OGF_IDS, with the fields every table shares renamed
+    tbl_df = event_fields(source.read(table, id_range), table[4:])
+    return tbl_df[tbl_df['ORN_ROAD_NET_ELEMENT_ID'].isin(OGF_IDS)]
+
+def table_winners(table, OGF_IDS, source, id_range, stage):
+    # Returns the longest event of every road element in OGF_IDS from an event table, indexed on ORN_ROAD_NET_ELEMENT_ID
+    print(f'Running segmentification on: {table}')
+    tbl_df = table_events(table, OGF_IDS, source, id_range)
+    #Keep only the event with the largest measure dif (longest seg) for each road element
+    winners = longest_events(tbl_df, table[4:], open_backend())
+    print(f'Table Length: {len(tbl_df)} Road elements with events: {len(winners)}')
+    stage.update(rows_in= len(tbl_df), rows_out= len(winners), dropped= len(tbl_df) - len(winners))
+    return winners
+
+def event_spans(lengths, event_dfs):
+    # Merges the SPAN_FROM / SPAN_TO breakpoints of all the event tables with the ends of each road element in one sorted sweep
+    # and returns the spans between consecutive breakpoints (OGF_ID, FROM_MEASURE, TO_MEASURE). Breakpoints closer than
+    # min_span_length to the breakpoint before them or to the end of the element are dropped. Elements without a usable
+    # length get a single span
+    breaks = [pd.DataFrame({'OGF_ID' : lengths.index, 'MEASURE' : 0.0}), pd.DataFrame({'OGF_ID' : lengths.index, 'MEASURE' : lengths.values})]
+    for tbl_df in event_dfs.values():
+        for field in ['SPAN_FROM', 'SPAN_TO']:
+            breaks.append(pd.DataFrame({'OGF_ID' : tbl_df['ORN_ROAD_NET_ELEMENT_ID'].values, 'MEASURE' : tbl_df[field].values}))
+    breaks = pd.concat(breaks, ignore_index=True).dropna().drop_duplicates().sort_values(by=['OGF_ID', 'MEASURE'], ignore_index=True)
+    length = lengths.reindex(breaks['OGF_ID']).values
+    first = breaks['OGF_ID'].ne(breaks['OGF_ID'].shift()).values
+    gap = breaks['MEASURE'].diff().values
+    keep = first | (breaks['MEASURE'].values == length) | ((gap >= min_span_length) & (length - breaks['MEASURE'].values >= min_span_length))
+    breaks = breaks[keep]
+    spans = pd.DataFrame({'OGF_ID' : breaks['OGF_ID'].values, 'FROM_MEASURE' : breaks['MEASURE'].values,
+                        'TO_MEASURE' : breaks.groupby('OGF_ID')['MEASURE'].shift(-1).values})
+    spans = spans.dropna(subset=['TO_MEASURE'])
+    missing = lengths.index.difference(spans['OGF_ID'])
+    missing_spans = pd.DataFrame({'OGF_ID' : missing, 'FROM_MEASURE' : 0.0, 'TO_MEASURE' : lengths.reindex(missing).values})
+    return pd.concat([spans, missing_spans], ignore_index=True).sort_values(by=['OGF_ID', 'FROM_MEASURE'], kind='stable', ignore_index=True)
+
+def line_substrings(geometries, starts, ends, geographic):
+    # Cuts each line between the starts and ends fractions of its length (one geometry per cut) with array operations over
+    # all the vertices at once: vertices strictly inside a cut are copied and its end points interpolated on the segments
+    # they fall on. On geographic coordinates lengths are measured in metres (equirectangular) so the fractions follow
+    # LENGTH. Returns MultiLineStrings, the parts of multi part roads are cut separately and stay separate
+    if len(geometries) == 0:
+        return np.full(0, None, dtype=object)
+    parts, owner = shapely.get_parts(geometries, return_index=True)
+    coords, vertex_part = shapely.get_coordinates(parts, return_index=True)
+    # Distances are summed part by part so a road is cut the same way whatever else is in the batch
+    local = pd.Series(segment_lengths(coords, vertex_part, geographic)).groupby(vertex_part).cumsum().values
+    part_first = np.searchsorted(vertex_part, np.arange(len(parts)))
+    part_last = np.append(part_first[1:], len(coords)) - 1
+    part_length = local[part_last]
+    part_offset = pd.Series(part_length).groupby(owner).cumsum().values - part_length # from the start of the geometry to the part
+    total = np.bincount(owner, weights=part_length, minlength=len(geometries))
+    cut_from = np.clip(starts[owner] * total[owner] - part_offset, 0, part_length)
+    cut_to = np.clip(ends[owner] * total[owner] - part_offset, 0, part_length)
+    pieces = np.flatnonzero(cut_to > cut_from)
+    # Vertices are found with one search over all parts laid end to end, each part starting 1 past the end of the one before
+    part_start = np.cumsum(part_length + 1) - (part_length + 1)
+    key = local + part_start[vertex_part]
+    lo, hi = cut_from[pieces], cut_to[pieces]
+    after_lo = np.searchsorted(key, part_start[pieces] + lo, 'right')
+    from_hi = np.searchsorted(key, part_start[pieces] + hi, 'left')
+    def interpolate(i, at):
+        # Points at distance at along the part on the segments ending at vertices i
+        span = local[i] - local[i - 1]
+        t = np.where(span > 0, (at - local[i - 1]) / np.where(span > 0, span, 1), 0)[:, None]
+        return coords[i - 1] + t * (coords[i] - coords[i - 1])
+    counts = from_hi - after_lo + 2
+    piece_of = np.repeat(np.arange(len(pieces)), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    out = coords[np.clip(after_lo[piece_of] + position - 1, 0, len(coords) - 1)]
+    out[position == 0] = interpolate(after_lo, lo)
+    out[position == counts[piece_of] - 1] = interpolate(from_hi, hi)
+    lines = shapely.linestrings(out, indices=piece_of)
+    cut_owner = owner[pieces]
+    result = np.full(len(geometries), None, dtype=object)
+    has_cut, dense = np.unique(cut_owner, return_inverse=True)
+    if len(lines):
+        result[has_cut] = shapely.multilinestrings(lines, indices=dense)
+    return result
+
+def add_event_spans(roads_df, tables, source, id_range=None, checkpoints=None):
+    # Dynamic segmentation event stage, splits every road element at the FROM/TO_MEASURE breakpoints of all the event tables
+    # and gives each span the attributes of the event covering it in each table (the longest event where events overlap)
+    # Neighbouring spans left with the same attributes are merged again, so each row is one homogeneous stretch of road
+    # Measures are clipped to measure_length_field (the furthest event measure on elements without a length), events without
+    # measures cover the whole element. The event rows of the roads are checkpointed per table, the spans are rebuilt from them
+    OGF_IDS = roads_df.OGF_ID.unique()
+    print('Splitting roads at event breakpoints')
+    event_dfs = {}
+    for table in tables:
+        with run_report.stage(table) as stage:
+            print(f'Running segmentification on: {table}')
+            event_dfs[table] = run_stage(checkpoints, f'events/{table}', lambda: table_events(table, OGF_IDS, source, id_range), after=['roads'])
+            stage['rows_in'] = len(event_dfs[table])
+    lengths = roads_df.drop_duplicates(subset=['OGF_ID']).set_index('OGF_ID')[measure_length_field].astype(float)
+    measures = [pd.concat([tbl_df[field] for field in ['FROM_MEASURE', 'TO_MEASURE'] if field in tbl_df.columns]).groupby(
+                    pd.concat([tbl_df['ORN_ROAD_NET_ELEMENT_ID'] for field in ['FROM_MEASURE', 'TO_MEASURE'] if field in tbl_df.columns])).max()
+                for tbl_df in event_dfs.values() if {'FROM_MEASURE', 'TO_MEASURE'} & set(tbl_df.columns)]
+    if measures:
+        lengths = lengths.fillna(pd.concat(measures).groupby(level=0).max())
+    lengths = lengths.fillna(0)
+    for table, tbl_df in event_dfs.items():
+        length = lengths.reindex(tbl_df['ORN_ROAD_NET_ELEMENT_ID']).values
+        start = tbl_df['FROM_MEASURE'].fillna(0).values if 'FROM_MEASURE' in tbl_df.columns else np.zeros(len(tbl_df))
+        end = tbl_df['TO_MEASURE'].fillna(pd.Series(length, index=tbl_df.index)).values if 'TO_MEASURE' in tbl_df.columns else length
+        tbl_df = tbl_df.assign(SPAN_FROM= np.clip(np.minimum(start, end), 0, length), SPAN_TO= np.clip(np.maximum(start, end), 0, length))
+        event_dfs[table] = tbl_df.drop([table[4:] + '_EVENT_ID', 'FROM_MEASURE', 'TO_MEASURE'], axis=1, errors='ignore')
+
+    spans = event_spans(lengths, event_dfs)
+    spans['MID'] = (spans['FROM_MEASURE'] + spans['TO_MEASURE']) / 2
+    spans.index.name = 'SPAN'
+    attributes = []
+    for table, tbl_df in event_dfs.items():
+        # Pair each span with the events of its element that cover the middle of the span and keep the longest. Zero length
+        # events only cover zero length spans (elements without a length) at the same measure
+        fields = [field for field in tbl_df.columns if field not in ['ORN_ROAD_NET_ELEMENT_ID', 'SPAN_FROM', 'SPAN_TO']]
+        pairs = spans[['OGF_ID', 'MID', 'FROM_MEASURE', 'TO_MEASURE']].reset_index().merge(tbl_df, left_on='OGF_ID', right_on='ORN_ROAD_NET_ELEMENT_ID')
+        covers = (pairs['SPAN_FROM'] <= pairs['MID']) & (pairs['MID'] < pairs['SPAN_TO'])
+        point = (pairs['FROM_MEASURE'] == pairs['TO_MEASURE']) & (pairs['SPAN_FROM'] <= pairs['MID']) & (pairs['MID'] <= pairs['SPAN_TO'])
+        pairs = pairs[covers | point]
+        pairs = pairs.assign(event_length= pairs['SPAN_TO'] - pairs['SPAN_FROM'])
+        pairs = pairs.sort_values(by=['SPAN', 'event_length'], ascending=[True, False], kind='stable').drop_duplicates(subset=['SPAN'])
+        attributes.append(pairs.set_index('SPAN')[fields])
+    spans = pd.concat([spans.drop('MID', axis=1)] + attributes, axis=1)
+    # Merge neighbouring spans of an element whose attributes are all the same
+    fields = [field for attributes_df in attributes for field in attributes_df.columns]
+    row_hash = pd.util.hash_pandas_object(spans[fields], index=False).values if fields else np.zeros(len(spans), dtype='uint64')
+    new_span = spans['OGF_ID'].ne(spans['OGF_ID'].shift()).values | (row_hash != np.roll(row_hash, 1))
+    group = np.cumsum(new_span)
+    span_ends = spans.groupby(group)['TO_MEASURE'].max().values
+    spans = spans[new_span].assign(TO_MEASURE= span_ends).reset_index(drop=True)
+    print(f'{len(roads_df)} roads split into {len(spans)} segments')
+    run_report.count('segments', len(spans))
+
+    roads_df = roads_df.merge(spans, how= 'left', on='OGF_ID')
+    length = roads_df[measure_length_field].astype(float).values
+    whole = ~(length > 0) | ((roads_df['FROM_MEASURE'].values <= 0) & (roads_df['TO_MEASURE'].values >= length))
+    geometries = np.asarray(roads_df.geometry.values, dtype=object)
+    cuts = line_substrings(geometries[~whole], roads_df['FROM_MEASURE'].values[~whole] / length[~whole],
+                        roads_df['TO_MEASURE'].values[~whole] / length[~whole], roads_df.crs is not None and roads_df.crs.is_geographic)
+    geometries[~whole] = np.where(pd.isna(cuts), geometries[~whole], cuts) # lines without a length can't be cut and are kept whole
+    return roads_df.set_geometry(gpd.GeoSeries(geometries, index=roads_df.index, crs=roads_df.crs))
+
+def add_routes(roads_df, source, id_range=None, checkpoints=None):
+    # Route stage, adds the ROUTE_NUMBER_n and ROUTE_NAME_ENGLISH/FRENCH_n multi fields
+    print('Creating route name and number multi fields')
+    for table in ['ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME']:
+        with run_report.stage(table) as stage:
+            routes_df = run_stage(checkpoints, f'routes/{table}', lambda: table_routes(table, roads_df[['OGF_ID']].drop_duplicates(), source, id_range, stage),
+                                after=['roads'])
+            roads_df = roads_df.merge(routes_df, how= 'left', on='OGF_ID')
+    return roads_df
+
+def table_routes(table, ids_df, source, id_range, stage):
+    # Returns the route multi fields of the road elements in ids_df (OGF_ID) from a route table, one row per element
+    print(f'Running segmentification on: {table}')
+    tbl_df = source.read(table, id_range)
+    stage['rows_in'] = len(tbl_df)
+    return route_multifields(ids_df, tbl_df, route_fields[table], route_field_cap[table], run_report, open_backend())
+
+@functools.lru_cache(maxsize=None)
+def whole_roads():
+    # Returns every road element of the run (those of the region in a regional run), read once for the point, junction and QA
+    # stages and only when one of them isn't resumed from its checkpoint
+    return read_roads()
+
+def point_layer(table, qgis_layer, layer):
+    # Returns the encoded point layer of an ORN point event table, located on the roads by AT_MEASURE or read from the layer
+    # made in QGIS with the linear referencing plugin
+    if locate_points_from_events:
+        points_df = locate_points(table, whole_roads())
+        points_df = points_df[points_df['lrs_err'] == '']
+    else:
+        points_df = gpd.read_file(workingGDB, layer= qgis_layer)
+    points_df = points_df.drop(['EVENT_ID', 'AT_MEASURE', 'lrs_err'], axis=1)
+    unmapped = encode_layer(points_df, layer, code_tables)
+    unmapped_report(unmapped, layer)
+    return points_df
+
+def locate_points(table, roads_df=None):
+    # Builds the point layer of an ORN point event table (ORN_TOLL_POINT, ORN_BLOCKED_PASSAGE) by locating every AT_MEASURE along
+    # its road element, in place of the layers made in QGIS with the linear referencing plugin. Fields keep the 10 character
+    # names the plugin gave them (TOLL_POINT, BLOCKED_PA, ...) and lrs_err says why an event could not be located
+    events_df = GdbTables(ORN_GDB).read(table, columns=table_fields(ORN_GDB, table, drop=['OBJECTID']))
+    if roads_df is None:
+        roads_df = read_roads()
+    roads_df = roads_df[roads_df['OGF_ID'].notna()] # no event is on a road without an OGF_ID, and its vertices can't be told apart as one route
+    parts, owner = shapely.get_parts(roads_df.geometry.values, return_index=True)
+    coords, vertex_part = shapely.get_coordinates(parts, return_index=True)
+    road_ids = roads_df['OGF_ID'].values
+    xy, lrs_err = locate_measures(road_ids[owner[vertex_part]], vertex_part, coords, roads_df.set_index('OGF_ID')[measure_length_field],
+                                events_df['ORN_ROAD_NET_ELEMENT_ID'].values, events_df['AT_MEASURE'].values,
+                                roads_df.crs is not None and roads_df.crs.is_geographic, lrs_tolerance)
+    lrs_report(lrs_err, table)
+    run_report.count('lrs_errors', (lrs_err != '').sum())
+    events_df = events_df.rename(columns={field : field[:10] for field in events_df.columns})
+    events_df['lrs_err'] = lrs_err
+    return gpd.GeoDataFrame(events_df, geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs=roads_df.crs)
+
+def segment_partition(tables, road_where=None, tile=None, source=None):
+    # Runs the address, event and route stages over one partition of the road elements (an OGF_ID range or a spatial tile)
+    # The OGF_ID range of the partition is pushed down into every table read. Tables come from the gdb unless a source
+    # such as IndexedTables is given
+    # Each stage is recorded in the run report, the address, event and route joins must keep one row per road
+    # With checkpoint on every stage output is checkpointed under the partition, so a rerun loads what is already done
+    # Tables read from the gdb are read ahead of the stages (prefetch_depth). The address and event columns are cast to the
+    # dtypes of their source fields (output_dtypes) so the schema doesn't depend on the roads of the partition or region
+    source = source or GdbTables(ORN_GDB)
+    checkpoints = open_checkpoints(partition_chain(road_where, tile))
+    with run_report.stage('partition', partition= str(road_where or tile or 'all roads')[:100]) as partition:
+        with run_report.stage('read_roads') as stage:
+            roads_df = run_stage(checkpoints, 'roads', lambda: read_roads(road_where, tile))
+            stage['rows_out'] = len(roads_df)
+        print(f'Segmenting {len(roads_df)} roads ({road_where or tile or "all roads"})')
+        if len(roads_df) == 0:
+            return roads_df
+        ids = roads_df.OGF_ID.dropna()
+        id_range = (ids.min(), ids.max()) if len(ids) else (0, -1) # roads without an OGF_ID have no events, the empty range reads none
+        event_stage = add_event_spans if segmentation == 'dynamic' else add_events
+        with PrefetchTables(source, stage_reads(tables, id_range, checkpoints) if isinstance(source, GdbTables) else []) as tables_source:
+            for name, add_stage, args in [('address', add_address_ranges, ()), ('events', event_stage, (tables,)), ('routes', add_routes, ())]:
+                # Dynamic segmentation is meant to give several rows per road
+                with run_report.stage(name, rows_in= len(roads_df), one_to_one= add_stage is not add_event_spans) as stage:
+                    roads_df = add_stage(roads_df, *args, tables_source, id_range, checkpoints)
+                    stage['rows_out'] = len(roads_df)
+        roads_df = roads_df.drop([measure_length_field], axis=1)
+        # gdb datetimes are read as UTC
+        roads_df = fixed_dtypes(roads_df, output_dtypes({table : table_dtypes(ORN_GDB, table) for table in tables + ['ORN_ADDRESS_INFO']}, 'UTC'))
+        partition['rows_out'] = len(roads_df)
+    return roads_df
+
+def report_partition(tables, job):
+    # Runs segment_partition in a worker process and returns the partition along with the stage records of the worker
+    global run_report
+    run_report = RunReport()
+    return segment_partition(tables, **job), run_report.stages
+
+def partition_jobs(ogf_ids=None):
+    # Returns the segment_partition arguments of every partition, the OGF_ID ranges or tiles of the roads (or batches of
+    # ogf_ids when given)
+    if ogf_ids is not None:
+        ogf_ids = np.sort(np.asarray(ogf_ids))
+        batches = np.array_split(ogf_ids, max(partitions, int(np.ceil(len(ogf_ids) / 1000)), 1))
+        return [{'road_where' : f'OGF_ID IN ({", ".join(str(i) for i in batch)})'} for batch in batches if len(batch)]
+    if partitions <= 1:
+        return [{}]
+    if partition_by == 'tile':
+        return [{'tile' : tile} for tile in tile_partitions(partitions)]
+    return [{'road_where' : where} for where in ogf_id_partitions(partitions)]
+
+def partition_chain(road_where=None, tile=None):
+    # Returns the name of a partition, its checkpoint chain
+    return f'partition {road_where or tile or "all roads"}'
+
+def segment_roads(tables, ogf_ids=None):
+    # Segments every partition, in a process pool when workers > 1, and stitches the partitions back together ordered on OGF_ID
+    # so that the result does not depend on how the roads were partitioned. When ogf_ids is given only those roads are
+    # segmented, read in batches of at most 1000 ids. The roads read by the partitions must add up to the road layer
+    jobs = partition_jobs(ogf_ids)
+    print(f'Segmenting {len(jobs)} partitions with {workers} workers')
+    first_record = len(run_report.stages)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers= workers) as pool:
+            futures = [pool.submit(report_partition, tables, job) for job in jobs]
+            parts = []
+            for future in futures:
+                part, records = future.result()
+                run_report.extend(records)
+                parts.append(part)
+    else:
+        parts = [segment_partition(tables, **job) for job in jobs]
+    read = sum(record.get('rows_out') or 0 for record in run_report.stages[first_record:] if record['stage'].endswith('partition/read_roads'))
+    if ogf_ids is None and region_ids() is None:
+        total = pyogrio.read_info(road_gdb, layer=road_layer, force_feature_count=True)['features']
+        if read != total:
+            raise RuntimeError(f'The {len(jobs)} partitions read {read} of the {total} roads in {road_layer}')
+    parts = [part for part in parts if len(part)] or parts[:1]
+    if not parts:
+        return gpd.GeoDataFrame(geometry=[], crs=f'EPSG:{espg}')
+    return pd.concat(parts, ignore_index=True).sort_values(by=['OGF_ID'], kind='stable', ignore_index=True)
+
+def element_hashes(tables):
+    # Returns a hash per OGF_ID of the road element attributes plus the EVENT_ID / EFFECTIVE_DATETIME of every event on it
+    # Event hashes are summed per element so the result does not depend on row order. Address events also carry the hash of
+    # their ORN_STREET_NAME_PARSED rows so a re-parsed street name marks its roads as changed
+    roads = pyogrio.read_dataframe(road_gdb, layer=road_layer, read_geometry=False)
+    hashes = pd.Series(pd.util.hash_pandas_object(roads, index=False).values, index=roads['OGF_ID'].values)
+    parsed = read_table(ORN_GDB, 'ORN_STREET_NAME_PARSED', parsed_fields)
+    name_hashes = pd.Series(pd.util.hash_pandas_object(parsed, index=False).values, index=parsed['FULL_STREET_NAME']).groupby(level=0).sum()
+    for table in tables + ['ORN_ADDRESS_INFO', 'ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME']:
+        keys = read_table(ORN_GDB, table, table_fields(ORN_GDB, table, keep=['ORN_ROAD_NET_ELEMENT_ID', 'EVENT_ID', 'EFFECTIVE_DATETIME']))
+        event_hashes = pd.util.hash_pandas_object(keys.assign(TABLE= table), index=False)
+        if table == 'ORN_ADDRESS_INFO':
+            names = read_table(ORN_GDB, table, ['FULL_STREET_NAME'])['FULL_STREET_NAME']
+            event_hashes = event_hashes + names.map(name_hashes).fillna(0).astype('uint64')
+        element_sums = event_hashes.groupby(keys['ORN_ROAD_NET_ELEMENT_ID'].values).sum()
+        hashes = hashes + element_sums.reindex(hashes.index, fill_value=0).astype('uint64')
+    return hashes.rename_axis('OGF_ID').rename('HASH')
+
+def element_changes(new_hashes, old_hashes):
+    # Compares the element hashes of this run with the last run and returns the inserted, updated and deleted OGF_IDs
+    common = new_hashes.index.intersection(old_hashes.index)
+    return {'inserted' : new_hashes.index.difference(old_hashes.index),
+            'updated' : common[new_hashes[common].values != old_hashes[common].values],
+            'deleted' : old_hashes.index.difference(new_hashes.index)}
+
+def upsert_segments(roads_df, writer, layer, remove_ids):
+    # Deletes remove_ids from an existing GeoPackage layer then appends roads_df to it. The gpkg R-tree triggers keep the
+    # spatial index in step with the deletes
+    with sqlite3.connect(writer.path) as con:
+        con.executemany(f'DELETE FROM "{layer}" WHERE OGF_ID = ?', [(ogf_id,) for ogf_id in pd.Index(remove_ids).tolist()])
+    con.close()
+    if len(roads_df):
+        writer.write(roads_df, layer, append=True)
+
+def stream_segments(tables, writer, layer, nrn_writer):
+    # Segments the roads in OGF_ID order, chunk_size roads at a time, against tables indexed in memory once and appends each
+    # encoded chunk to the output layer. Peak memory follows the chunk size and the geometry free tables, not the province
+    print('Indexing ORN tables')
+    with run_report.stage('index_tables'):
+        source = IndexedTables(ORN_GDB, tables + ['ORN_ADDRESS_INFO', 'ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME'])
+    written = 0
+    for road_where in ogf_id_partitions(size=chunk_size):
+        chunk_df = segment_partition(tables, road_where, source=source)
+        if len(chunk_df) == 0:
+            continue
+        chunk_df = chunk_df.sort_values(by=['OGF_ID'], kind='stable', ignore_index=True)
+        with run_report.stage('encode', rows_in= len(chunk_df)):
+            encode_segments(chunk_df)
+        with run_report.stage(f'export/{layer}', rows_in= len(chunk_df)):
+            writer.write(chunk_df, layer)
+        if nrn_export:
+            export_nrn_products(layer, chunk_df, nrn_writer)
+        written += len(chunk_df)
+        print(f'{written} roads written to {layer}')
+
+def export_nrn_products(layer, df, writer):
+    # Writes the NRN tables the configs build from a delivered layer (still in memory) to the NRN GeoPackage, appending to
+    # tables that another config or an earlier chunk already wrote in this run
+    for product in products_for(nrn_products, layer):
+        conformed = conform_product(df, product, df.geometry.name)
+        if conformed is None:
+            continue
+        if df.geometry.name in conformed.columns:
+            conformed = gpd.GeoDataFrame(conformed, geometry=df.geometry.name, crs=df.crs)
+        with run_report.stage(f'nrn/{product["table"]}', rows_in= len(df)) as stage:
+            writer.write(conformed, product['table'])
+            stage['rows_out'] = len(conformed)
+        print(f'{len(conformed)} {layer} rows written to NRN {product["table"]} ({os.path.basename(product["config"])})')
+
+def build_junctions(roads_df):
+    # Topology stage, builds the junction graph of the road elements from FROM_JUNCTION_ID / TO_JUNCTION_ID and returns the
+    # ORN_junctions layer: the ORN_JUNCTION points the roads end at with their NRN junction type, DEGREE and COMPONENT
+    # Dangles and disconnected networks are counted over all the roads given. Regional runs only read the points within the
+    # extent of the region's roads
+    graph = JunctionGraph(roads_df['OGF_ID'].values, roads_df['FROM_JUNCTION_ID'].values, roads_df['TO_JUNCTION_ID'].values)
+    cache = open_layer_cache()
+    load = lambda: pyogrio.read_dataframe(ORN_GDB, layer='ORN_JUNCTION', columns=['JUNCTION_ID'], use_arrow=use_arrow)
+    if region_ids() is not None:
+        xmin, ymin, xmax, ymax = roads_df.total_bounds
+        pad = max(xmax - xmin, ymax - ymin, 1) * 0.001
+        points_df = pyogrio.read_dataframe(ORN_GDB, layer='ORN_JUNCTION', columns=['JUNCTION_ID'], bbox=(xmin - pad, ymin - pad, xmax + pad, ymax + pad),
+                                        use_arrow=use_arrow)
+    elif cache is not None:
+        points_df = cache.read(ORN_GDB, 'ORN_JUNCTION', load, ['JUNCTION_ID'], geometry=True)
+    else:
+        points_df = load()
+    junctions_df, road_component = junction_layer(graph, points_df[['JUNCTION_ID', points_df.geometry.name]], roads_df['ROAD_ELEMENT_TYPE'].values)
+    for check, count in topology_report(graph, road_component).items():
+        run_report.count(check, count)
+    return junctions_df
+
+def encoded_junctions(roads_df):
+    # Returns the ORN_junctions layer of the roads with its junction types encoded
+    jn_df = build_junctions(roads_df)
+    unmapped = encode_layer(jn_df, 'ORN_junctions', code_tables)
+    unmapped_report(unmapped, 'ORN_junctions')
+    return jn_df
+
+def check_events(tables, roads_df):
+    # QA stage, sweeps the measures of every event table for missing, reversed, out of range, overlapping and gapped events
+    # against the element lengths. The per table counts go to qa_report_file and every flagged span is returned cut out of
+    # its road for the ORN_event_qa layer (events past the end of their road and spans of no length get the whole road)
+    def read(table):
+        columns = table_fields(ORN_GDB, table, keep=['ORN_ROAD_NET_ELEMENT_ID', 'EVENT_ID', 'FROM_MEASURE', 'TO_MEASURE', 'STREET_SIDE'])
+        if not {'FROM_MEASURE', 'TO_MEASURE'}.issubset(columns):
+            return None
+        return GdbTables(ORN_GDB).read(table, columns=columns)
+    roads_df = roads_df.drop_duplicates(subset=['OGF_ID']).set_index('OGF_ID')
+    lengths = roads_df[measure_length_field].astype(float)
+    qa_tables = tables + ['ORN_ADDRESS_INFO', 'ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME']
+    with Prefetcher(read, qa_tables, prefetch_depth) as prefetch: # the next tables are read while one is swept
+        flagged_df, report_df = check_tables(prefetch.get, qa_tables, lengths, qa_tolerance, qa_gaps_allowed, qa_overlaps_allowed)
+    prefetch_report(prefetch)
+    report_df.to_csv(qa_report_file, index=False)
+    print(f'{len(flagged_df)} event issues on {flagged_df["ORN_ROAD_NET_ELEMENT_ID"].nunique()} road elements, report written to {qa_report_file}')
+    run_report.count('issues', len(flagged_df))
+    geometries = np.asarray(roads_df.geometry.reindex(flagged_df['ORN_ROAD_NET_ELEMENT_ID']).values, dtype=object)
+    length = lengths.reindex(flagged_df['ORN_ROAD_NET_ELEMENT_ID']).values
+    cut = (flagged_df['QA_TO'].values > flagged_df['QA_FROM'].values) & (length > 0) & ~pd.isna(geometries)
+    cuts = line_substrings(geometries[cut], flagged_df['QA_FROM'].values[cut] / length[cut], flagged_df['QA_TO'].values[cut] / length[cut],
+                        roads_df.crs is not None and roads_df.crs.is_geographic)
+    geometries[cut] = np.where(pd.isna(cuts), geometries[cut], cuts)
+    return gpd.GeoDataFrame(flagged_df, geometry=gpd.GeoSeries(geometries, crs=roads_df.crs))
+
+def encode_segments(roads_df):
+    # Encodes select fields of the segmented roads from strings into NRN numeric codes (in place)
+    if len(roads_df) == 0: # nothing changed in an incremental run
+        return
+    print('Encoding select fields from strings into NRN numeric codes')
+    unmapped = encode_layer(roads_df, 'ORN_Road_Segments', code_tables)
+    unmapped_report(unmapped, 'ORN_Road_Segments')
+    run_report.count('unmapped', sum(counts.sum() for counts in unmapped.values()))
+
+def parse_args(argv):
+    # Reads the command line, every argument defaults to its value in the inputs below
+    # python to_segments_gpd.py --roads Non_Sensitive.gdb/ORN_ROAD_NET_ELEMENT --bbox -79.5 43.6 -79.3 43.8 --out toronto.gpkg
+    # Arguments can be read from a file with @file (one per line), e.g. --ogf-ids @ids.txt
+    parser = argparse.ArgumentParser(description='Converts the ORN LRS into NRN road segments', fromfile_prefix_chars='@')
+    parser.add_argument('--orn-gdb', default=ORN_GDB, help='gdb holding the ORN event tables (default: %(default)s)')
+    parser.add_argument('--working-gdb', default=workingGDB, help='gdb holding the test roads and the QGIS point layers (default: %(default)s)')
+    parser.add_argument('--roads', help=f'road element layer as gdb/layer, e.g. Non_Sensitive.gdb/ORN_ROAD_NET_ELEMENT (default: working gdb/{road_layer})')
+    parser.add_argument('--out', default=out_gpkg, help='delivery GeoPackage (default: %(default)s)')
+    parser.add_argument('--nrn-out', default=nrn_gpkg, help='NRN products GeoPackage (default: %(default)s)')
+    parser.add_argument('--parquet', action='store_true', default=parquet_copy, help=f'also write the delivered layers as GeoParquet to {parquet_dir}')
+    parser.add_argument('--layer-cache', action='store_true', default=use_layer_cache,
+                        help=f'keep Parquet copies of the gdb layers in {layer_cache_dir} for faster reruns (a full copy of the gdbs)')
+    region = parser.add_argument_group('region', 'only the road elements meeting every filter given are processed, their rows are filtered in the reads')
+    region.add_argument('--bbox', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'), help='roads crossing this box, in the road CRS')
+    region.add_argument('--polygon', help='roads crossing the polygons of this layer (any format GDAL reads)')
+    region.add_argument('--polygon-layer', help='layer of --polygon to use, for files holding several layers')
+    region.add_argument('--jurisdiction', nargs='+', help='roads with an ORN_JURISDICTION event of one of these JURISDICTIONs')
+    region.add_argument('--ogf-ids', type=int, nargs='+', help='these road elements')
+    stages = parser.add_argument_group('checkpoints', f'stage outputs are checkpointed in {checkpoint_dir} (a folder per road layer and region) and a rerun resumes from them')
+    stages.add_argument('--checkpoint', action='store_true', default=checkpoint, help='checkpoint the stage outputs and resume from them')
+    stages.add_argument('--rerun', nargs='+', default=rerun_stages, metavar='STAGE',
+                        help='build these stages again (and the stages built from them): roads, address, events/<table>, routes/<table>, '
+                            'element_hashes, ORN_Road_Segments, ORN_toll_booths, ORN_blocked_passages, ORN_junctions, ORN_event_qa')
+    stages.add_argument('--fresh', action='store_true', help='remove the checkpoints of these roads and run every stage')
+    stages.add_argument('--prune', action='store_true', help='remove the checkpoints of every other road layer and region')
+    args = parser.parse_args(argv)
+    if args.bbox is not None and (args.bbox[0] >= args.bbox[2] or args.bbox[1] >= args.bbox[3]):
+        parser.error('--bbox is XMIN YMIN XMAX YMAX')
+    if args.fresh and args.rerun:
+        parser.error('--fresh already reruns every stage')
+    if args.rerun and not args.checkpoint:
+        parser.error('--rerun resumes the other stages from their checkpoints, add --checkpoint')
+    if incremental and (args.bbox or args.polygon or args.jurisdiction or args.ogf_ids):
+        parser.error('regional runs are not incremental, switch incremental off')
+    return args
+
 #Data Source: https://geohub.lio.gov.on.ca/datasets/mnrf::ontario-road-network-orn-road-net-element
 '''                     Conversion Methodology
 Note that the blocked passages and toll point data is excluded from this methodology because the tool needed in arcgis was not licenced.
@@ -27,259 +832,207 @@ ORN_GDB = os.path.join(directory, 'Non_Sensitive.gdb')
 workingGDB = os.path.join(directory, 'workingGDB.gdb')
 #road_ele_data = os.path.join(ORN_GDB, 'ORN_ROAD_NET_ELEMENT') # Full road dataset
 road_ele_data = os.path.join(workingGDB, 'ORN_net_element_tester') #Test area road dataset
+road_gdb, road_layer = os.path.split(road_ele_data)
 espg = 4269 #EPSG number
+use_arrow = importlib.util.find_spec('pyarrow') is not None # Read tables as Arrow batches when pyarrow is available
+field_map_only = False # Only read the event table fields used by the YAML configs below (plus the fields that get encoded)
+field_maps = [os.path.join(os.path.dirname(os.path.abspath(__file__)), yml) for yml in ['ORN_field_map.yaml', 'ORN_ferry_segs.yaml']]
+prefetch_depth = 2 # ORN tables read ahead in threads while the current one is joined (at most this many held in memory), 0 reads each table when its stage asks for it
+workers = 1 # Number of processes segmenting partitions in parallel, 1 runs everything in this process
+partitions = 1 # Number of partitions the road elements are split into
+partition_by = 'ogf_id' # 'ogf_id' splits on OGF_ID ranges, 'tile' on a spatial grid of at least partitions tiles
+unplaced_tile = 'no geometry' # Tile of the roads with a null or empty geometry, which no tile of the grid holds
+backend = 'pandas' # 'pandas' picks the address, event and route rows with pandas, 'duckdb' with DuckDB (multithreaded, spills to disk, needs duckdb)
+duckdb_threads = None # DuckDB threads per process, None uses every core
+duckdb_memory_limit = None # e.g. '4GB', DuckDB spills to duckdb_temp_dir past this. None leaves DuckDB's default (80% of RAM)
+duckdb_temp_dir = os.path.join(directory, 'duckdb_tmp')
+incremental = False # Only re-segment the road elements whose road row or events changed since the last run and upsert them
+state_file = os.path.join(directory, 'segments_state.csv') # Per OGF_ID hashes written by every run
+change_log = os.path.join(directory, 'segments_changes.csv') # Inserted / updated / deleted OGF_IDs of each incremental run
+use_layer_cache = False # Keep Parquet copies of the layers read from the gdbs, refreshed whenever a gdb changes (needs pyarrow), see --layer-cache
+layer_cache_dir = os.path.join(directory, 'layer_cache')
+street_name_cache_dir = os.path.join(directory, 'street_name_cache') # Street names missing from ORN_STREET_NAME_PARSED parsed by earlier runs, None parses them again every run
+report_file = os.path.join(directory, 'files_for_delivery_run_report.json') # Stage timings, peak memory and row counts of the run
+profile = False # Profile the run with cProfile into profile_file (open with snakeviz or pstats). The stages are plain functions so
+                # py-spy record --subprocesses -- python to_segments_gpd.py shows them by name without this switch
+profile_file = os.path.join(directory, 'files_for_delivery_profile.prof')
+run_report = RunReport() # Stage records of this process
+segmentation = 'longest' # 'longest' gives each road element the event covering most of it, 'dynamic' splits the roads into one segment per homogeneous span of events
+measure_length_field = 'LENGTH' # Road field holding the element length in FROM_MEASURE / TO_MEASURE units, used by dynamic segmentation
+min_span_length = 1.0 # Dynamic segmentation ignores breakpoints closer than this (in measure units) to the breakpoint before them
+topology = True # Build ORN_junctions from the roads' FROM/TO_JUNCTION_ID with NRN junction types and count dangles and disconnected networks
+locate_points_from_events = True # Locate ORN_TOLL_POINT and ORN_BLOCKED_PASSAGE on the roads by AT_MEASURE, False reads ORN_Toll_Points / ORN_BLocked_Passages made in QGIS from workingGDB
+event_qa = True # Check the measures of every event table for missing, reversed, out of range, overlapping and gapped events
+qa_tolerance = 0.5 # Measures closer than this (in measure units) are treated as equal by the event QA
+qa_gaps_allowed = ['ORN_ADDRESS_INFO', 'ORN_STRUCTURE', 'ORN_UNDERPASS', 'ORN_ALTERNATE_STREET_NAME', 'ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME'] # Tables not meant to cover their elements end to end
+qa_overlaps_allowed = ['ORN_ALTERNATE_STREET_NAME', 'ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME'] # Tables with concurrent events (several names or routes on one stretch)
+qa_report_file = os.path.join(directory, 'files_for_delivery_event_qa.csv') # Per table counts of each issue
+qa_gpkg = os.path.join(directory, 'files_for_delivery_event_qa.gpkg') # ORN_event_qa layer of the flagged spans
+lrs_tolerance = 1.0 # AT_MEASUREs up to this far (in measure units) past either end of their road element are placed on the end
+chunk_size = None # Stream the roads through the pipeline this many at a time and append them to the output, None segments all at once
+route_field_cap = {'ORN_ROUTE_NUMBER' : 5, 'ORN_ROUTE_NAME' : 4} # Max ROUTE_NUMBER_n / ROUTE_NAME_*_n columns (NRN rtnumber1-5, rtename1-4)
+# Fields the pipeline keeps from each table, everything else is skipped at read time
+address_fields = ['ORN_ROAD_NET_ELEMENT_ID', 'AGENCY_NAME', 'EFFECTIVE_DATETIME', 'EVENT_ID', 'STREET_SIDE', 'HOUSE_NUMBER_STRUCTURE',
+                'FIRST_HOUSE_NUMBER', 'LAST_HOUSE_NUMBER', 'FULL_STREET_NAME']
+parsed_fields = ['FULL_STREET_NAME', 'DIRECTIONAL_PREFIX', 'STREET_TYPE_PREFIX', 'STREET_NAME_BODY', 'STREET_TYPE_SUFFIX', 'DIRECTIONAL_SUFFIX']
+event_drop_fields = ['OBJECTID', 'EVENT_ID'] # dropped from every event table after the longest event is picked
+event_key_fields = ['ORN_ROAD_NET_ELEMENT_ID', 'FROM_MEASURE', 'TO_MEASURE']
+code_tables = load_code_tables(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ORN_code_tables.yaml')) # NRN codes of the encoded fields
+encoded_fields = [field for field, table in code_tables['encode']['ORN_Road_Segments'].values()]
+event_keep_fields = set(event_key_fields + encoded_fields) | field_map_fields(field_maps) if field_map_only else None
+route_fields = {'ORN_ROUTE_NUMBER' : ['ROUTE_NUMBER'], 'ORN_ROUTE_NAME' : ['ROUTE_NAME_ENGLISH', 'ROUTE_NAME_FRENCH']}
+parquet_copy = False # Also write every delivered layer as GeoParquet (a folder of parts per layer) to parquet_dir
+parquet_dir = os.path.join(directory, 'files_for_delivery_parquet')
+nrn_export = True # Build the NRN products of nrn_configs from the delivered layers in memory and write them to nrn_gpkg (full runs only)
+nrn_configs = [os.path.join(os.path.dirname(os.path.abspath(__file__)), yml) for yml in ['ORN_field_map.yaml', 'ORN_ferry_segs.yaml', 'ORN_Toll_Booths.yaml', 'ORN_Blocked_Passages.yaml', 'ORN_junctions.yaml']]
+nrn_products = load_products(nrn_configs)
+nrn_gpkg = os.path.join(directory, 'nrn_delivery.gpkg') # One layer per NRN table (roadseg, addrange, strplaname, ferryseg, tollpoint, blkpassage, junction)
+out_gpkg = os.path.join(directory, 'files_for_delivery.gpkg')
+# Region of a regional rerun, None processes every road element (set from the command line, see parse_args)
+region_bbox = None # (xmin, ymin, xmax, ymax) in the road CRS
+region_polygon = None # Polygon layer file, the roads crossing its polygons are processed
+region_polygon_layer = None
+region_jurisdictions = None # JURISDICTION values of ORN_JURISDICTION
+region_ogf_ids = None # OGF_IDs
+checkpoint = False # Checkpoint every stage output (Parquet, with a manifest) so a rerun after a failure resumes from the last finished stage, see --checkpoint
+checkpoint_dir = os.path.join(directory, 'checkpoints')
+rerun_stages = [] # Stages to build again even when their checkpoint is valid (the stages built from them follow), see --rerun
+max_in_list = 500 # Largest id list pushed down to the gdb as an IN filter, longer lists are pushed down as their id range
 
-#----------------------------------------------------------------------------------------------------------------
-# Main script
-
-tables = fiona.listlayers(ORN_GDB) # List of everything in ORN_GDB
-print('Reading road data into spatial dataframe')
-roads_df = gpd.read_file(workingGDB, layer='ORN_net_element_tester')
-
-OGF_IDS = roads_df.OGF_ID.unique()
-# Remove tables and fc's that require specific treatment or are not required 
-for tbl in ['ORN_ROAD_NET_ELEMENT', 'ORN_JUNCTION', 'ORN_BLOCKED_PASSAGE', 'ORN_TOLL_POINT', 'ORN_UNDERPASS', 'ORN_STREET_NAME_PARSED', 'ORN_ADDRESS_INFO', 'ORN_ROUTE_NAME', 'ORN_ROUTE_NUMBER', 'ORN_OFFICIAL_STREET_NAME']:
-    tables.remove(tbl)
-#Make Address Ranges on L/R
-add_rng_df = gpd.read_file(ORN_GDB, layer='ORN_ADDRESS_INFO') # get full dataset
-field_prefix = 'ADDRESS_INFO'
-add_rng_df.rename(columns={'AGENCY_NAME' : field_prefix + '_AGENCY', 
-                        'EFFECTIVE_DATETIME' : field_prefix + '_EFF_DATE',
-                        'EVENT_ID' : field_prefix + '_EVENT_ID',
-                        }, 
-                        inplace= True)
-# Select only rows that are in the section currently being worked on
-add_rng_df = add_rng_df[add_rng_df['ORN_ROAD_NET_ELEMENT_ID'].isin(OGF_IDS)]
-add_rng_base = add_rng_df[['ORN_ROAD_NET_ELEMENT_ID', 
-                            field_prefix + '_AGENCY',
-                            field_prefix + '_EFF_DATE',
-                            field_prefix + '_EVENT_ID',
-                            'STREET_SIDE',
-                            'HOUSE_NUMBER_STRUCTURE']].drop_duplicates(subset=['ORN_ROAD_NET_ELEMENT_ID'],  keep='first') # Base for adding L/R attributes to the table
-
-#Merger of street nme table
-str_nme_parsed_df = gpd.read_file(ORN_GDB, layer='ORN_STREET_NAME_PARSED') # ORN_STREET_NAME_PARSED table as a df
-add_rng_df = add_rng_df.merge(str_nme_parsed_df, how= 'left', left_on='FULL_STREET_NAME', right_on= 'FULL_STREET_NAME')
-
-#Add the columns to be calculated below as empty columns but specify te dtypes so that there are no errors
-temp_df = pd.DataFrame({'L_HOUSE_NUMBER_STRUCTURE_CDE' : pd.Series([], dtype='int'), 
-                        'L_FIRST_HOUSE_NUM' : pd.Series([], dtype='int'),
-                        'L_LAST_HOUSE_NUM' : pd.Series([], dtype='int'),
-                        'L_FULL_STREET_NAME' :  pd.Series([], dtype='str'), 
-                        'L_DIR_PRE' : pd.Series([], dtype= 'str'),
-                        'L_STR_TYP_PRE' : pd.Series([], dtype= 'str'),
-                        'L_STR_NME_BDY' : pd.Series([], dtype= 'str'),
-                        'L_STR_TYP_SUF' : pd.Series([], dtype= 'str'),
-                        'L_DIR_SUF' : pd.Series([], dtype= 'str'),
-                        'R_HOUSE_NUMBER_STRUCTURE_CDE' : pd.Series([], dtype='int'), 
-                        'R_FIRST_HOUSE_NUM' : pd.Series([], dtype='int'),
-                        'R_LAST_HOUSE_NUM' : pd.Series([], dtype='int'),
-                        'R_FULL_STREET_NAME' :  pd.Series([], dtype='str'), 
-                        'R_DIR_PRE' : pd.Series([], dtype= 'str'),
-                        'R_STR_TYP_PRE' : pd.Series([], dtype= 'str'),
-                        'R_STR_NME_BDY' : pd.Series([], dtype= 'str'),
-                        'R_STR_TYP_SUF' : pd.Series([], dtype= 'str'),
-                        'R_DIR_SUF' : pd.Series([], dtype= 'str')
-                        })
-add_rng_base = pd.concat([add_rng_base, temp_df], axis= 1) # add the new fields to addr_rng_base via a concat
-#Loop to add address info to roads df
-print('Calculating Address Range data')
-for row in add_rng_df.itertuples():
-    index = add_rng_base.ORN_ROAD_NET_ELEMENT_ID[add_rng_base.ORN_ROAD_NET_ELEMENT_ID == row.ORN_ROAD_NET_ELEMENT_ID].index.tolist()[0]
-    Structure_CDE = {'Unknown' : -1, 'None' : 0, 'Even' : 1, 'Odd' : 2, 'Mixed' : 3, 'Irregular' : 4}
-    # Calculate Address range columns and HOUSE_NUMBER_STRUCTURE_CDE based on STREET_SIDE column value
-    if row.STREET_SIDE == 'Left':
-        add_rng_base.at[index, 'L_HOUSE_NUMBER_STRUCTURE_CDE'] = Structure_CDE[row.HOUSE_NUMBER_STRUCTURE]
-        add_rng_base.at[index, 'L_FIRST_HOUSE_NUM'] = row.FIRST_HOUSE_NUMBER
-        add_rng_base.at[index, 'L_LAST_HOUSE_NUM'] = row.LAST_HOUSE_NUMBER
-        add_rng_base.at[index, 'L_FULL_STREET_NAME'] = row.FULL_STREET_NAME
-        #STREET NAME PARSED data
-        add_rng_base.at[index, 'L_DIR_PRE'] = row.DIRECTIONAL_PREFIX
-        add_rng_base.at[index, 'L_STR_TYP_PRE'] = row.STREET_TYPE_PREFIX
-        add_rng_base.at[index, 'L_STR_NME_BDY'] = row.STREET_NAME_BODY
-        add_rng_base.at[index, 'L_STR_TYP_SUF'] = row.STREET_TYPE_SUFFIX
-        add_rng_base.at[index, 'L_DIR_SUF'] = row.DIRECTIONAL_SUFFIX
-
-    if row.STREET_SIDE == 'Right':
-        add_rng_base.at[index, 'R_HOUSE_NUMBER_STRUCTURE_CDE'] = Structure_CDE[row.HOUSE_NUMBER_STRUCTURE]
-        add_rng_base.at[index, 'R_FIRST_HOUSE_NUM'] = row.FIRST_HOUSE_NUMBER
-        add_rng_base.at[index, 'R_LAST_HOUSE_NUM'] = row.LAST_HOUSE_NUMBER
-        add_rng_base.at[index, 'R_FULL_STREET_NAME'] = row.FULL_STREET_NAME
-        #STREET NAME PARSED data
-        add_rng_base.at[index, 'R_DIR_PRE'] = row.DIRECTIONAL_PREFIX
-        add_rng_base.at[index, 'R_STR_TYP_PRE'] = row.STREET_TYPE_PREFIX
-        add_rng_base.at[index, 'R_STR_NME_BDY'] = row.STREET_NAME_BODY
-        add_rng_base.at[index, 'R_STR_TYP_SUF'] = row.STREET_TYPE_SUFFIX
-        add_rng_base.at[index, 'R_DIR_SUF'] = row.DIRECTIONAL_SUFFIX
-
-    if row.STREET_SIDE == 'Both':
-        add_rng_base.at[index, 'L_HOUSE_NUMBER_STRUCTURE_CDE'] = Structure_CDE[row.HOUSE_NUMBER_STRUCTURE]
-        add_rng_base.at[index, 'R_HOUSE_NUMBER_STRUCTURE_CDE'] = Structure_CDE[row.HOUSE_NUMBER_STRUCTURE]
-        add_rng_base.at[index, 'L_FIRST_HOUSE_NUM'] = row.FIRST_HOUSE_NUMBER
-        add_rng_base.at[index, 'L_LAST_HOUSE_NUM'] = row.LAST_HOUSE_NUMBER
-        add_rng_base.at[index, 'R_FIRST_HOUSE_NUM'] = row.FIRST_HOUSE_NUMBER
-        add_rng_base.at[index, 'R_LAST_HOUSE_NUM'] = row.LAST_HOUSE_NUMBER
-        add_rng_base.at[index, 'L_FULL_STREET_NAME'] = row.FULL_STREET_NAME
-        add_rng_base.at[index, 'R_FULL_STREET_NAME'] = row.FULL_STREET_NAME
-        #STREET NAME PARSED data
-        add_rng_base.at[index, 'L_DIR_PRE'] = row.DIRECTIONAL_PREFIX
-        add_rng_base.at[index, 'L_STR_TYP_PRE'] = row.STREET_TYPE_PREFIX
-        add_rng_base.at[index, 'L_STR_NME_BDY'] = row.STREET_NAME_BODY
-        add_rng_base.at[index, 'L_STR_TYP_SUF'] = row.STREET_TYPE_SUFFIX
-        add_rng_base.at[index, 'L_DIR_SUF'] = row.DIRECTIONAL_SUFFIX
-        add_rng_base.at[index, 'R_DIR_PRE'] = row.DIRECTIONAL_PREFIX
-        add_rng_base.at[index, 'R_STR_TYP_PRE'] = row.STREET_TYPE_PREFIX
-        add_rng_base.at[index, 'R_STR_NME_BDY'] = row.STREET_NAME_BODY
-        add_rng_base.at[index, 'R_STR_TYP_SUF'] = row.STREET_TYPE_SUFFIX
-        add_rng_base.at[index, 'R_DIR_SUF'] = row.DIRECTIONAL_SUFFIX
-
-#Merge the Address Range data to the roads data beofre looping other tables 
-roads_df = roads_df.merge(add_rng_base, how= 'left', left_on='OGF_ID', right_on= 'ORN_ROAD_NET_ELEMENT_ID')
-roads_df = roads_df.drop(['ORN_ROAD_NET_ELEMENT_ID', 'HOUSE_NUMBER_STRUCTURE', 
-                        'LENGTH','STREET_SIDE', 'FROM_JUNCTION_ID', 'TO_JUNCTION_ID'], axis=1)
-
-print('Adding non address data to table')
-for table in tables: #Loop for line tables
-    field_prefix = table[4:]
-    print(f'Running segmentification on: {table}')
-    tbl_df = gpd.read_file(ORN_GDB, layer=table)
-    tbl_df = tbl_df.drop('geometry', axis=1)
-    #Rename Table fields
-    tbl_df.rename(columns={'AGENCY_NAME' : field_prefix + '_AGENCY', 
-                            'EFFECTIVE_DATETIME' : field_prefix + '_EFF_DATE',
-                            'EVENT_ID' : field_prefix + '_EVENT_ID',
-                            'NATIONAL_UUID' : field_prefix + '_NAT_UUID', 
-                            'STREET_SIDE': field_prefix + '_STREET_SIDE', 
-                            'FULL_STREET_NAME': field_prefix + '_FULL_STREET_NAME'}, 
-                            inplace= True)
+if __name__ in ['__main__', '__mp_main__']: # __mp_main__ is the script re-run in a spawned worker, which gets the same sys.argv
+    args = parse_args(sys.argv[1:])
+    ORN_GDB, workingGDB, out_gpkg, nrn_gpkg, parquet_copy = args.orn_gdb, args.working_gdb, args.out, args.nrn_out, args.parquet
+    use_layer_cache = args.layer_cache
+    road_gdb, road_layer = os.path.split(os.path.abspath(args.roads)) if args.roads else (workingGDB, road_layer)
+    region_bbox, region_polygon, region_polygon_layer = args.bbox, args.polygon, args.polygon_layer
+    region_jurisdictions, region_ogf_ids = args.jurisdiction, args.ogf_ids
+    checkpoint, rerun_stages = args.checkpoint, args.rerun
+    if args.fresh and __name__ == '__main__' and os.path.isdir(checkpoint_folder()):
+        shutil.rmtree(checkpoint_folder())
+    if args.prune and __name__ == '__main__':
+        prune(checkpoint_dir, keep= checkpoint_folder())
 
-    tbl_df[field_prefix + '_measure_dif'] = np.where(tbl_df['FROM_MEASURE'] > tbl_df['TO_MEASURE'], 
-                        tbl_df['FROM_MEASURE'] - tbl_df['TO_MEASURE'], 
-                        tbl_df['TO_MEASURE'] - tbl_df['FROM_MEASURE']) #Get the measure dif value 
-
-    print(f'Roads length: {len(roads_df)} Table Length: {len(tbl_df)}')
-    merged = gpd.GeoDataFrame(roads_df.merge(tbl_df, how= 'left', left_on='OGF_ID', right_on= 'ORN_ROAD_NET_ELEMENT_ID'), crs= f'EPSG:{espg}')
-    #Sort measure dif values highest to lowest and then drop duplicate OGF_ID records from the dataframe. Leaving only the largest dif (longest seg)
-    merged.sort_values(by=[field_prefix + '_measure_dif'], ascending= True)
-    merged = gpd.GeoDataFrame(merged.drop_duplicates(subset=['OGF_ID'], keep='first'), crs= f'EPSG:{espg}')
-    merged.astype({'OGF_ID' : int})
-    print('Length of dataframe: ' + str(len(merged)))
-    merged = merged.drop( [field_prefix + '_measure_dif',
-                        field_prefix + '_EVENT_ID',
-                        'FROM_MEASURE',
-                        'TO_MEASURE', 
-                        'ORN_ROAD_NET_ELEMENT_ID'],
-                         axis=1) # Removes non-essential fields
-    roads_df = merged
-
-print('Creating route name and number multi fields')
-#Route Name and Number Multifields
-for table in ['ORN_ROUTE_NUMBER', 'ORN_ROUTE_NAME']:
-    field_prefix = table[4:]
-    print(f'Running segmentification on: {table}')
-    tbl_df = gpd.read_file(ORN_GDB, layer=table)
-    tbl_df = tbl_df.drop(['EVENT_ID', 'AGENCY_NAME'], axis=1) # Drop some excess fields
-    print(f'Iterating over matches for the ORN_NET_ID in {table}')
-    for row in roads_df.itertuples():
-        ogf_id = row.OGF_ID
-        matched_df = tbl_df.loc[tbl_df['ORN_ROAD_NET_ELEMENT_ID'] == ogf_id] # df of compiled matches
-        for match_row in matched_df.itertuples():
-            fields_to_extract = {'ORN_ROUTE_NUMBER' : ['ROUTE_NUMBER'], 'ORN_ROUTE_NAME' : ['ROUTE_NAME_ENGLISH', 'ROUTE_NAME_FRENCH']}
-            count = 1           
-            if table == 'ORN_ROUTE_NUMBER':
-                roads_df[f'ROUTE_NUMBER_{count}'] = matched_df.ROUTE_NUMBER
-                count += 1            
-            if table == 'ORN_ROUTE_NAME':
-                roads_df[f'ROUTE_NAME_ENGLISH_{count}'] = matched_df.ROUTE_NAME_ENGLISH
-                roads_df[f'ROUTE_NAME_FRENCH_{count}'] = matched_df.ROUTE_NAME_FRENCH
-                count += 1
-
-print('Encoding select fields from strings into NRN numeric codes')
-# Encode certain fields from the loop
-NumberizeField(roads_df, 'ACQUISITION_TECHNIQUE', 'ACQUISITION_TECHNIQUE', {'UNKNOWN' : -1,
-                                                                        'NONE' : 0,
-                                                                        'OTHER' : 1,
-                                                                        'GPS' : 2,
-                                                                        'ORTHOIMAGE' : 3,
-                                                                        'ORTHOPHOTO' : 4,
-                                                                        'VECTOR DATA' : 5,
-                                                                        'PAPER MAP' : 6,
-                                                                        'FIELD COMPLETION' : 7,
-                                                                        'RASTER DATA' : 8,
-                                                                        'DIGITAL ELEVATION MODEL' : 9,
-                                                                        'AERIAL PHOTO' : 10,
-                                                                        'RAW IMAGERY DATA' : 11,
-                                                                        'COMPUTED' : 12})
-
-NumberizeField(roads_df, 'ROAD_CLASS', 'ROAD_CLASS', {'Freeway' : 1, 
-                                                    'Expressway / Highway' : 2, 
-                                                    'Arterial' : 3, 
-                                                    'Collector' : 4,
-                                                    'Local / Street' : 5,
-                                                    'Local / Strata' : 6,
-                                                    'Local / Unknown' : 7,
-                                                    'Alleyway / Laneway' : 8,
-                                                    'Ramp' : 9,
-                                                    'Resource / Recreation' : 10,
-                                                    'Rapid Transit' : 11,
-                                                    'Service' : 12,
-                                                    'Winter' : 13})   
-
-NumberizeField(roads_df, 'STRUCTURE_TYPE', 'STRUCTURE_TYPE', {'None' : 0,
-                                                            'Bridge' : 1,
-                                                            'Bridge Covered' : 2,
-                                                            'Bridge Moveable' : 3,
-                                                            'Tunnel'  : 5,
-                                                            'Dam' : 7})
-
-NumberizeField(roads_df, 'DIRECTION_OF_TRAFFIC_FLOW', 'DIRECTION_OF_TRAFFIC_FLOW', 
-                                                        {'Unknown' : -1, 
-                                                        'Both' : 1,
-                                                        'Positive' : 2, # 'Positive' - flow of traffic same as digitizing direction (Same Direction)
-                                                        'Negative' : 3 # 'Negative' - flow of traffic different from digitizing direction (Opposite Direction)
-                                                        })
-
-NumberizeField(roads_df, 'PAVEMENT_STATUS', 'PAVEMENT_STATUS', {'Paved' : 1, 'Unpaved' : 2})
-
-NumberizeField(roads_df, 'SURFACE_TYPE', 'UNPAVED_SURFACE_TYPE', {'Unknown' : -1,
-                                                                'None' : 0,
-                                                                'Gravel' : 1,
-                                                                'Dirt' : 2})
-
-NumberizeField(roads_df, 'SURFACE_TYPE', 'PAVED_SURFACE_TYPE', {'Unknown' : -1, 
-                                                                'None' : 0,
-                                                                'Rigid' : 1, # Rigid = Summer (Same def between docs)
-                                                                'Flexible' : 2, # Flexible = Winter (Same def between docs)
-                                                                'Blocks' : 3
-                                                                })
-
-# Directional prefix and suffix encoding
-direction_cde = {'None' : 0, 'North' : 1, 'Nord' : 2, 'South' : 3, 'Sud' : 4, 'East' : 5, 'Est' : 6, 'West' : 7, 'Ouest' : 8, 'North West' : 9,
-            'Nord Ouest' : 10, 'North East' : 11, 'Nord Est' : 12, 'South West' :13, 'Sud Ouest' : 14, 'South East' : 15, 'Sud Est' : 16, 
-            'Central' : 17, 'Centre' : 18}
- 
-NumberizeField(roads_df, 'L_DIR_PRE', 'L_DIR_PRE', direction_cde)
-NumberizeField(roads_df, 'L_DIR_SUF', 'L_DIR_SUF', direction_cde)
-
-#Export the complete roads df
-print('Exporting compiled dataset.')
-roads_df.to_file(os.path.join(directory, 'files_for_delivery.gpkg'), layer= 'ORN_Road_Segments', driver='GPKG')
-
-#----------------------------------------------------------------------------------------------------------------------------------
-# Encode fields in point datasets and add them to the GPKG
-
-#Toll Points field encoding
-print('Importing and encoding Toll Points data')
-tp_df = gpd.read_file(workingGDB, layer= 'ORN_Toll_Points') # ORN_Toll_Points created in QGIS with the linear referencing plugin
-tp_df = tp_df.drop(['EVENT_ID', 'AT_MEASURE', 'lrs_err'], axis=1)
-NumberizeField(tp_df, 'TOLL_POINT', 'TOLL_PNT_TYP', {'Unknown' :-1, 'Physical' : 1, 'Virtual' : 2, 'Hybrid' : 3})
-tp_df.to_file(os.path.join(directory, 'files_for_delivery.gpkg'), layer='ORN_toll_booths', driver='GPKG')
-
-#Blocked Passages field encoding
-print('Importing and encoding Blocked Passages data')
-bp_df = gpd.read_file(workingGDB, layer='ORN_BLocked_Passages')
-bp_df = bp_df.drop(['EVENT_ID', 'AT_MEASURE', 'lrs_err'], axis=1)
-NumberizeField(bp_df, 'BLOCKED_PA', 'BLKD_PASS_TYP', {'Unknown' : -1, 'Permanent' : 1, 'Removable' : 2})
-bp_df.to_file(os.path.join(directory, 'files_for_delivery.gpkg'), layer= 'ORN_blocked_passages', driver='GPKG')
-
-print('DONE!')
+if __name__ == '__main__':
+    #----------------------------------------------------------------------------------------------------------------
+    # Main script
+
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        print(f'Profiling this process (pid {os.getpid()}), worker processes are not included')
+        profiler.enable()
+    tables = event_tables(ORN_GDB)
+    region = region_ids()
+    if region is not None and len(region) == 0:
+        sys.exit('No road elements in the region')
+    run_checkpoints = open_checkpoints('run')
+    element_state, changes = None, None
+    if region is None:
+        print('Hashing road elements and events')
+        with run_report.stage('hash') as stage:
+            element_state = run_stage(run_checkpoints, 'element_hashes', lambda: element_hashes(tables).to_frame())['HASH']
+            stage['rows_out'] = len(element_state)
+    else:
+        print(f'Regional run, {out_gpkg} only holds the region and {state_file} is left as it is')
+    if incremental and region is None and os.path.exists(state_file) and os.path.exists(out_gpkg):
+        last_state = pd.read_csv(state_file, index_col='OGF_ID', dtype={'HASH' : 'uint64'})['HASH']
+        changes = element_changes(element_state, last_state)
+        print(', '.join(f'{len(ids)} {change}' for change, ids in changes.items()) + ' road elements since the last run')
+    if nrn_export and changes is not None:
+        print('Incremental run, the NRN products are only rebuilt by full runs')
+    elif nrn_export and os.path.exists(nrn_gpkg):
+        os.remove(nrn_gpkg)
+    delivery_writer = GpkgWriter(out_gpkg, parquet_dir if parquet_copy else None, use_arrow)
+    nrn_writer = GpkgWriter(nrn_gpkg, use_arrow=use_arrow)
+    print('Reading road data into spatial dataframe')
+    if changes is None and chunk_size:
+        with run_report.stage('stream'):
+            stream_segments(tables, delivery_writer, 'ORN_Road_Segments', nrn_writer)
+    elif changes is None:
+        # The segmented roads are resumed once every partition checkpoint they were built from is unchanged
+        if run_checkpoints is not None and run_checkpoints.valid('ORN_Road_Segments', {'segments' : segments_version(rerun_stages)}):
+            roads_df = run_checkpoints.load('ORN_Road_Segments')
+            print(f'ORN_Road_Segments: resumed from the checkpoint of {run_checkpoints.manifest["stages"]["ORN_Road_Segments"]["saved"]}')
+        else:
+            with run_report.stage('segment') as stage:
+                roads_df = segment_roads(tables)
+                stage['rows_out'] = len(roads_df)
+            with run_report.stage('encode', rows_in= len(roads_df)):
+                encode_segments(roads_df)
+            if run_checkpoints is not None:
+                run_checkpoints.save('ORN_Road_Segments', roads_df, {'segments' : segments_version()})
+        #Export the complete roads df
+        print('Exporting compiled dataset.')
+        with run_report.stage('export/ORN_Road_Segments', rows_in= len(roads_df)):
+            delivery_writer.write(roads_df, 'ORN_Road_Segments')
+        if nrn_export:
+            export_nrn_products('ORN_Road_Segments', roads_df, nrn_writer)
+    else:
+        with run_report.stage('segment') as stage:
+            roads_df = segment_roads(tables, changes['inserted'].union(changes['updated']))
+            stage['rows_out'] = len(roads_df)
+        with run_report.stage('encode', rows_in= len(roads_df)):
+            encode_segments(roads_df)
+        print('Updating changed road elements in the compiled dataset.')
+        with run_report.stage('upsert/ORN_Road_Segments', rows_in= len(roads_df)):
+            upsert_segments(roads_df, delivery_writer, 'ORN_Road_Segments', changes['updated'].union(changes['deleted']))
+        run_date = datetime.now().isoformat(timespec='seconds')
+        log_df = pd.concat([pd.DataFrame({'OGF_ID' : ids, 'CHANGE' : change, 'RUN_DATE' : run_date}) for change, ids in changes.items()])
+        log_df.to_csv(change_log, mode='a', header=not os.path.exists(change_log), index=False)
+    if element_state is not None:
+        element_state.to_csv(state_file, header=True)
+
+    #----------------------------------------------------------------------------------------------------------------------------------
+    # Encode fields in point datasets and add them to the GPKG
+
+    #Toll Points field encoding
+    print('Importing and encoding Toll Points data')
+    with run_report.stage('export/ORN_toll_booths') as stage:
+        # ORN_Toll_Points is the layer created in QGIS with the linear referencing plugin
+        tp_df = run_stage(run_checkpoints, 'ORN_toll_booths', lambda: point_layer('ORN_TOLL_POINT', 'ORN_Toll_Points', 'ORN_toll_booths'))
+        delivery_writer.write(tp_df, 'ORN_toll_booths')
+        stage['rows_out'] = len(tp_df)
+    if nrn_export and changes is None:
+        export_nrn_products('ORN_toll_booths', tp_df, nrn_writer)
+
+    #Blocked Passages field encoding
+    print('Importing and encoding Blocked Passages data')
+    with run_report.stage('export/ORN_blocked_passages') as stage:
+        bp_df = run_stage(run_checkpoints, 'ORN_blocked_passages', lambda: point_layer('ORN_BLOCKED_PASSAGE', 'ORN_BLocked_Passages', 'ORN_blocked_passages'))
+        delivery_writer.write(bp_df, 'ORN_blocked_passages')
+        stage['rows_out'] = len(bp_df)
+    if nrn_export and changes is None:
+        export_nrn_products('ORN_blocked_passages', bp_df, nrn_writer)
+
+    #Junctions from the road topology
+    if topology:
+        print('Building the junction topology')
+        with run_report.stage('export/ORN_junctions') as stage:
+            jn_df = run_stage(run_checkpoints, 'ORN_junctions', lambda: encoded_junctions(whole_roads()))
+            delivery_writer.write(jn_df, 'ORN_junctions')
+            stage['rows_out'] = len(jn_df)
+        if nrn_export and changes is None:
+            export_nrn_products('ORN_junctions', jn_df, nrn_writer)
+
+    #Measure QA of the event tables
+    qa_writer = GpkgWriter(qa_gpkg, use_arrow=use_arrow)
+    if event_qa:
+        print('Checking event measures')
+        with run_report.stage('event_qa') as stage:
+            qa_df = run_stage(run_checkpoints, 'ORN_event_qa', lambda: check_events(tables, whole_roads()))
+            qa_writer.write(qa_df, 'ORN_event_qa')
+            stage['rows_out'] = len(qa_df)
+
+    with run_report.stage('export/spatial_index'):
+        delivery_writer.close()
+        nrn_writer.close()
+        qa_writer.close()
+
+    if open_layer_cache() is not None:
+        open_layer_cache().report()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+        print(f'Profile written to {profile_file}')
+    run_report.write(report_file, workers= workers, partitions= partitions, partition_by= partition_by, chunk_size= chunk_size,
+                    incremental= changes is not None, region_roads= None if region is None else len(region))
+    print('DONE!')